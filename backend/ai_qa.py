@@ -13,20 +13,35 @@
 - 优雅降级
 """
 
+import asyncio
+import concurrent.futures
+import heapq
+import http.client
+import json
 import logging
 import os
-import json
 from pathlib import Path
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
 import re
 import sqlite3
+import threading
+import time
 from collections import Counter
-from contextlib import closing
+from contextlib import aclosing, closing
 from math import sqrt
-from typing import Dict, List, Optional, Tuple
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 
-from .db import DB_PATH
+from .circuit_breaker import CircuitBreaker
+from .db import DB_PATH, ensure_qa_kb_features
+from .kb_dedup import DEFAULT_THRESHOLD as DEFAULT_DUP_THRESHOLD, KBDedup
+from .kb_index import KBIndex, parse_features, serialize_features
+from .kb_matrix import AVAILABLE as KB_MATRIX_AVAILABLE, KBMatrix
+from .kb_misses import MissTracker
+from .kb_shards import KBShardPool
+from .kb_snapshot import KBSnapshot, resolve_snapshot
+from .llm_cache import LLMAnswerCache
+from .llm_client import AsyncHTTPConnectionPool, BudgetExceeded, HTTPConnectionPool, LLMHTTPError
+from .settings_cache import SettingsCache
+from .singleflight import FlightRejected, SingleFlight
 
 logger = logging.getLogger(__name__)
 
@@ -90,32 +105,447 @@ def _load_kb(conn: sqlite3.Connection) -> List[Dict]:
     return items
 
 
-def retrieve_best(question: str) -> Tuple[Optional[Dict], float]:
-    """检索最匹配的知识库条目，返回条目和相似度得分"""
+# 常驻倒排索引：首次检索时从快照 + 快照后变更加载，此后由 /qa_kb 写接口原地更新，
+# 其他进程的写入按知识库代数定期同步
+_KB_INDEX = KBIndex(_char_bigrams, _normalize_text)
+_KB_INDEX_LOAD_LOCK = threading.Lock()
+# 索引快照文件：与数据库同目录，供各进程内存映射
+_KB_SNAPSHOT_PATH = os.getenv("KB_SNAPSHOT_PATH") or os.path.splitext(DB_PATH)[0] + ".kbsnap"
+# 快照之后累计变更超过此条数时重写快照
+_KB_SNAPSHOT_REFRESH = int(os.getenv("KB_SNAPSHOT_REFRESH", "500"))
+# 检查其他进程写入的最小间隔（秒）
+_KB_SYNC_INTERVAL = float(os.getenv("KB_SYNC_INTERVAL", "1.0"))
+_KB_SYNC_LOCK = threading.Lock()
+_KB_SYNC_STATE = {"checked_at": 0.0, "synced_rows": 0}
+
+
+def get_kb_index() -> KBIndex:
+    """获取已加载的知识库索引（懒加载，线程安全）"""
+    if not _KB_INDEX.loaded:
+        with _KB_INDEX_LOAD_LOCK:
+            if not _KB_INDEX.loaded:
+                with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+                    ensure_qa_kb_features(conn)
+                    conn.commit()
+                    _KB_INDEX.load(conn, KBSnapshot.open(_KB_SNAPSHOT_PATH))
+                _maybe_save_kb_snapshot()
+                _KB_SYNC_STATE["checked_at"] = time.monotonic()
+    elif time.monotonic() - _KB_SYNC_STATE["checked_at"] >= _KB_SYNC_INTERVAL:
+        _sync_kb_index()
+    return _KB_INDEX
+
+
+def _sync_kb_index() -> None:
+    """同步其他连接 / 进程提交的知识库变更（同一时刻只有一个线程执行）"""
+    if not _KB_SYNC_LOCK.acquire(blocking=False):
+        return
     try:
+        _KB_SYNC_STATE["checked_at"] = time.monotonic()
+        with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+            n = _KB_INDEX.sync(conn)
+        _KB_SYNC_STATE["synced_rows"] += n
+        if n:
+            # 变更可能来自其他进程：持久层缓存已由修改方失效，这里丢弃本进程内存层中可能过期的回答
+            _LLM_CACHE.drop_memory()
+            _MISS_CACHE.drop_memory()
+        _maybe_save_kb_snapshot()
+    except sqlite3.Error as e:
+        logger.warning("同步知识库索引失败: %s", e)
+    finally:
+        _KB_SYNC_LOCK.release()
+
+
+# 快照在后台线程中重写，检索路径只负责触发；写入失败后至少间隔此秒数再重试
+_KB_SNAPSHOT_RETRY = float(os.getenv("KB_SNAPSHOT_RETRY", "60"))
+_KB_SNAPSHOT_LOCK = threading.Lock()
+_KB_SNAPSHOT_STATE: Dict = {"thread": None, "failed_at": None, "writes": 0, "failures": 0}
+
+
+def _maybe_save_kb_snapshot(force: bool = False) -> bool:
+    """快照缺失或累计变更较多时在后台重写快照，返回是否启动了重写"""
+    pending = _KB_INDEX.pending
+    if not (force or (pending and (pending >= _KB_SNAPSHOT_REFRESH or resolve_snapshot(_KB_SNAPSHOT_PATH) is None))):
+        return False
+    with _KB_SNAPSHOT_LOCK:
+        thread = _KB_SNAPSHOT_STATE["thread"]
+        if thread is not None and thread.is_alive():
+            return False
+        failed_at = _KB_SNAPSHOT_STATE["failed_at"]
+        if not force and failed_at is not None and time.monotonic() - failed_at < _KB_SNAPSHOT_RETRY:
+            return False
+        thread = threading.Thread(target=_save_kb_snapshot, name="kb-snapshot", daemon=True)
+        _KB_SNAPSHOT_STATE["thread"] = thread
+        thread.start()
+    return True
+
+
+def _save_kb_snapshot() -> None:
+    try:
+        ok = _KB_INDEX.save_snapshot(_KB_SNAPSHOT_PATH)
+    except Exception:
+        logger.exception("重写知识库索引快照失败")
+        ok = False
+    with _KB_SNAPSHOT_LOCK:
+        _KB_SNAPSHOT_STATE["failed_at"] = None if ok else time.monotonic()
+        _KB_SNAPSHOT_STATE["writes" if ok else "failures"] += 1
+
+
+def wait_kb_snapshot(timeout: Optional[float] = None) -> bool:
+    """等待正在进行的快照重写结束（供基准测试等需要确定性的场景），返回是否已无进行中的重写"""
+    with _KB_SNAPSHOT_LOCK:
+        thread = _KB_SNAPSHOT_STATE["thread"]
+    if thread is not None:
+        thread.join(timeout)
+        return not thread.is_alive()
+    return True
+
+
+def kb_item_updated(conn: sqlite3.Connection, item_id: int) -> None:
+    """/qa_kb 新增或更新后调用：原地刷新索引中的单条条目与其 MinHash 签名，并失效相关回答缓存
+
+    新条目可能覆盖此前未命中的问题：清空未命中回答缓存，并移除该问题的未命中记录
+    """
+    _KB_INDEX.upsert_from_db(conn, item_id)
+    row = conn.execute("SELECT id, question, gen FROM qa_kb WHERE id=?", (item_id,)).fetchone()
+    if row is not None:
+        # 本次写入已原地应用：记录其代数，避免下次同步当作外部变更而丢弃回答缓存的内存层
+        _KB_INDEX.advance(row[2])
+        _KB_DEDUP.index_rows(conn, [tuple(row[:2])])
+        _KB_MISSES.resolve(conn, _normalize_text(row[1] or ""))
+        conn.commit()
+    _LLM_CACHE.invalidate_kb(item_id)
+    _MISS_CACHE.invalidate_all()
+
+
+def kb_item_deleted(conn: sqlite3.Connection, item_id: int) -> None:
+    """/qa_kb 删除提交后调用：从索引中移除单条条目，并失效相关回答缓存"""
+    _KB_INDEX.remove(item_id)
+    row = conn.execute("SELECT gen FROM qa_kb_tombstones WHERE id=?", (item_id,)).fetchone()
+    if row is not None:
+        _KB_INDEX.advance(row[0])
+    _LLM_CACHE.invalidate_kb(item_id)
+
+
+# 近似重复检测：MinHash 签名与 LSH 桶持久化在数据库中，不占用进程内存
+_KB_DEDUP = KBDedup(_char_bigrams)
+
+
+def kb_find_duplicates(
+    conn: sqlite3.Connection, question: str, exclude_id: Optional[int] = None, threshold: float = DEFAULT_DUP_THRESHOLD
+) -> List[Dict]:
+    """查找与问题近似重复的已有条目（只查询固定数量的 LSH 桶）"""
+    return _KB_DEDUP.find_similar(conn, question, threshold, exclude_id)
+
+
+def kb_backfill_minhash(conn: sqlite3.Connection) -> int:
+    """为尚无 MinHash 签名的行补算签名（不提交）"""
+    return _KB_DEDUP.backfill(conn)
+
+
+def kb_duplicate_clusters(threshold: float = DEFAULT_DUP_THRESHOLD) -> List[List[Dict]]:
+    """列出全库近似重复簇，每簇为条目列表（按 id 升序），按簇大小降序"""
+    with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+        if _KB_DEDUP.backfill(conn):
+            conn.commit()
+        clusters = _KB_DEDUP.clusters(conn, threshold)
+        if not clusters:
+            return []
+        conn.row_factory = sqlite3.Row
+        ids = [i for c in clusters for i in c]
+        items: Dict[int, Dict] = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            for r in conn.execute(
+                f"SELECT id, question, answer, created_at, updated_at FROM qa_kb WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ):
+                items[r["id"]] = dict(r)
+    return [[items[i] for i in c if i in items] for c in clusters]
+
+
+def kb_features(question: str) -> Tuple[str, str]:
+    """返回条目的 (标准化问题, 序列化双字组特征)，与索引补写的格式一致"""
+    return _normalize_text(question), serialize_features(Counter(_char_bigrams(question)))
+
+
+def kb_backfill_features(conn: sqlite3.Connection) -> int:
+    """为缺少持久化特征的行补写特征（不提交），返回补写条数"""
+    rows = conn.execute(
+        "SELECT id, question FROM qa_kb WHERE question_norm IS NULL OR features IS NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE qa_kb SET question_norm=?, features=? WHERE id=?",
+        [(*kb_features(r[1] or ""), r[0]) for r in rows],
+    )
+    return len(rows)
+
+
+def kb_bulk_updated() -> int:
+    """批量导入后调用：移除已被覆盖的未命中记录并清空未命中回答缓存；
+    索引已加载时一次性同步（只读取变更的行）并按需重写快照，返回同步条数
+    """
+    n = 0
+    with _KB_SYNC_LOCK:
+        with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+            if _KB_INDEX.loaded:
+                n = _KB_INDEX.sync(conn)
+            # 与检索引擎无关（fts 引擎不加载索引）：导入的条目可能覆盖此前未命中的问题
+            _KB_MISSES.resolve_existing(conn)
+            conn.commit()
+        if _KB_INDEX.loaded:
+            _KB_SYNC_STATE["synced_rows"] += n
+            _KB_SYNC_STATE["checked_at"] = time.monotonic()
+            _maybe_save_kb_snapshot()
+    _MISS_CACHE.invalidate_all()
+    return n
+
+
+def _match_bonus(question: str, item_question: str) -> float:
+    """精确匹配 / 子串匹配加分（question 需已 strip）"""
+    iq = item_question.strip()
+    if iq == question:
+        return 0.2
+    if question in iq:
+        return 0.1
+    return 0.0
+
+
+def _kb_engine() -> str:
+    """检索引擎配置：index（倒排索引，默认）、matrix（稀疏矩阵，需 numpy/scipy）、
+    fts（SQLite FTS5 BM25 召回 + 余弦重排，无需常驻内存）
+    或 sharded（多进程按 id 区间分片检索内存映射快照，适合数十万条以上）"""
+    return (os.getenv("KB_ENGINE") or "index").strip().lower()
+
+
+_KB_MATRIX: Optional[KBMatrix] = None
+_KB_MATRIX_WARNED = False
+
+
+def _get_kb_matrix() -> Optional[KBMatrix]:
+    """按配置返回稀疏矩阵引擎；未启用或依赖缺失时返回 None"""
+    global _KB_MATRIX, _KB_MATRIX_WARNED
+    if _kb_engine() != "matrix":
+        return None
+    if not KB_MATRIX_AVAILABLE:
+        if not _KB_MATRIX_WARNED:
+            logger.warning("KB_ENGINE=matrix 但未安装 numpy/scipy，回退到倒排索引")
+            _KB_MATRIX_WARNED = True
+        return None
+    if _KB_MATRIX is None:
+        _KB_MATRIX = KBMatrix(get_kb_index(), _char_bigrams, _normalize_text, _cosine, _match_bonus)
+    return _KB_MATRIX
+
+
+def _needs_full_scan(question: str) -> bool:
+    """极短问题无法构成双字组，子串加分需退化为全量扫描"""
+    return len(_normalize_text(question).replace(" ", "")) < 2
+
+
+def _retrieve_top_k_index(
+    index: KBIndex, question: str, k: int, min_score: float
+) -> List[Tuple[Dict, float]]:
+    """倒排索引路径：有界堆 + 上界剪枝"""
+    q = question.strip()
+    return index.top_k(
+        Counter(_char_bigrams(question)),
+        k,
+        min_score,
+        lambda item: _match_bonus(q, item["question"]),
+        full_scan=_needs_full_scan(question),
+    )
+
+
+_KB_SHARDS: Optional[KBShardPool] = None
+
+
+def _get_kb_shards(index: KBIndex) -> Optional[KBShardPool]:
+    """按配置返回分片检索进程池；未启用、没有快照或条目数不足时返回 None"""
+    global _KB_SHARDS
+    if _kb_engine() != "sharded":
+        return None
+    if _KB_SHARDS is None:
+        _KB_SHARDS = KBShardPool(
+            int(os.getenv("KB_SHARD_WORKERS") or os.cpu_count() or 1),
+            _match_bonus,
+            min_rows=int(os.getenv("KB_SHARD_MIN_ROWS", "50000")),
+        )
+    return _KB_SHARDS if _KB_SHARDS.usable(index) else None
+
+
+def _rebase_kb_index() -> bool:
+    """快照文件已被其他进程重写：以新快照为底重新加载索引，返回是否换底"""
+    with _KB_SYNC_LOCK:
+        base, _ = _KB_INDEX.base_view()
+        snap = KBSnapshot.open(_KB_SNAPSHOT_PATH)
+        if snap is None or (base is not None and snap.generation == base.generation):
+            return False
         with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
-            kb = _load_kb(conn)
-        if not kb:
-            return None, 0.0
-
-        q_vec = Counter(_char_bigrams(question))
-        best: Optional[Dict] = None
-        best_score = 0.0
-        for item in kb:
-            c_vec = Counter(_char_bigrams(item["question"]))
-            score = _cosine(q_vec, c_vec)
-            # 精确匹配加分
-            if item["question"].strip() == question.strip():
-                score += 0.2
-            elif question.strip() in item["question"].strip():
-                score += 0.1
-            if score > best_score:
-                best_score = score
-                best = item
-        return best, best_score
+            _KB_INDEX.load(conn, snap)
+        return True
+
+
+def _retrieve_top_k_sharded(
+    shards: KBShardPool, index: KBIndex, questions: List[str], k: int, min_score: float
+) -> List[List[Tuple[Dict, float]]]:
+    """分片路径：散发到各进程检索快照，本进程检索内存增量后合并；不可用时回退到倒排索引"""
+    queries = [
+        (dict(Counter(_char_bigrams(q))), q.strip(), _needs_full_scan(q)) for q in questions
+    ]
+    tops = shards.top_k_batch(index, queries, k, min_score)
+    if tops is None and _rebase_kb_index():
+        tops = shards.top_k_batch(index, queries, k, min_score)
+    if tops is None:
+        tops = [_retrieve_top_k_index(index, q, k, min_score) for q in questions]
+    return tops
+
+
+# FTS 模式下每次召回的 BM25 候选数量
+_FTS_CANDIDATES = int(os.getenv("KB_FTS_CANDIDATES", "200"))
+_KB_COLUMNS = "q.id, q.question, q.answer, q.created_at, q.updated_at, q.features"
+# 其他写入方（如外部脚本）插入的行没有特征，不在全文索引中；检索时定期补写
+_FTS_BACKFILL_STATE = {"checked_at": float("-inf")}
+
+
+def _fts_match_expr(question: str) -> str:
+    """生成 FTS5 查询表达式：与索引相同的标准化双字组，任一命中即召回（与倒排索引的候选集一致）"""
+    return " OR ".join(f'"{bg}"' for bg in dict.fromkeys(_char_bigrams(question)))
+
+
+def _fts_candidates(conn: sqlite3.Connection, question: str) -> List[sqlite3.Row]:
+    """从 SQLite 召回候选行
+
+    - 双字组 MATCH 按 BM25 排序召回至多 _FTS_CANDIDATES 条
+    - 极短问题（标准化后不足两个字符）另以子串匹配补充可获得加分的条目，
+      对应倒排索引路径的全量扫描；这类问题的 instr 扫描无法使用索引
+    """
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    rows: List[sqlite3.Row] = []
+    expr = _fts_match_expr(question)
+    if expr:
+        rows = cur.execute(
+            f"""
+            SELECT {_KB_COLUMNS} FROM qa_kb_fts f JOIN qa_kb q ON q.id = f.rowid
+            WHERE qa_kb_fts MATCH ? ORDER BY bm25(qa_kb_fts) LIMIT ?
+            """,
+            (expr, _FTS_CANDIDATES),
+        ).fetchall()
+    q = question.strip()
+    remain = _FTS_CANDIDATES - len(rows)
+    if remain <= 0 or not q or not _needs_full_scan(question):
+        return rows
+    seen = [r["id"] for r in rows]
+    exclude = f"AND q.id NOT IN ({','.join('?' * len(seen))})" if seen else ""
+    rows.extend(cur.execute(
+        f"""
+        SELECT {_KB_COLUMNS} FROM qa_kb q WHERE instr(q.question, ?) > 0 {exclude}
+        ORDER BY LENGTH(q.question) ASC, q.id DESC LIMIT ?
+        """,
+        (q, *seen, remain),
+    ).fetchall())
+    return rows
+
+
+def _fts_backfill(conn: sqlite3.Connection) -> None:
+    """为缺少特征的行补写特征（触发器随之写入全文索引）；按同步间隔节流"""
+    now = time.monotonic()
+    if now - _FTS_BACKFILL_STATE["checked_at"] < _KB_SYNC_INTERVAL:
+        return
+    _FTS_BACKFILL_STATE["checked_at"] = now
+    if conn.execute("SELECT 1 FROM qa_kb WHERE question_norm IS NULL LIMIT 1").fetchone() is None:
+        return
+    try:
+        if kb_backfill_features(conn):
+            conn.commit()
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        logger.debug("补写知识库特征失败: %s", e)
+
+
+def _retrieve_top_k_fts(question: str, k: int, min_score: float) -> List[Tuple[Dict, float]]:
+    """FTS 路径：BM25 召回少量候选，再用 _cosine 重排"""
+    with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+        _fts_backfill(conn)
+        rows = _fts_candidates(conn, question)
+    q = question.strip()
+    q_vec = Counter(_char_bigrams(question))
+    heap: List[Tuple[float, int, Dict]] = []
+    for r in rows:
+        item = {
+            "id": r["id"],
+            "question": r["question"] or "",
+            "answer": r["answer"] or "",
+            "created_at": r["created_at"],
+            "updated_at": r["updated_at"],
+        }
+        # 优先使用持久化的双字组特征，缺失时现场分词
+        vec = (parse_features(r["features"]) if r["features"] else None) or Counter(_char_bigrams(item["question"]))
+        score = _cosine(q_vec, vec) + _match_bonus(q, item["question"])
+        if score <= 0.0 or score < min_score:
+            continue
+        entry = (score, item["id"], item)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+    heap.sort(key=lambda t: (t[0], t[1]), reverse=True)
+    return [(item, score) for score, _, item in heap]
+
+
+def retrieve_top_k(question: str, k: int = 5, min_score: float = 0.0) -> List[Tuple[Dict, float]]:
+    """检索得分最高的 k 个知识库条目，按得分降序返回 (条目, 得分) 列表"""
+    try:
+        if k <= 0:
+            return []
+        if _kb_engine() == "fts":
+            try:
+                return _retrieve_top_k_fts(question, k, min_score)
+            except sqlite3.OperationalError as e:
+                logger.warning("FTS 检索不可用，回退到倒排索引: %s", e)
+        index = get_kb_index()
+        if not len(index):
+            return []
+        matrix = _get_kb_matrix()
+        if matrix is not None:
+            return matrix.search_top_k(question, k, min_score)
+        shards = _get_kb_shards(index)
+        if shards is not None:
+            return _retrieve_top_k_sharded(shards, index, [question], k, min_score)[0]
+        return _retrieve_top_k_index(index, question, k, min_score)
     except Exception as e:
         logger.exception("知识库检索错误: %s", e)
+        return []
+
+
+def retrieve_best(question: str) -> Tuple[Optional[Dict], float]:
+    """检索最匹配的知识库条目，返回条目和相似度得分"""
+    top = retrieve_top_k(question, 1)
+    if not top:
         return None, 0.0
+    return top[0]
+
+
+def retrieve_best_batch(questions: List[str]) -> List[Tuple[Optional[Dict], float]]:
+    """批量检索；matrix 引擎下一次矩阵乘法完成全部打分，sharded 引擎一次散发全部问题"""
+    try:
+        if _kb_engine() == "fts":
+            return [retrieve_best(q) for q in questions]
+        index = get_kb_index()
+        if not len(index):
+            return [(None, 0.0) for _ in questions]
+        matrix = _get_kb_matrix()
+        shards = _get_kb_shards(index)
+        if matrix is not None:
+            tops = matrix.search_batch_top_k(questions, 1)
+        elif shards is not None:
+            # 一批问题只散发一次，进程间通信开销按批摊薄
+            tops = _retrieve_top_k_sharded(shards, index, questions, 1, 0.0)
+        else:
+            tops = [_retrieve_top_k_index(index, q, 1, 0.0) for q in questions]
+        return [top[0] if top else (None, 0.0) for top in tops]
+    except Exception as e:
+        logger.exception("知识库批量检索错误: %s", e)
+        return [(None, 0.0) for _ in questions]
 
 
 def _read_env_local_key() -> Optional[str]:
@@ -137,8 +567,18 @@ def _read_env_local_key() -> Optional[str]:
     return None
 
 
-def _generate_with_llm(question: str, kb_answer: str, system: Optional[str]) -> Optional[str]:
-    """调用 DeepSeek API 基于知识库答案生成优化回复，失败返回 None"""
+# 共享长连接池：所有 DeepSeek 调用复用 TCP + TLS 连接
+_HTTP_POOL = HTTPConnectionPool(
+    max_per_host=int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "8")),
+    connect_timeout=float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("DEEPSEEK_READ_TIMEOUT", "15")),
+)
+
+
+def _build_chat_request(
+    question: str, kb_answer: str, system: Optional[str]
+) -> Optional[Tuple[str, Dict, Dict[str, str]]]:
+    """构造 chat/completions 请求，返回 (url, payload, headers)；无密钥返回 None"""
     key = os.getenv("DEEPSEEK_API_KEY") or _read_env_local_key()
     if not key:
         return None
@@ -158,63 +598,627 @@ def _generate_with_llm(question: str, kb_answer: str, system: Optional[str]) ->
         "temperature": 0.2,
         "max_tokens": 1000,
     }
-    url = f"{base}/chat/completions"
-    req = Request(url, data=json.dumps(payload).encode("utf-8"))
-    req.add_header("Content-Type", "application/json")
-    req.add_header("Authorization", f"Bearer {key}")
+    url = f"{base.rstrip('/')}/chat/completions"
+    return url, payload, {"Authorization": f"Bearer {key}"}
+
+
+def _extract_content(data: Dict) -> Optional[str]:
+    """DeepSeek 兼容 OpenAI 格式: choices[0].message.content"""
+    content = (
+        (data.get("choices") or [{}])[0]
+        .get("message", {})
+        .get("content")
+    )
+    if isinstance(content, str) and content.strip():
+        return content.strip()
+    return None
+
+
+# DeepSeek 熔断器：连续失败 / 超时后熔断，熔断期间直接使用知识库答案
+_LLM_BREAKER = CircuitBreaker(
+    "deepseek",
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30")),
+)
+
+
+def _generate_with_llm(
+    question: str, kb_answer: str, system: Optional[str], timeout: Optional[float] = None
+) -> Optional[str]:
+    """调用 DeepSeek API 基于知识库答案生成优化回复，失败或熔断时返回 None
+
+    timeout 为调用方剩余的时间预算；因预算耗尽而超时不计入熔断失败
+    """
+    req = _build_chat_request(question, kb_answer, system)
+    if req is None:
+        return None
+    if not _LLM_BREAKER.allow():
+        logger.debug("DeepSeek 熔断中，跳过调用")
+        return None
+    url, payload, headers = req
     try:
-        with urlopen(req, timeout=15) as resp:
-            data = json.loads(resp.read().decode("utf-8", errors="ignore"))
-            # DeepSeek 兼容 OpenAI 格式: choices[0].message.content
-            content = (
-                data.get("choices", [{}])[0]
-                .get("message", {})
-                .get("content")
-            )
-            if isinstance(content, str) and content.strip():
-                return content.strip()
-    except (HTTPError, URLError, TimeoutError) as e:
+        ans = _extract_content(_HTTP_POOL.post_json(url, payload, headers, timeout=timeout))
+        _LLM_BREAKER.record_success()
+        return ans
+    except BudgetExceeded as e:
+        # 调用方预算不足，不是上游故障
+        _LLM_BREAKER.abandon()
+        logger.debug("DeepSeek 调用超出时间预算: %s", e)
+    except (LLMHTTPError, OSError, http.client.HTTPException) as e:
+        _LLM_BREAKER.record_failure()
         logger.warning("DeepSeek API 调用失败: %s", e)
     except Exception as e:
+        _LLM_BREAKER.record_failure()
         logger.exception("DeepSeek API 异常: %s", e)
     return None
 
 
-def answer_question(question: str, system: Optional[str] = None) -> Dict:
-    """核心接口：根据问题返回答案和元数据
-    
-    返回字典包含: answer, matched_id, matched_question, score
+# asyncio 版连接池：供 answer_question_async 在单个 worker 上并发大量请求
+_ASYNC_HTTP_POOL = AsyncHTTPConnectionPool(
+    max_per_host=int(os.getenv("DEEPSEEK_MAX_ASYNC_CONNECTIONS", "32")),
+    connect_timeout=float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("DEEPSEEK_READ_TIMEOUT", "15")),
+)
+
+
+# 异步调用可能出现的网络 / 协议异常
+_ASYNC_LLM_ERRORS = (
+    LLMHTTPError,
+    OSError,
+    asyncio.TimeoutError,
+    http.client.HTTPException,
+    asyncio.IncompleteReadError,
+)
+
+
+async def _generate_with_llm_async(question: str, kb_answer: str, system: Optional[str]) -> Optional[str]:
+    """_generate_with_llm 的异步版本，失败或熔断时返回 None"""
+    req = _build_chat_request(question, kb_answer, system)
+    if req is None:
+        return None
+    if not _LLM_BREAKER.allow():
+        logger.debug("DeepSeek 熔断中，跳过调用")
+        return None
+    url, payload, headers = req
+    try:
+        ans = _extract_content(await _ASYNC_HTTP_POOL.post_json(url, payload, headers))
+        _LLM_BREAKER.record_success()
+        return ans
+    except _ASYNC_LLM_ERRORS as e:
+        _LLM_BREAKER.record_failure()
+        logger.warning("DeepSeek API 调用失败: %s", e)
+    except asyncio.CancelledError:
+        _LLM_BREAKER.abandon()
+        raise
+    except Exception as e:
+        _LLM_BREAKER.record_failure()
+        logger.exception("DeepSeek API 异常: %s", e)
+    return None
+
+
+async def _stream_llm_async(question: str, kb_answer: str, system: Optional[str]) -> AsyncIterator[str]:
+    """以 stream=true 调用 chat/completions，逐个产出增量文本；无密钥或熔断时不产出任何内容"""
+    req = _build_chat_request(question, kb_answer, system)
+    if req is None:
+        return
+    if not _LLM_BREAKER.allow():
+        logger.debug("DeepSeek 熔断中，跳过流式调用")
+        return
+    url, payload, headers = req
+    payload = dict(payload, stream=True)
+    hdrs = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+    hdrs.update(headers)
+    body = json.dumps(payload).encode("utf-8")
+    buf = b""
+    finished = False
+    try:
+        async with aclosing(_ASYNC_HTTP_POOL.stream("POST", url, body, hdrs)) as chunks:
+            async for chunk in chunks:
+                buf += chunk
+                while b"\n" in buf:
+                    line, buf = buf.split(b"\n", 1)
+                    line = line.strip()
+                    if finished or not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        # 继续读完剩余字节，连接才能归还连接池复用
+                        finished = True
+                        continue
+                    try:
+                        obj = json.loads(data.decode("utf-8", errors="ignore"))
+                    except ValueError:
+                        continue
+                    delta = ((obj.get("choices") or [{}])[0].get("delta") or {}).get("content")
+                    if isinstance(delta, str) and delta:
+                        yield delta
+    except _ASYNC_LLM_ERRORS:
+        _LLM_BREAKER.record_failure()
+        raise
+    except BaseException:
+        # 消费方提前结束或被取消：不计入成败
+        _LLM_BREAKER.abandon()
+        raise
+    _LLM_BREAKER.record_success()
+
+
+# 大模型回答缓存：相同问题 + 相同知识库答案 + 相同提示词直接复用
+_LLM_CACHE = LLMAnswerCache(
+    DB_PATH,
+    max_entries=int(os.getenv("LLM_CACHE_MAX", "2000")),
+    ttl_seconds=float(os.getenv("LLM_CACHE_TTL", "86400")),
+)
+
+
+# 未命中知识库时的大模型回答缓存：键为标准化问题 + 提示词，TTL 较短；知识库新增或修改条目时整体清空
+_MISS_CACHE = LLMAnswerCache(
+    DB_PATH,
+    max_entries=int(os.getenv("LLM_MISS_CACHE_MAX", "1000")),
+    ttl_seconds=float(os.getenv("LLM_MISS_CACHE_TTL", "3600")),
+    max_db_entries=int(os.getenv("LLM_MISS_CACHE_DB_MAX", "10000")),
+    table="llm_miss_cache",
+)
+
+# 未命中统计：内存聚合后批量写入 kb_misses，供管理端补充知识库
+_KB_MISSES = MissTracker(DB_PATH)
+
+
+def _record_miss(question: str, score: float) -> None:
+    _KB_MISSES.record(question, _normalize_text(question), score)
+
+
+def kb_top_misses(limit: int = 50, offset: int = 0, min_hits: int = 1) -> Tuple[List[Dict], int]:
+    """按次数降序列出未命中知识库的问题，返回 (记录列表, 总数)"""
+    return _KB_MISSES.top(limit, offset, min_hits)
+
+
+def kb_dismiss_miss(miss_id: int) -> bool:
+    """忽略一条未命中记录"""
+    return _KB_MISSES.remove(miss_id)
+
+
+# 单飞合并：相同问题 + 相同知识库条目 + 相同提示词的并发调用共享一次大模型请求
+_LLM_FLIGHTS = SingleFlight()
+
+
+def _flight_key(question: str, kb_id: Optional[int], system: str) -> Tuple[str, Optional[int], str]:
+    return (_normalize_text(question), kb_id, system)
+
+
+# 时间预算不足此秒数时不再发起大模型调用，直接使用知识库答案
+_MIN_LLM_BUDGET = 0.2
+_BUDGET_STATS = {"budget_skips": 0, "deadline_exceeded": 0, "rejected": 0, "expired": 0}
+_BUDGET_LOCK = threading.Lock()
+
+
+def _count_budget(key: str) -> None:
+    with _BUDGET_LOCK:
+        _BUDGET_STATS[key] += 1
+
+
+def _budget_stats() -> Dict[str, int]:
+    with _BUDGET_LOCK:
+        return dict(_BUDGET_STATS)
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    """距离截止时间（time.monotonic() 基准）的剩余秒数；无截止时间返回 None"""
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+# 有时间预算的同步调用的领头请求在此线程池中执行：调用方超时返回后，在途调用继续完成并写入缓存。
+# 执行中 + 排队的领头请求数不超过 线程数 + LLM_QUEUE_MAX，超出时直接使用知识库答案
+_LLM_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=_HTTP_POOL.max_per_host, thread_name_prefix="llm-call"
+)
+_LLM_EXECUTOR_SLOTS = threading.BoundedSemaphore(_HTTP_POOL.max_per_host + int(os.getenv("LLM_QUEUE_MAX", "32")))
+
+
+def _launch_llm(deadline: float) -> Callable[[Callable[[], None], Callable[[], None]], bool]:
+    """返回供 SingleFlight.do_background 使用的 launch：队列满时拒绝，排队期间已过截止时间的请求不再发出"""
+
+    def launch(run: Callable[[], None], abandon: Callable[[], None]) -> bool:
+        if not _LLM_EXECUTOR_SLOTS.acquire(blocking=False):
+            _count_budget("rejected")
+            return False
+
+        def task() -> None:
+            try:
+                if time.monotonic() >= deadline:
+                    _count_budget("expired")
+                    abandon()
+                else:
+                    run()
+            finally:
+                _LLM_EXECUTOR_SLOTS.release()
+
+        _LLM_EXECUTOR.submit(task)
+        return True
+
+    return launch
+
+
+def _coalesce(key: Tuple, fn: Callable[[], Optional[str]], deadline: Optional[float]) -> Optional[str]:
+    """在时间预算内执行（或合并等待）一次大模型调用
+
+    与 _coalesce_async 一致：调用本身不受调用方预算限制（只受连接池超时约束，超时计入熔断），
+    调用方最多等待剩余预算，超时返回 None，结果照常写入缓存供后续请求使用。
+    合并在调用方线程中完成，只有领头请求进入有界线程池；队列已满或排队期间过期时返回 None
     """
-    q = (question or "").strip()
-    if not q:
-        return {
-            "answer": "请输入问题",
+    remaining = _remaining(deadline)
+    if remaining is None:
+        return _LLM_FLIGHTS.do(key, fn)
+    if remaining < _MIN_LLM_BUDGET:
+        _count_budget("budget_skips")
+        return None
+    try:
+        return _LLM_FLIGHTS.do_background(key, fn, _launch_llm(deadline), timeout=remaining)
+    except concurrent.futures.TimeoutError:
+        _count_budget("deadline_exceeded")
+        return None
+    except FlightRejected:
+        return None
+
+
+async def _coalesce_async(
+    key: Tuple, fn: Callable[[], Awaitable[Optional[str]]], deadline: Optional[float]
+) -> Optional[str]:
+    """_coalesce 的异步版本：预算耗尽时立即返回 None，在途调用继续完成并写入缓存，不浪费请求"""
+    remaining = _remaining(deadline)
+    if remaining is not None and remaining < _MIN_LLM_BUDGET:
+        _count_budget("budget_skips")
+        return None
+    task = asyncio.ensure_future(_LLM_FLIGHTS.do_async(key, fn))
+    if remaining is None:
+        return await task
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), remaining)
+    except asyncio.TimeoutError:
+        _count_budget("deadline_exceeded")
+        return None
+
+
+def _generate_cached(
+    question: str,
+    kb_answer: str,
+    system: str,
+    kb_id: Optional[int],
+    deadline: Optional[float] = None,
+    cache: LLMAnswerCache = _LLM_CACHE,
+) -> Optional[str]:
+    """带缓存、合并与时间预算的 _generate_with_llm：仅缓存成功的回答"""
+    key = LLMAnswerCache.make_key(_normalize_text(question), kb_answer, system)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    def call() -> Optional[str]:
+        ans = _generate_with_llm(question, kb_answer, system)
+        if ans:
+            cache.put(key, ans, kb_id, system)
+        return ans
+
+    return _coalesce(_flight_key(question, kb_id, system), call, deadline)
+
+
+async def _generate_cached_async(
+    question: str,
+    kb_answer: str,
+    system: str,
+    kb_id: Optional[int],
+    deadline: Optional[float] = None,
+    cache: LLMAnswerCache = _LLM_CACHE,
+) -> Tuple[Optional[str], bool]:
+    """_generate_cached 的异步版本，返回 (回答, 是否命中缓存)；缓存的 SQLite 读写放到线程中执行"""
+    key = LLMAnswerCache.make_key(_normalize_text(question), kb_answer, system)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return cached, True
+
+    async def call() -> Optional[str]:
+        ans = await _generate_with_llm_async(question, kb_answer, system)
+        if ans:
+            await asyncio.to_thread(cache.put, key, ans, kb_id, system)
+        return ans
+
+    return await _coalesce_async(_flight_key(question, kb_id, system), call, deadline), False
+
+
+def ai_stats() -> Dict[str, Dict]:
+    """问答链路运行统计：回答缓存、连接池等"""
+    return {
+        "llm_cache": _LLM_CACHE.stats(),
+        "llm_miss_cache": _MISS_CACHE.stats(),
+        "kb_misses": _KB_MISSES.stats(),
+        "http_pool": _HTTP_POOL.stats(),
+        "async_http_pool": _ASYNC_HTTP_POOL.stats(),
+        "settings_cache": _SETTINGS_CACHE.stats(),
+        "llm_coalescing": _LLM_FLIGHTS.stats(),
+        "llm_breaker": _LLM_BREAKER.stats(),
+        "llm_budget": _budget_stats(),
+        "answer_tiers": dict(_TIER_STATS),
+        "kb_index": {
+            "size": len(_KB_INDEX),
+            "generation": _KB_INDEX.generation,
+            "pending": _KB_INDEX.pending,
+            "synced_rows": _KB_SYNC_STATE["synced_rows"],
+            "snapshot_writes": _KB_SNAPSHOT_STATE["writes"],
+            "snapshot_failures": _KB_SNAPSHOT_STATE["failures"],
+        },
+        "kb_shards": _KB_SHARDS.stats() if _KB_SHARDS is not None else None,
+    }
+
+
+def warm_up() -> None:
+    """常驻进程启动时调用（如进程内回答的监听脚本）：加载知识库索引并预建大模型连接"""
+    get_kb_index()
+    req = _build_chat_request("", "", None)
+    if req is not None:
+        _HTTP_POOL.warm(req[0])
+
+
+def ai_settings_updated(old_system: Optional[str]) -> None:
+    """/ai_settings 更新后调用：失效设置缓存，以及以旧提示词生成的回答缓存"""
+    _SETTINGS_CACHE.invalidate()
+    if old_system:
+        _LLM_CACHE.invalidate_system(old_system.strip())
+        _MISS_CACHE.invalidate_system(old_system.strip())
+
+
+# 未命中知识库时传给大模型的参考答案占位
+_NO_KB_HINT = "（未命中知识库）"
+# 分层阈值默认值（ai_settings 未配置时使用）：
+# 得分不低于 _KB_DIRECT_SCORE 直接返回知识库答案，不低于 _KB_MIN_SCORE 由大模型润色，否则按未命中处理
+_KB_DIRECT_SCORE = 1.0
+_KB_MIN_SCORE = 0.05
+
+# 回答层级，随结果的 tier 字段返回
+TIER_KB = "kb"  # 高置信：直接返回知识库答案，不调用大模型
+TIER_LLM = "llm"  # 中间段：大模型基于知识库答案润色
+TIER_KB_FALLBACK = "kb_fallback"  # 中间段但大模型不可用（无密钥 / 熔断 / 超时），退回知识库答案
+TIER_NO_KB = "no_kb"  # 低于下限：按未命中处理，由大模型直接回答
+
+_TIER_STATS: Counter = Counter()
+
+
+def _tier_thresholds() -> Tuple[float, float]:
+    """返回 (直接返回阈值, 命中下限)，取自 ai_settings，缺失时使用默认值"""
+    direct, low = _KB_DIRECT_SCORE, _KB_MIN_SCORE
+    try:
+        row = _SETTINGS_CACHE.get() or {}
+        if row.get("kb_direct_score") is not None:
+            direct = float(row["kb_direct_score"])
+        if row.get("kb_min_score") is not None:
+            low = float(row["kb_min_score"])
+    except Exception:
+        pass
+    return direct, low
+
+
+def _classify(item: Optional[Dict], score: float) -> str:
+    """根据检索得分确定回答层级：TIER_KB / TIER_LLM / TIER_NO_KB"""
+    direct, low = _tier_thresholds()
+    if not item or score < low:
+        return TIER_NO_KB
+    if score >= direct:
+        return TIER_KB
+    return TIER_LLM
+
+
+def _empty_result() -> Dict:
+    return {
+        "answer": "请输入问题",
+        "matched_id": None,
+        "matched_question": None,
+        "score": 0.0,
+        "tier": None,
+    }
+
+
+def _build_result(item: Optional[Dict], score: float, llm_ans: Optional[str], tier: str) -> Dict:
+    """根据检索结果、回答层级与大模型回答组装返回字典"""
+    if tier == TIER_NO_KB:
+        result = {
+            "answer": llm_ans or "暂未命中知识库，请补充条目或调整问题",
             "matched_id": None,
             "matched_question": None,
-            "score": 0.0,
+            "score": score,
+            "tier": tier,
         }
-
-    item, score = retrieve_best(q)
-    if item and score >= 0.05:
-        kb_answer = item["answer"]
-        # 尝试用大模型优化答案
-        llm_ans = _generate_with_llm(q, kb_answer, system or _get_default_system_prompt())
-        final_answer = llm_ans if (llm_ans and len(llm_ans) >= 5) else kb_answer
-        return {
-            "answer": final_answer,
+    else:
+        if tier == TIER_LLM and not (llm_ans and len(llm_ans) >= 5):
+            tier = TIER_KB_FALLBACK
+        result = {
+            "answer": llm_ans if tier == TIER_LLM else item["answer"],
             "matched_id": item["id"],
             "matched_question": item["question"],
             "score": score,
+            "tier": tier,
         }
-    # 未命中知识库：让大模型直接回答（仍受系统提示词约束）
-    llm_ans = _generate_with_llm(q, "（未命中知识库）", system or _get_default_system_prompt())
-    return {
-        "answer": llm_ans or "暂未命中知识库，请补充条目或调整问题",
-        "matched_id": None,
-        "matched_question": None,
+    _TIER_STATS[tier] += 1
+    return result
+
+
+def answer_question(question: str, system: Optional[str] = None, deadline: Optional[float] = None) -> Dict:
+    """核心接口：根据问题返回答案和元数据
+    
+    返回字典包含: answer, matched_id, matched_question, score, tier
+    deadline 为 time.monotonic() 基准的截止时间：预算不足或超时时直接返回知识库答案
+    """
+    q = (question or "").strip()
+    if not q:
+        return _empty_result()
+
+    sys_prompt = (system or _get_default_system_prompt()).strip()
+    item, score = retrieve_best(q)
+    tier = _classify(item, score)
+    if tier == TIER_KB:
+        # 高置信命中：直接使用知识库答案
+        llm_ans = None
+    elif tier == TIER_LLM:
+        # 尝试用大模型优化答案
+        llm_ans = _generate_cached(q, item["answer"], sys_prompt, item["id"], deadline)
+    else:
+        # 未命中知识库：记录未命中，让大模型直接回答（仍受系统提示词约束），回答按问题缓存
+        _record_miss(q, score)
+        llm_ans = _generate_cached(q, _NO_KB_HINT, sys_prompt, None, deadline, cache=_MISS_CACHE)
+    return _build_result(item, score, llm_ans, tier)
+
+
+async def _answer_matched_async(
+    q: str, item: Optional[Dict], score: float, sys_prompt: str, deadline: Optional[float] = None
+) -> Tuple[Dict, bool]:
+    """根据已完成的检索结果生成回答，返回 (结果, 是否命中回答缓存)"""
+    tier = _classify(item, score)
+    llm_ans, cached = None, False
+    if tier == TIER_LLM:
+        llm_ans, cached = await _generate_cached_async(q, item["answer"], sys_prompt, item["id"], deadline)
+    elif tier == TIER_NO_KB:
+        await asyncio.to_thread(_record_miss, q, score)
+        llm_ans, cached = await _generate_cached_async(q, _NO_KB_HINT, sys_prompt, None, deadline, cache=_MISS_CACHE)
+    return _build_result(item, score, llm_ans, tier), cached
+
+
+def _prompt_and_match(q: str, system: Optional[str]) -> Tuple[str, Optional[Dict], float]:
+    """读取系统提示词并检索最佳匹配，返回 (提示词, 条目, 得分)
+
+    设置缓存失效后读取提示词会访问 SQLite，异步接口应在线程中调用
+    """
+    sys_prompt = (system or _get_default_system_prompt()).strip()
+    item, score = retrieve_best(q)
+    return sys_prompt, item, score
+
+
+async def answer_question_async(
+    question: str, system: Optional[str] = None, deadline: Optional[float] = None
+) -> Dict:
+    """answer_question 的异步版本，返回结构相同
+
+    - 读取提示词与知识库检索放到线程中执行，不阻塞事件循环
+    - 大模型调用走 asyncio 连接池，等待期间不占用线程
+    - 超过 deadline 时立即返回知识库答案，在途的大模型调用继续完成并写入缓存
+    """
+    q = (question or "").strip()
+    if not q:
+        return _empty_result()
+
+    sys_prompt, item, score = await asyncio.to_thread(_prompt_and_match, q, system)
+    result, _ = await _answer_matched_async(q, item, score, sys_prompt, deadline)
+    return result
+
+
+async def answer_questions_batch(
+    questions: List[str],
+    system: Optional[str] = None,
+    concurrency: int = 8,
+    ordered: bool = True,
+) -> AsyncIterator[Dict]:
+    """批量问答：一次检索完成全部打分，大模型调用以有限并发扇出
+
+    每条结果在 answer_question 字段基础上附加 index、question、
+    cached（命中回答缓存）与 elapsed_ms（该条生成耗时）；
+    ordered 为 True 时按输入顺序产出，否则按完成顺序产出
+    """
+    qs = [(q or "").strip() for q in questions]
+    sys_prompt = (system or await asyncio.to_thread(_get_default_system_prompt)).strip()
+    matches = await asyncio.to_thread(retrieve_best_batch, qs)
+    sem = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(i: int) -> Dict:
+        q = qs[i]
+        async with sem:
+            start = time.perf_counter()
+            if q:
+                item, score = matches[i]
+                result, cached = await _answer_matched_async(q, item, score, sys_prompt)
+            else:
+                result, cached = _empty_result(), False
+            result.update(
+                index=i,
+                question=questions[i],
+                cached=cached,
+                elapsed_ms=round((time.perf_counter() - start) * 1000, 3),
+            )
+            return result
+
+    tasks = [asyncio.create_task(run(i)) for i in range(len(qs))]
+    try:
+        if ordered:
+            for task in tasks:
+                yield await task
+        else:
+            for fut in asyncio.as_completed(tasks):
+                yield await fut
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def answer_question_stream(
+    question: str, system: Optional[str] = None
+) -> AsyncIterator[Tuple[str, Dict]]:
+    """流式问答：依次产出 ("meta", 匹配信息)、若干 ("delta", 增量文本)、("done", 完整结果)
+
+    - 检索完成后立即产出 meta，首字节不必等待大模型
+    - 命中回答缓存（含未命中知识库时的回答缓存）时以单个 delta 输出缓存内容
+    - 高置信命中或大模型不可用时以单个 delta 输出知识库答案（或未命中提示）
+    - 已输出的增量与最终答案不一致时（流中途失败、回答过短而回退到知识库答案），
+      在 done 之前产出 ("replace", {"content": 最终答案})，客户端应以其替换已显示的内容
+    - done 的字段与 answer_question 的返回值一致，answer 即客户端最终显示的文本
+    """
+    q = (question or "").strip()
+    if not q:
+        yield "done", _empty_result()
+        return
+
+    sys_prompt, item, score = await asyncio.to_thread(_prompt_and_match, q, system)
+    tier = _classify(item, score)
+    hit = tier != TIER_NO_KB
+    yield "meta", {
+        "matched_id": item["id"] if hit else None,
+        "matched_question": item["question"] if hit else None,
         "score": score,
+        "tier": tier,
     }
 
+    parts: List[str] = []
+    cached = None
+    llm_ans: Optional[str] = None
+    if tier != TIER_KB:
+        kb_answer = item["answer"] if hit else _NO_KB_HINT
+        cache = _LLM_CACHE if hit else _MISS_CACHE
+        if not hit:
+            await asyncio.to_thread(_record_miss, q, score)
+        cache_key = LLMAnswerCache.make_key(_normalize_text(q), kb_answer, sys_prompt)
+        cached = await asyncio.to_thread(cache.get, cache_key)
+    if cached is not None:
+        llm_ans = cached.strip() or None
+        parts.append(cached)
+        yield "delta", {"content": cached}
+    elif tier != TIER_KB:
+        failed = False
+        try:
+            async for delta in _stream_llm_async(q, kb_answer, sys_prompt):
+                parts.append(delta)
+                yield "delta", {"content": delta}
+        except _ASYNC_LLM_ERRORS as e:
+            failed = True
+            logger.warning("DeepSeek 流式调用失败: %s", e)
+        full = "".join(parts).strip()
+        # 中途失败的部分输出不作为回答
+        if full and not failed:
+            llm_ans = full
+            await asyncio.to_thread(cache.put, cache_key, full, item["id"] if hit else None, sys_prompt)
+
+    result = _build_result(item, score, llm_ans, tier)
+    if not parts:
+        yield "delta", {"content": result["answer"]}
+    elif "".join(parts).strip() != result["answer"]:
+        yield "replace", {"content": result["answer"]}
+    yield "done", result
+
 
 # 可选的 DSPy 封装（用于未来的 LLM 编排）
 try:
@@ -237,16 +1241,24 @@ except Exception:
     # DSPy 未安装，跳过 LLM 编排功能
     KBQASignature = None  # type: ignore
     KBQAModule = None  # type: ignore
+def _load_ai_settings(conn: sqlite3.Connection) -> Optional[Dict]:
+    """读取 ai_settings 最新一行"""
+    row = conn.cursor().execute(
+        "SELECT * FROM ai_settings ORDER BY id DESC LIMIT 1"
+    ).fetchone()
+    return dict(row) if row else None
+
+
+# 进程级设置缓存：/ai_settings 更新时立即失效，其他进程的修改由设置版本号发现
+_SETTINGS_CACHE = SettingsCache(DB_PATH, _load_ai_settings)
+
+
 def _get_default_system_prompt() -> str:
-    """从数据库获取默认系统提示词，失败返回默认值"""
+    """从设置缓存获取默认系统提示词，失败返回默认值"""
     try:
-        with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.cursor().execute(
-                "SELECT system_prompt FROM ai_settings ORDER BY id DESC LIMIT 1"
-            ).fetchone()
-            if row and row["system_prompt"]:
-                return str(row["system_prompt"]).strip()
+        row = _SETTINGS_CACHE.get()
+        if row and row.get("system_prompt"):
+            return str(row["system_prompt"]).strip()
     except Exception:
         pass
     return (
@@ -0,0 +1,115 @@
+"""
+知识库检索吞吐基准：单进程倒排索引 vs 多进程分片检索
+
+用法：
+    python -m backend.bench_retrieval --rows 300000 --queries 2000 --concurrency 16 --workers 4
+
+说明：
+- 在临时目录生成合成知识库（不触碰正式数据库），写出索引快照后分别以
+  KB_ENGINE=index 与 KB_ENGINE=sharded 用线程池并发检索，输出每秒查询数
+- 同时校验两种引擎的 Top-K 结果一致
+- 分片检索的收益取决于 CPU 核数：单核机器上只会体现进程间通信开销
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+# 兼容直接脚本运行：确保可以使用绝对导入 backend.*
+if __name__ == "__main__":
+    ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+# 常用汉字片段，用于生成问题
+_CHARS = (
+    "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所"
+    "民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那"
+    "价格退货发票快递时间客服优惠活动会员积分订单支付地址修改取消物流售后保修尺码颜色库存预约门店营业"
+)
+
+
+def _build_db(path: str, rows: int, seed: int) -> None:
+    from .db import ensure_qa_kb_features, ensure_qa_kb_table
+
+    rnd = random.Random(seed)
+    with closing(sqlite3.connect(path)) as conn:
+        ensure_qa_kb_table(conn)
+        ensure_qa_kb_features(conn)
+        conn.executemany(
+            "INSERT INTO qa_kb(question, answer) VALUES (?, ?)",
+            (
+                ("".join(rnd.choice(_CHARS) for _ in range(rnd.randint(6, 24))), f"答案{i}")
+                for i in range(rows)
+            ),
+        )
+        conn.commit()
+
+
+def _run(retrieve, questions, concurrency: int, k: int) -> float:
+    """并发执行全部检索，返回总耗时（秒）"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda q: retrieve(q, k), questions))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="kb_bench_")
+    db_path = os.path.join(tmpdir, "bench.db")
+    # 必须在导入 ai_qa 之前设置，使其使用临时数据库与快照
+    os.environ["KB_SNAPSHOT_PATH"] = os.path.join(tmpdir, "bench.kbsnap")
+    os.environ["KB_SHARD_WORKERS"] = str(args.workers)
+    os.environ["KB_SHARD_MIN_ROWS"] = "1"
+
+    from . import db
+
+    db.DB_PATH = db_path
+    t0 = time.perf_counter()
+    _build_db(db_path, args.rows, args.seed)
+    print(f"生成 {args.rows} 条知识库: {time.perf_counter() - t0:.1f}s")
+
+    from . import ai_qa
+
+    t0 = time.perf_counter()
+    ai_qa.get_kb_index()
+    ai_qa.wait_kb_snapshot()
+    print(f"构建索引与快照: {time.perf_counter() - t0:.1f}s")
+
+    rnd = random.Random(args.seed + 1)
+    questions = ["".join(rnd.choice(_CHARS) for _ in range(rnd.randint(4, 16))) for _ in range(args.queries)]
+
+    results = {}
+    for engine in ("index", "sharded"):
+        os.environ["KB_ENGINE"] = engine
+        # 预热：启动进程池并映射快照
+        ai_qa.retrieve_top_k(questions[0], args.k)
+        elapsed = _run(ai_qa.retrieve_top_k, questions, args.concurrency, args.k)
+        results[engine] = [[(item["id"], score) for item, score in ai_qa.retrieve_top_k(q, args.k)] for q in questions[:200]]
+        print(
+            f"{engine:8s} {args.queries / elapsed:9.1f} 次/秒  总耗时 {elapsed:7.2f}s"
+            f"（{args.queries} 次检索，并发 {args.concurrency}）"
+        )
+    print("结果一致" if results["index"] == results["sharded"] else "结果不一致！")
+    print("分片统计:", ai_qa.ai_stats()["kb_shards"])
+    if ai_qa._KB_SHARDS is not None:
+        ai_qa._KB_SHARDS.shutdown()
+
+
+if __name__ == "__main__":
+    main()
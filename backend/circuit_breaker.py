@@ -0,0 +1,90 @@
+"""
+熔断器
+
+功能：
+- 连续失败（含超时）达到阈值后熔断，熔断期间直接拒绝调用
+- 熔断持续 reset_timeout 秒后进入半开状态，只放行一个探测请求
+- 探测成功则恢复，失败则重新熔断
+
+说明：
+- 线程安全；asyncio 调用者同样适用（方法均不阻塞）
+"""
+
+import logging
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """基于连续失败计数的熔断器"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        """是否放行本次调用；熔断中返回 False"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._stats["successes"] += 1
+            self._failures = 0
+            if self._state != CLOSED:
+                logger.info("熔断器 %s 恢复", self.name)
+            self._state = CLOSED
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._stats["failures"] += 1
+            self._failures += 1
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+                self._stats["opened"] += 1
+                logger.warning("熔断器 %s 打开：连续失败 %d 次", self.name, self._failures)
+
+    def abandon(self) -> None:
+        """放行的调用被放弃而没有结果（如被取消）时调用，释放半开探测名额"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            data: Dict = dict(self._stats)
+            data["state"] = self._state
+            data["consecutive_failures"] = self._failures
+        return data
@@ -0,0 +1,216 @@
+"""
+监听脚本的对话记忆：按聊天 LRU 常驻，溢出到 chat_history 表
+
+功能：
+- 每个聊天保留最近 max_messages 条消息；常驻聊天数与估算字节数都有上限，超出时按最久未用淘汰
+- 超过 idle_seconds 未活动的聊天过期移出内存
+- 移出内存前把尚未落库的消息写入 chat_history（msg_type 记为 user / assistant，msg_time 为追加时间），
+  该聊天再次来消息时从表中懒加载最近的消息
+- 统计常驻聊天数、估算字节数，以及加载 / 溢出 / 淘汰 / 过期次数
+
+说明：
+- 表结构在 db.ensure_chat_history_table 中创建；friend_id 按好友名称匹配 friends 表，匹配不到（如群聊）记为 0
+- 读写数据库在锁内进行：单个聊天最多读写 max_messages 行，相对 UI 自动化的耗时可以忽略
+- 写库失败只记日志，对应消息从内存中丢弃
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, List
+
+from .db import ensure_chat_history_table
+
+logger = logging.getLogger(__name__)
+
+# 每条消息除文本外的估算开销（字典与字符串对象）
+_ENTRY_OVERHEAD = 200
+
+
+def _entry_bytes(entry: Dict) -> int:
+    return len(entry["content"].encode("utf-8")) + len(entry["sender"].encode("utf-8")) + _ENTRY_OVERHEAD
+
+
+class _Chat:
+    __slots__ = ("messages", "persisted", "nbytes", "last_used")
+
+    def __init__(self, messages: List[Dict], now: float):
+        self.messages = messages
+        self.persisted = len(messages)  # 前 persisted 条已在数据库中
+        self.nbytes = sum(_entry_bytes(m) for m in messages)
+        self.last_used = now
+
+
+class ConversationStore:
+    """LRU + 空闲过期的对话记忆，溢出到 SQLite"""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_chats: int = 200,
+        max_bytes: int = 8 * 1024 * 1024,
+        idle_seconds: float = 1800.0,
+        max_messages: int = 20,
+    ):
+        self.db_path = db_path
+        self.max_chats = max(1, max_chats)
+        self.max_bytes = max(1, max_bytes)
+        self.idle_seconds = idle_seconds
+        self.max_messages = max(1, max_messages)
+        self._lock = threading.Lock()
+        self._chats: "OrderedDict[str, _Chat]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            "loads": 0,
+            "loaded_messages": 0,
+            "spills": 0,
+            "spilled_messages": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+        try:
+            with closing(self._connect()) as conn:
+                ensure_chat_history_table(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("初始化聊天记录表失败: %s", e)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def ensure(self, chat_name: str) -> bool:
+        """使聊天常驻内存（必要时从数据库加载），返回是否为从未出现过的新聊天"""
+        with self._lock:
+            chat, created = self._resident(chat_name)
+            self._shrink(time.monotonic())
+            return created and not chat.messages
+
+    def append(self, chat_name: str, role: str, content: str, sender: str) -> int:
+        """追加一条消息（记录追加时间，落库时作为 msg_time），返回该聊天当前保留的消息数"""
+        entry = {
+            "role": role,
+            "content": content or "",
+            "sender": sender or "",
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with self._lock:
+            chat, _ = self._resident(chat_name)
+            chat.messages.append(entry)
+            size = _entry_bytes(entry)
+            chat.nbytes += size
+            self._bytes += size
+            # 保持对话历史在合理长度
+            overflow = len(chat.messages) - self.max_messages
+            if overflow > 0:
+                dropped = sum(_entry_bytes(m) for m in chat.messages[:overflow])
+                del chat.messages[:overflow]
+                chat.nbytes -= dropped
+                self._bytes -= dropped
+                chat.persisted = max(0, chat.persisted - overflow)
+            n = len(chat.messages)
+            self._shrink(time.monotonic())
+            return n
+
+    def get(self, chat_name: str) -> List[Dict]:
+        """返回聊天最近的消息（副本）"""
+        with self._lock:
+            chat, _ = self._resident(chat_name)
+            messages = list(chat.messages)
+            self._shrink(time.monotonic())
+            return messages
+
+    def flush(self) -> int:
+        """把所有常驻聊天尚未落库的消息写入数据库（聊天仍保留在内存中），返回写入条数"""
+        with self._lock:
+            return sum(self._spill(name, chat) for name, chat in self._chats.items())
+
+    def resident(self) -> Dict[str, int]:
+        """常驻聊天及各自的消息数"""
+        with self._lock:
+            return {name: len(chat.messages) for name, chat in self._chats.items()}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._shrink(time.monotonic())
+            data = dict(self._stats)
+            data["resident_chats"] = len(self._chats)
+            data["resident_messages"] = sum(len(c.messages) for c in self._chats.values())
+            data["resident_bytes"] = self._bytes
+        return data
+
+    # ----- 内部方法（调用方需持有锁） -----
+
+    def _resident(self, chat_name: str):
+        """返回 (常驻的聊天, 是否刚加载或新建)，并标记为最近使用"""
+        now = time.monotonic()
+        chat = self._chats.get(chat_name)
+        if chat is not None:
+            chat.last_used = now
+            self._chats.move_to_end(chat_name)
+            return chat, False
+        chat = _Chat(self._load(chat_name), now)
+        self._chats[chat_name] = chat
+        self._bytes += chat.nbytes
+        return chat, True
+
+    def _load(self, chat_name: str) -> List[Dict]:
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    """
+                    SELECT msg_type, content, sender, msg_time FROM chat_history
+                    WHERE friend_name=? AND msg_type IN ('user', 'assistant')
+                    ORDER BY id DESC LIMIT ?
+                    """,
+                    (chat_name, self.max_messages),
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("加载对话历史失败: %s", e)
+            return []
+        if rows:
+            self._stats["loads"] += 1
+            self._stats["loaded_messages"] += len(rows)
+        return [{"role": r[0], "content": r[1], "sender": r[2], "time": r[3]} for r in reversed(rows)]
+
+    def _spill(self, chat_name: str, chat: _Chat) -> int:
+        """写入尚未落库的消息，返回写入条数"""
+        pending = chat.messages[chat.persisted:]
+        if not pending:
+            return 0
+        try:
+            with closing(self._connect()) as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO chat_history (friend_id, friend_name, sender, content, msg_type, msg_time)
+                    VALUES (COALESCE((SELECT id FROM friends WHERE name=? LIMIT 1), 0), ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (chat_name, chat_name, m["sender"], m["content"], m["role"], m["time"])
+                        for m in pending
+                    ],
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("对话历史写入数据库失败: %s", e)
+            return 0
+        chat.persisted = len(chat.messages)
+        self._stats["spills"] += 1
+        self._stats["spilled_messages"] += len(pending)
+        return len(pending)
+
+    def _shrink(self, now: float) -> None:
+        """过期空闲聊天，并在超出聊天数或字节上限时淘汰最久未用的聊天（至少保留最近的一个）"""
+        while self._chats:
+            name, chat = next(iter(self._chats.items()))
+            if now - chat.last_used >= self.idle_seconds:
+                self._stats["expirations"] += 1
+            elif len(self._chats) > 1 and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+                self._stats["evictions"] += 1
+            else:
+                break
+            self._spill(name, chat)
+            del self._chats[name]
+            self._bytes -= chat.nbytes
@@ -87,16 +87,190 @@ def ensure_qa_kb_table(conn: sqlite3.Connection):
     """)
 
 
+def ensure_qa_kb_features(conn: sqlite3.Connection):
+    # 知识库检索特征：每行持久化标准化问题与双字组特征（由 ai_qa 写入，问题修改时触发器清空待重算）
+    # gen 为该行最近一次变更时的知识库代数，qa_kb_meta.generation 每次增删改递增，
+    # 删除记录在 qa_kb_tombstones；各进程据此只同步代数之后变更的行
+    cols = {row[1] for row in _exec(conn, "PRAGMA table_info('qa_kb')").fetchall()}
+    if 'question_norm' not in cols:
+        _exec(conn, "ALTER TABLE qa_kb ADD COLUMN question_norm TEXT")
+    if 'features' not in cols:
+        _exec(conn, "ALTER TABLE qa_kb ADD COLUMN features TEXT")
+    if 'gen' not in cols:
+        _exec(conn, "ALTER TABLE qa_kb ADD COLUMN gen INTEGER NOT NULL DEFAULT 0")
+    _exec(conn, """
+    CREATE TABLE IF NOT EXISTS qa_kb_meta (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+    _exec(conn, "INSERT OR IGNORE INTO qa_kb_meta(name, value) VALUES ('generation', 0)")
+    _exec(conn, """
+    CREATE TABLE IF NOT EXISTS qa_kb_tombstones (
+        id INTEGER PRIMARY KEY,
+        gen INTEGER NOT NULL
+    )
+    """)
+    _exec(conn, "CREATE INDEX IF NOT EXISTS idx_qa_kb_gen ON qa_kb(gen)")
+    # 批量导入按标准化问题去重
+    _exec(conn, "CREATE INDEX IF NOT EXISTS idx_qa_kb_question_norm ON qa_kb(question_norm)")
+    # 插入时已带代数的行（批量导入整批共用一个代数）不再逐行递增；旧版触发器无此条件，重建
+    row = _exec(conn, "SELECT sql FROM sqlite_master WHERE type='trigger' AND name='qa_kb_gen_ai'").fetchone()
+    if row and 'WHEN' not in row[0]:
+        _exec(conn, "DROP TRIGGER qa_kb_gen_ai")
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_gen_ai AFTER INSERT ON qa_kb WHEN new.gen = 0 BEGIN
+        UPDATE qa_kb_meta SET value = value + 1 WHERE name = 'generation';
+        UPDATE qa_kb SET gen = (SELECT value FROM qa_kb_meta WHERE name = 'generation') WHERE id = new.id;
+    END
+    """)
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_gen_au AFTER UPDATE OF question, answer ON qa_kb BEGIN
+        UPDATE qa_kb_meta SET value = value + 1 WHERE name = 'generation';
+        UPDATE qa_kb SET
+            gen = (SELECT value FROM qa_kb_meta WHERE name = 'generation'),
+            question_norm = CASE WHEN new.question IS old.question THEN question_norm END,
+            features = CASE WHEN new.question IS old.question THEN features END
+        WHERE id = new.id;
+    END
+    """)
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_gen_ad AFTER DELETE ON qa_kb BEGIN
+        UPDATE qa_kb_meta SET value = value + 1 WHERE name = 'generation';
+        INSERT OR REPLACE INTO qa_kb_tombstones(id, gen)
+            VALUES (old.id, (SELECT value FROM qa_kb_meta WHERE name = 'generation'));
+    END
+    """)
+
+
+def ensure_qa_kb_lsh(conn: sqlite3.Connection):
+    # 近似重复检测：qa_kb.minhash 为问题的 MinHash 签名（由 ai_qa 写入），
+    # qa_kb_lsh 为 LSH 分带桶表（key 高位为带号）；删除或修改问题时触发器清理旧桶并清空签名待重算
+    cols = {row[1] for row in _exec(conn, "PRAGMA table_info('qa_kb')").fetchall()}
+    if 'minhash' not in cols:
+        _exec(conn, "ALTER TABLE qa_kb ADD COLUMN minhash BLOB")
+    _exec(conn, """
+    CREATE TABLE IF NOT EXISTS qa_kb_lsh (
+        key INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        PRIMARY KEY (key, id)
+    ) WITHOUT ROWID
+    """)
+    _exec(conn, "CREATE INDEX IF NOT EXISTS idx_qa_kb_lsh_id ON qa_kb_lsh(id)")
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_lsh_ad AFTER DELETE ON qa_kb BEGIN
+        DELETE FROM qa_kb_lsh WHERE id = old.id;
+    END
+    """)
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_lsh_au AFTER UPDATE OF question ON qa_kb
+    WHEN new.question IS NOT old.question BEGIN
+        DELETE FROM qa_kb_lsh WHERE id = old.id;
+        UPDATE qa_kb SET minhash = NULL WHERE id = new.id;
+    END
+    """)
+
+
+def begin_qa_kb_bulk(conn: sqlite3.Connection) -> int:
+    # 批量写入开始（需在事务内调用）：整批行共用一个新代数，返回该代数
+    # 插入时写入 gen 列即跳过逐行的代数触发器；全文索引触发器照常逐行写入
+    _exec(conn, "UPDATE qa_kb_meta SET value = value + 1 WHERE name = 'generation'")
+    return _exec(conn, "SELECT value FROM qa_kb_meta WHERE name = 'generation'").fetchone()[0]
+
+
+def _fts_bigrams(col: str) -> str:
+    # 由持久化特征（双字组 JSON）生成全文索引文本：双字组以空格分隔，与检索端的标准化、分词完全一致
+    return f"(SELECT group_concat(key, ' ') FROM json_each(CASE WHEN json_valid({col}) THEN {col} END))"
+
+
+def ensure_qa_kb_fts(conn: sqlite3.Connection):
+    # 知识库全文索引：FTS5 表保存每行标准化问题的双字组（取自 qa_kb.features），
+    # ascii 分词按空格切分、非 ASCII 字符整体保留，检索端以同样的双字组 MATCH
+    # 由触发器随特征写入 / 清空保持同步；特征缺失的行在补写后入索引；首次创建时对已有数据回填
+    cols = [row[1] for row in _exec(conn, "PRAGMA table_info('qa_kb_fts')").fetchall()]
+    if cols and cols != ['bigrams']:
+        # 旧版索引（trigram 分词原始问题）：删除后按新格式重建
+        for name in ('qa_kb_fts_ai', 'qa_kb_fts_ad', 'qa_kb_fts_au'):
+            _exec(conn, f"DROP TRIGGER IF EXISTS {name}")
+        _exec(conn, "DROP TABLE qa_kb_fts")
+        cols = []
+    if not cols:
+        try:
+            _exec(conn, """
+            CREATE VIRTUAL TABLE qa_kb_fts USING fts5(
+                bigrams,
+                tokenize="ascii tokenchars '_'"
+            )
+            """)
+        except sqlite3.OperationalError as e:
+            # SQLite 未编译 FTS5，跳过，检索自动回退
+            logging.warning(f"创建知识库全文索引失败，已跳过: {e}")
+            return
+    _exec(conn, f"""
+    CREATE TRIGGER IF NOT EXISTS qa_kb_fts_ai AFTER INSERT ON qa_kb BEGIN
+        INSERT INTO qa_kb_fts(rowid, bigrams)
+        SELECT new.id, b FROM (SELECT {_fts_bigrams('new.features')} AS b) WHERE b IS NOT NULL;
+    END
+    """)
+    _exec(conn, """
+    CREATE TRIGGER IF NOT EXISTS qa_kb_fts_ad AFTER DELETE ON qa_kb BEGIN
+        DELETE FROM qa_kb_fts WHERE rowid = old.id;
+    END
+    """)
+    _exec(conn, f"""
+    CREATE TRIGGER IF NOT EXISTS qa_kb_fts_au AFTER UPDATE OF features ON qa_kb BEGIN
+        DELETE FROM qa_kb_fts WHERE rowid = old.id;
+        INSERT INTO qa_kb_fts(rowid, bigrams)
+        SELECT new.id, b FROM (SELECT {_fts_bigrams('new.features')} AS b) WHERE b IS NOT NULL;
+    END
+    """)
+    if not cols:
+        rebuild_qa_kb_fts(conn)
+
+
+def rebuild_qa_kb_fts(conn: sqlite3.Connection):
+    # 回填/重建全文索引：用于已有数据库首次启用或索引损坏后修复
+    _exec(conn, "DELETE FROM qa_kb_fts")
+    _exec(conn, f"""
+    INSERT INTO qa_kb_fts(rowid, bigrams)
+    SELECT id, b FROM (SELECT id, {_fts_bigrams('features')} AS b FROM qa_kb) WHERE b IS NOT NULL
+    """)
+
+
 def ensure_ai_settings_table(conn: sqlite3.Connection):
     # 系统提示词设置表：仅需一条记录，保存当前 system 提示词
     _exec(conn, """
     CREATE TABLE IF NOT EXISTS ai_settings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         system_prompt TEXT NOT NULL,
+        kb_direct_score REAL NOT NULL DEFAULT 1.0,
+        kb_min_score REAL NOT NULL DEFAULT 0.05,
         created_at DATETIME DEFAULT (DATETIME('now','localtime')),
         updated_at DATETIME DEFAULT (DATETIME('now','localtime'))
     )
     """)
+    # 兼容已存在的表：补齐分层阈值列
+    # kb_direct_score：得分不低于此值直接返回知识库答案；kb_min_score：低于此值按未命中处理
+    cols = {row[1] for row in _exec(conn, "PRAGMA table_info('ai_settings')").fetchall()}
+    if 'kb_direct_score' not in cols:
+        _exec(conn, "ALTER TABLE ai_settings ADD COLUMN kb_direct_score REAL NOT NULL DEFAULT 1.0")
+    if 'kb_min_score' not in cols:
+        _exec(conn, "ALTER TABLE ai_settings ADD COLUMN kb_min_score REAL NOT NULL DEFAULT 0.05")
+    # 设置版本号：ai_settings 每次增删改由触发器递增，各进程的设置缓存只比较此值，
+    # 不受其他表写入的影响
+    _exec(conn, """
+    CREATE TABLE IF NOT EXISTS ai_settings_meta (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    """)
+    _exec(conn, "INSERT OR IGNORE INTO ai_settings_meta(name, value) VALUES ('version', 0)")
+    for event, name in (("INSERT", "ai"), ("UPDATE", "au"), ("DELETE", "ad")):
+        _exec(conn, f"""
+        CREATE TRIGGER IF NOT EXISTS ai_settings_version_{name} AFTER {event} ON ai_settings BEGIN
+            UPDATE ai_settings_meta SET value = value + 1 WHERE name = 'version';
+        END
+        """)
     # 确保至少有一条默认记录
     cur = _exec(conn, "SELECT COUNT(*) AS c FROM ai_settings")
     cnt = cur.fetchone()[0]
@@ -109,6 +283,40 @@ def ensure_ai_settings_table(conn: sqlite3.Connection):
         _exec(conn, "INSERT INTO ai_settings(system_prompt) VALUES (?)", (default_prompt,))
 
 
+def ensure_llm_answer_cache_table(conn: sqlite3.Connection):
+    # 大模型回答缓存：key 为问题/知识库答案/提示词的摘要，expires_at 为 Unix 时间戳
+    # llm_miss_cache 结构相同，缓存未命中知识库时的大模型回答
+    for table in ("llm_answer_cache", "llm_miss_cache"):
+        _exec(conn, f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            answer TEXT NOT NULL,
+            kb_id INTEGER,
+            system_hash TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at DATETIME DEFAULT (DATETIME('now','localtime'))
+        )
+        """)
+        _exec(conn, f"CREATE INDEX IF NOT EXISTS idx_{table}_kb ON {table}(kb_id)")
+        _exec(conn, f"CREATE INDEX IF NOT EXISTS idx_{table}_sys ON {table}(system_hash)")
+
+
+def ensure_kb_misses_table(conn: sqlite3.Connection):
+    # 知识库未命中统计：按标准化问题计数，供管理端挑选高频问题补充知识库
+    _exec(conn, """
+    CREATE TABLE IF NOT EXISTS kb_misses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        question_norm TEXT NOT NULL UNIQUE,
+        question TEXT NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+        best_score REAL NOT NULL DEFAULT 0,
+        first_seen DATETIME DEFAULT (DATETIME('now','localtime')),
+        last_seen DATETIME DEFAULT (DATETIME('now','localtime'))
+    )
+    """)
+    _exec(conn, "CREATE INDEX IF NOT EXISTS idx_kb_misses_hits ON kb_misses(hits DESC)")
+
+
 def ensure_chat_history_table(conn: sqlite3.Connection):
     # 聊天记录表：存储好友聊天历史
     _exec(conn, """
@@ -124,6 +332,8 @@ def ensure_chat_history_table(conn: sqlite3.Connection):
         FOREIGN KEY (friend_id) REFERENCES friends(id)
     )
     """)
+    # 监听脚本按聊天名称懒加载最近的对话
+    _exec(conn, "CREATE INDEX IF NOT EXISTS idx_chat_history_friend_name ON chat_history(friend_name, id)")
 
 
 def ensure_all_tables():
@@ -137,7 +347,12 @@ def ensure_all_tables():
             ensure_send_history_table(conn)
             ensure_scheduled_jobs_table(conn)
             ensure_qa_kb_table(conn)
+            ensure_qa_kb_features(conn)
+            ensure_qa_kb_lsh(conn)
+            ensure_qa_kb_fts(conn)
             ensure_ai_settings_table(conn)
+            ensure_llm_answer_cache_table(conn)
+            ensure_kb_misses_table(conn)
             ensure_chat_history_table(conn)
             conn.commit()
     except Exception as e:
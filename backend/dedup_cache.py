@@ -0,0 +1,105 @@
+"""
+消息去重缓存：定长摘要 + 按插入顺序过期
+
+功能：
+- 键由若干字符串片段组成，经 blake2b 压缩为 16 字节摘要，内存占用与消息长度无关
+- 同一实例的条目 TTL 相同，过期时间随插入顺序单调递增：用 deque 记录插入顺序，
+  每次访问只从队首弹出已过期的条目，摊还 O(1)，不再整表重建
+- 条目数超过 max_entries 时淘汰最早的条目，内存有上界
+- 统计命中 / 新增 / 过期 / 淘汰次数
+
+说明：
+- 命中不刷新过期时间：TTL 表示“首次出现后多长时间内视为重复”
+- 线程安全；监听脚本的消息过滤与 /api/get-chat-history 入库共用此实现
+"""
+
+import hashlib
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
+
+
+class TTLDedupCache:
+    """有界、按插入顺序过期的去重集合"""
+
+    def __init__(self, ttl_seconds: float, max_entries: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.max_entries = max(1, int(max_entries))
+        self._clock = clock
+        self._lock = threading.Lock()
+        # 摘要 -> 过期时间；deque 按插入顺序保存 (过期时间, 摘要)
+        self._expires: Dict[bytes, float] = {}
+        self._order: Deque[Tuple[float, bytes]] = deque()
+        self._stats = {"hits": 0, "added": 0, "expirations": 0, "evictions": 0}
+
+    @staticmethod
+    def digest(*parts: object) -> bytes:
+        """把键片段压缩为 16 字节摘要（各片段带长度前缀，避免拼接歧义）"""
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            data = str(part).encode("utf-8", "surrogatepass")
+            h.update(len(data).to_bytes(4, "little"))
+            h.update(data)
+        return h.digest()
+
+    def seen(self, *parts: object) -> bool:
+        """TTL 内已出现过返回 True（命中）；否则记录本次并返回 False"""
+        key = self.digest(*parts)
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if key in self._expires:
+                self._stats["hits"] += 1
+                return True
+            self._insert(key, now)
+            return False
+
+    def contains(self, *parts: object) -> bool:
+        """只查询不记录；命中计入统计"""
+        key = self.digest(*parts)
+        with self._lock:
+            self._expire(self._clock())
+            if key in self._expires:
+                self._stats["hits"] += 1
+                return True
+            return False
+
+    def add(self, *parts: object) -> None:
+        """记录一个键（已存在时保持原过期时间）"""
+        key = self.digest(*parts)
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if key not in self._expires:
+                self._insert(key, now)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._expires)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._expire(self._clock())
+            data = dict(self._stats)
+            data["size"] = len(self._expires)
+        return data
+
+    # ----- 内部方法（调用方需持有锁） -----
+
+    def _insert(self, key: bytes, now: float) -> None:
+        expires_at = now + self.ttl_seconds
+        self._expires[key] = expires_at
+        self._order.append((expires_at, key))
+        self._stats["added"] += 1
+        while len(self._order) > self.max_entries:
+            _, old = self._order.popleft()
+            del self._expires[old]
+            self._stats["evictions"] += 1
+
+    def _expire(self, now: float) -> None:
+        order = self._order
+        while order and order[0][0] <= now:
+            _, key = order.popleft()
+            del self._expires[key]
+            self._stats["expirations"] += 1
@@ -0,0 +1,195 @@
+"""
+知识库近似重复检测（MinHash + LSH）
+
+功能：
+- 以与检索相同的双字组为 shingle，为每条问题计算 MinHash 签名（qa_kb.minhash）
+- 签名按 LSH 分带（BANDS 带 x ROWS 行）散列到桶，桶表 qa_kb_lsh 持久化在 SQLite 中
+- 新增 / 修改条目时只需查询固定数量的桶，即可找出可能重复的条目
+- 全库聚类只需对同桶条目做校验，无需两两比较
+
+说明：
+- 每个 shingle 的哈希值由 blake2b 派生，跨进程、跨 Python 版本稳定；签名分量为 16 位
+- 候选最终以双字组集合的 Jaccard 相似度确认
+- 表结构与触发器在 db.ensure_qa_kb_lsh 中创建：删除或修改问题时触发器清理旧桶
+"""
+
+import hashlib
+import logging
+import sqlite3
+import struct
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from .kb_index import parse_features
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+# 默认的重复判定阈值（双字组集合 Jaccard）
+DEFAULT_THRESHOLD = 0.8
+# 单次查询最多校验的候选数（按命中的带数优先）
+_MAX_CANDIDATES = 200
+# 签名每个分量取 16 位：一次 64 字节的 blake2b 即得到全部 NUM_PERM 个哈希值
+_SIG = struct.Struct(f"<{NUM_PERM}H")
+_KEY_MASK = (1 << 56) - 1
+
+
+_HASHER = hashlib.blake2b(digest_size=64, person=b"kb-minhash")
+
+
+def minhash(shingles: Iterable[str]) -> Optional[Tuple[int, ...]]:
+    """计算 MinHash 签名；没有 shingle 时返回 None"""
+    hashes = []
+    for s in set(shingles):
+        h = _HASHER.copy()
+        h.update(s.encode("utf-8"))
+        hashes.append(_SIG.unpack(h.digest()))
+    if not hashes:
+        return None
+    if len(hashes) == 1:
+        return hashes[0]
+    return tuple(map(min, zip(*hashes)))
+
+
+def band_keys(sig: Sequence[int]) -> List[int]:
+    """签名的 LSH 桶键：高位为带号，低 56 位为该带 ROWS 个分量（共 64 位）的折叠"""
+    raw = _SIG.pack(*sig)
+    width = ROWS * 2
+    keys = []
+    for b in range(BANDS):
+        v = int.from_bytes(raw[b * width : (b + 1) * width], "little")
+        keys.append((b << 56) | ((v ^ (v >> 56)) & _KEY_MASK))
+    return keys
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    inter = len(a & b)
+    return inter / (len(a) + len(b) - inter)
+
+
+class KBDedup:
+    """基于 qa_kb_lsh 桶表的近似重复检测"""
+
+    def __init__(self, tokenize: Callable[[str], List[str]]):
+        self._tokenize = tokenize
+
+    def index_rows(self, conn: sqlite3.Connection, rows: Iterable[Tuple[int, str]]) -> int:
+        """为 (id, 问题) 计算签名并写入桶表（不提交），返回处理条数"""
+        sigs = []
+        buckets = []
+        ids = []
+        for item_id, question in rows:
+            sig = minhash(self._tokenize(question or ""))
+            ids.append((item_id,))
+            sigs.append((_SIG.pack(*sig) if sig else b"", item_id))
+            if sig:
+                buckets.extend((key, item_id) for key in band_keys(sig))
+        if not ids:
+            return 0
+        conn.executemany("DELETE FROM qa_kb_lsh WHERE id=?", ids)
+        conn.executemany("UPDATE qa_kb SET minhash=? WHERE id=?", sigs)
+        conn.executemany("INSERT OR IGNORE INTO qa_kb_lsh(key, id) VALUES (?, ?)", buckets)
+        return len(ids)
+
+    def backfill(self, conn: sqlite3.Connection) -> int:
+        """为尚无签名的行（新写入、问题被修改或旧数据）补算签名（不提交）"""
+        rows = conn.execute("SELECT id, question FROM qa_kb WHERE minhash IS NULL").fetchall()
+        n = self.index_rows(conn, rows)
+        if n:
+            logger.info("已补算知识库 MinHash 签名: %d 条", n)
+        return n
+
+    def find_similar(
+        self,
+        conn: sqlite3.Connection,
+        question: str,
+        threshold: float = DEFAULT_THRESHOLD,
+        exclude_id: Optional[int] = None,
+        limit: int = 5,
+    ) -> List[Dict]:
+        """查找与问题近似重复的条目：只查询 BANDS 个桶，按 Jaccard 降序返回
+
+        候选按与问题同桶的带数降序截取：同桶带数越多，签名越接近，越可能是重复
+        """
+        shingles = set(self._tokenize(question or ""))
+        sig = minhash(shingles)
+        if sig is None:
+            return []
+        keys = band_keys(sig)
+        rows = conn.execute(
+            f"""
+            SELECT q.id, q.question, q.features FROM qa_kb_lsh l JOIN qa_kb q ON q.id = l.id
+            WHERE l.key IN ({','.join('?' * len(keys))}) AND l.id != ?
+            GROUP BY l.id ORDER BY COUNT(*) DESC, l.id DESC LIMIT ?
+            """,
+            (*keys, -1 if exclude_id is None else exclude_id, _MAX_CANDIDATES),
+        ).fetchall()
+        found = []
+        for item_id, item_q, features in rows:
+            sim = jaccard(shingles, self._shingles(item_q, features))
+            if sim >= threshold:
+                found.append({"id": item_id, "question": item_q, "similarity": round(sim, 4)})
+        found.sort(key=lambda d: (-d["similarity"], -d["id"]))
+        return found[:limit]
+
+    def clusters(self, conn: sqlite3.Connection, threshold: float = DEFAULT_THRESHOLD) -> List[List[int]]:
+        """列出近似重复簇（每簇为按 id 升序的条目 id 列表，按簇大小降序）
+
+        同桶条目两两校验，通过校验的条目对经并查集合并（相似关系可传递）；
+        已在同一簇中的条目对、以及在其他桶中已校验过的条目对不再重复计算 Jaccard
+        """
+        groups: List[List[int]] = []
+        for (ids,) in conn.execute(
+            "SELECT group_concat(id) FROM qa_kb_lsh GROUP BY key HAVING COUNT(*) > 1"
+        ):
+            groups.append(sorted(int(i) for i in ids.split(",")))
+        if not groups:
+            return []
+        shingles = self._load_shingles(conn, {i for g in groups for i in g})
+        parent: Dict[int, int] = {}
+
+        def find(x: int) -> int:
+            root = x
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while x != root:
+                parent[x], x = root, parent[x]
+            return root
+
+        checked: Set[Tuple[int, int]] = set()
+        for g in groups:
+            for i, a in enumerate(g):
+                for b in g[i + 1 :]:
+                    ra, rb = find(a), find(b)
+                    if ra == rb or (a, b) in checked:
+                        continue
+                    checked.add((a, b))
+                    if jaccard(shingles.get(a, set()), shingles.get(b, set())) >= threshold:
+                        parent[max(ra, rb)] = min(ra, rb)
+        members: Dict[int, List[int]] = {}
+        for x in parent:
+            members.setdefault(find(x), []).append(x)
+        result = [sorted(set(m) | {root}) for root, m in members.items()]
+        result.sort(key=lambda m: (-len(m), m[0]))
+        return result
+
+    def _load_shingles(self, conn: sqlite3.Connection, ids: Set[int]) -> Dict[int, Set[str]]:
+        out: Dict[int, Set[str]] = {}
+        id_list = list(ids)
+        for start in range(0, len(id_list), 500):
+            chunk = id_list[start : start + 500]
+            for item_id, question, features in conn.execute(
+                f"SELECT id, question, features FROM qa_kb WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ):
+                out[item_id] = self._shingles(question, features)
+        return out
+
+    def _shingles(self, question: Optional[str], features: Optional[str]) -> Set[str]:
+        """优先使用持久化的双字组特征"""
+        vec = parse_features(features) if features else None
+        if vec is None:
+            return set(self._tokenize(question or ""))
+        return set(vec)
@@ -0,0 +1,474 @@
+"""
+知识库常驻倒排索引
+
+功能：
+- 以双字组为键维护倒排表（bigram -> {条目id: 词频}）
+- 预先计算每个条目的向量模，检索时只访问与问题共享双字组的候选
+- Top-K 检索使用有界堆与得分上界剪枝
+- 支持单条增、改、删的原地更新，无需整体重建
+- 可以内存映射的快照（kb_snapshot）为底：只从数据库补读快照之后变更的行，
+  变更部分保存在内存增量中，检索时与快照合并
+- 通过 qa_kb_meta 中的知识库代数发现其他进程提交的变更，只同步变更的行
+
+说明：
+- 分词 / 标准化函数由调用方注入（ai_qa._char_bigrams / _normalize_text），避免循环导入
+- 每行的标准化问题与双字组特征持久化在 qa_kb.question_norm / features 中，
+  缺失（新写入或问题被修改）时在读取该行时补写
+- 所有读写都在同一把锁内完成，可在 FastAPI 线程池中安全使用
+"""
+
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from math import sqrt
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .kb_snapshot import KBSnapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# 精确匹配可获得的最大加分（见 ai_qa._match_bonus）
+_MAX_BONUS = 0.2
+# 上界比较的浮点容忍度
+_BOUND_EPS = 1e-12
+
+
+class KBIndex:
+    """qa_kb 的内存倒排索引（可选以内存映射快照为底）"""
+
+    def __init__(self, tokenize: Callable[[str], List[str]], normalize: Optional[Callable[[str], str]] = None):
+        self._tokenize = tokenize
+        self._normalize = normalize or (lambda s: s)
+        self._lock = threading.RLock()
+        self._loaded = False
+        # 每次变更递增，供派生结构（如稀疏矩阵引擎）判断是否需要重建
+        self._version = 0
+        # 已应用的知识库代数（qa_kb_meta.generation）
+        self._generation = -1
+        # 快照底座；快照中已被修改或删除的 id 记入 _masked
+        self._base: Optional[KBSnapshot] = None
+        self._masked: Set[int] = set()
+        # 以下为内存增量（无快照时即全部条目）
+        self._items: Dict[int, Dict] = {}
+        self._vecs: Dict[int, Counter] = {}
+        self._norms: Dict[int, float] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def pending(self) -> int:
+        """不在快照中的变更条数（内存增量 + 快照中被覆盖 / 删除的条目）"""
+        with self._lock:
+            if self._base is None:
+                return len(self._items)
+            return len(self._items) + len(self._masked)
+
+    def __len__(self) -> int:
+        with self._lock:
+            base = self._base.count - len(self._masked) if self._base else 0
+            return len(self._items) + base
+
+    def load(self, conn: sqlite3.Connection, snapshot: Optional[KBSnapshot] = None) -> None:
+        """构建索引（仅在首次使用或显式重建时调用）
+
+        有快照时以快照为底，只读取其后变更的行与删除记录；否则从数据库全量构建
+        """
+        db_gen = _db_generation(conn)
+        if snapshot is not None and snapshot.generation > db_gen:
+            logger.warning("索引快照比数据库新（数据库可能已被替换），忽略快照")
+            snapshot = None
+        since = snapshot.generation if snapshot is not None else -1
+        entries, deleted, gen = self._read_changes(conn, since)
+        with self._lock:
+            self._items.clear()
+            self._vecs.clear()
+            self._norms.clear()
+            self._postings.clear()
+            self._masked.clear()
+            self._base = snapshot
+            self._generation = since
+            self._apply(entries, deleted, gen)
+            self._loaded = True
+            self._version += 1
+        if snapshot is not None:
+            logger.info(
+                "知识库索引已从快照加载: %d 条（快照后变更 %d 条）", len(self), len(entries) + len(deleted)
+            )
+        else:
+            logger.info("知识库索引构建完成: %d 条", len(entries))
+
+    def sync(self, conn: sqlite3.Connection) -> int:
+        """应用已知代数之后提交的变更（含其他进程的写入），返回变更条数"""
+        if not self._loaded:
+            return 0
+        gen = _db_generation(conn)
+        if gen == self._generation:
+            return 0
+        if gen < self._generation:
+            # 代数回退：数据库被替换，全量重建
+            self.load(conn)
+            return len(self)
+        entries, deleted, gen = self._read_changes(conn, self._generation)
+        with self._lock:
+            self._apply(entries, deleted, gen)
+            self._version += 1
+        return len(entries) + len(deleted)
+
+    def advance(self, generation: int) -> bool:
+        """记录本进程已原地应用的单次写入（其提交的代数为 generation），下次同步不再当作外部变更
+
+        仅当它紧接已应用的代数时前移：其间若有其他连接提交的变更，保持不动，由 sync 一并读取；
+        返回是否前移
+        """
+        with self._lock:
+            if self._loaded and generation == self._generation + 1:
+                self._generation = generation
+                return True
+            return False
+
+    def upsert(self, item: Dict, vec: Optional[Counter] = None) -> None:
+        """新增或替换一条条目"""
+        if vec is None:
+            vec = Counter(self._tokenize(item["question"]))
+        with self._lock:
+            self._remove(item["id"])
+            self._add(item, vec)
+            self._mask(item["id"])
+            self._version += 1
+
+    def upsert_from_db(self, conn: sqlite3.Connection, item_id: int) -> None:
+        """按 id 从数据库读取最新行（并补写缺失的特征）后写入索引；行不存在时移除"""
+        conn.row_factory = sqlite3.Row
+        row = conn.cursor().execute(
+            "SELECT id, question, answer, created_at, updated_at, features FROM qa_kb WHERE id=?",
+            (item_id,),
+        ).fetchone()
+        if row is None:
+            if self._loaded:
+                self.remove(item_id)
+            return
+        item, vec = self._entries_from_rows(conn, [row])[0]
+        if self._loaded:
+            self.upsert(item, vec)
+
+    def remove(self, item_id: int) -> None:
+        """删除一条条目（不存在时忽略）"""
+        with self._lock:
+            self._remove(item_id)
+            self._mask(item_id)
+            self._version += 1
+
+    def get(self, item_id: int) -> Optional[Dict]:
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is None and self._base is not None and item_id not in self._masked:
+                row = self._base.row_of(item_id)
+                if row is not None:
+                    item = self._base.item(row)
+            return item
+
+    def base_view(self) -> Tuple[Optional[KBSnapshot], List[int]]:
+        """返回 (快照底座, 快照中被覆盖 / 删除的 id 升序列表)，供分片检索在其他进程中扫描快照"""
+        with self._lock:
+            return self._base, sorted(self._masked)
+
+    def items(self) -> List[Dict]:
+        """返回所有条目的快照（按 id 倒序，与 _load_kb 保持一致）"""
+        return self.snapshot()[1]
+
+    def snapshot(self) -> Tuple[int, List[Dict], List[Counter]]:
+        """返回 (版本号, 条目列表, 双字组向量列表)，条目按 id 倒序"""
+        with self._lock:
+            entries = self._all_entries()
+            entries.sort(key=lambda e: e[0]["id"], reverse=True)
+            return self._version, [e[0] for e in entries], [e[1] for e in entries]
+
+    def save_snapshot(self, path: str) -> bool:
+        """把当前索引写为快照文件，成功后改以新快照为底并释放内存增量
+
+        锁内只复制内存增量与屏蔽集合（与变更条数成正比），解码快照底座的全部行在锁外进行，不阻塞检索
+        """
+        with self._lock:
+            if not self._loaded:
+                return False
+            delta = [(self._items[i], self._vecs[i], self._norms[i]) for i in self._items]
+            base, masked = self._base, set(self._masked)
+            version, gen = self._version, self._generation
+        # 快照底座只读，且只有本方法会替换并关闭它，可在锁外读取
+        entries = delta + self._base_entries(base, masked)
+        if not write_snapshot(path, gen, entries):
+            return False
+        snap = KBSnapshot.open(path)
+        if snap is None or snap.generation != gen:
+            return False
+        with self._lock:
+            # 写快照期间索引有变更时保持现状，下次再重写
+            if self._version == version:
+                old, self._base = self._base, snap
+                self._items.clear()
+                self._vecs.clear()
+                self._norms.clear()
+                self._postings.clear()
+                self._masked.clear()
+                if old is not None:
+                    old.close()
+        logger.info("知识库索引快照已写入: %s（代数 %d，%d 条）", path, gen, len(entries))
+        return True
+
+    def top_k(
+        self,
+        q_vec: Counter,
+        k: int,
+        min_score: float,
+        bonus: Callable[[Dict], float],
+        full_scan: bool = False,
+        include_base: bool = True,
+    ) -> List[Tuple[Dict, float]]:
+        """有界堆 + 得分上界剪枝的 Top-K 检索
+
+        - 按倒排表长度从短到长处理问题双字组；之后才首次出现的候选，
+          其余弦不超过剩余双字组的模 / 问题向量模，低于第 k 名时提前结束
+        - 子串/精确加分要求条目包含问题的全部双字组，因此只有第一个
+          双字组的候选可能加分；full_scan 用于无法构成双字组的极短问题
+        - 同分时 id 较大者优先，与按 id 倒序遍历的旧行为一致
+        - 快照与内存增量的倒排表合并处理，快照中被覆盖 / 删除的条目跳过；
+          include_base 为 False 时只检索内存增量（快照部分由分片进程检索）
+        """
+        if k <= 0:
+            return []
+        q_norm = sqrt(sum(v * v for v in q_vec.values()))
+        heap: List[Tuple[float, int]] = []
+
+        def threshold() -> float:
+            return heap[0][0] if len(heap) >= k else min_score
+
+        def push(cos: float, item_id: int) -> None:
+            if cos <= 0.0 or cos < min_score:
+                return
+            entry = (cos, item_id)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+        def consider(item_id: int, may_bonus: bool) -> None:
+            cos = self._exact_cosine(q_vec, q_norm, item_id)
+            if may_bonus and cos + _MAX_BONUS >= threshold():
+                cos += bonus(self._items[item_id])
+            push(cos, item_id)
+
+        def consider_base(row: int, may_bonus: bool) -> None:
+            item_id = base.id_at(row)
+            if item_id in self._masked:
+                return
+            cos = base.cosine(row, q_tids, q_norm)
+            if may_bonus and cos + _MAX_BONUS >= threshold():
+                cos += bonus({"id": item_id, "question": base.question(row)})
+            push(cos, item_id)
+
+        with self._lock:
+            base = self._base if include_base else None
+            q_tids: Dict[int, int] = {}
+            base_terms: Dict[str, int] = {}
+            if base is not None:
+                for bg, cnt in q_vec.items():
+                    tid = base.term_id(bg)
+                    if tid is not None:
+                        base_terms[bg] = tid
+                        q_tids[tid] = cnt
+
+            def df(bg: str) -> int:
+                n = len(self._postings.get(bg, ()))
+                if bg in base_terms:
+                    n += base.posting_len(base_terms[bg])
+                return n
+
+            if full_scan:
+                for item_id in self._items:
+                    consider(item_id, True)
+                if base is not None:
+                    for row in base.rows():
+                        consider_base(row, True)
+            elif q_norm > 0.0:
+                terms = sorted((bg for bg in q_vec if df(bg)), key=df)
+                # 后缀平方和：terms[j:] 的问题向量分量平方和
+                suffix = [0.0] * (len(terms) + 1)
+                for j in range(len(terms) - 1, -1, -1):
+                    suffix[j] = suffix[j + 1] + q_vec[terms[j]] ** 2
+                seen = set()
+                seen_rows = set()
+                for j, bg in enumerate(terms):
+                    bound = sqrt(suffix[j]) / q_norm + (_MAX_BONUS if j == 0 else 0.0)
+                    if bound + _BOUND_EPS < threshold():
+                        break
+                    for item_id in self._postings.get(bg, ()):
+                        if item_id not in seen:
+                            seen.add(item_id)
+                            consider(item_id, j == 0)
+                    if bg in base_terms:
+                        for row in base.posting(base_terms[bg]):
+                            if row not in seen_rows:
+                                seen_rows.add(row)
+                                consider_base(row, j == 0)
+            return [(self._get_locked(i), score) for score, i in sorted(heap, reverse=True)]
+
+    # ----- 内部方法（调用方需持有锁） -----
+
+    def _get_locked(self, item_id: int) -> Dict:
+        item = self._items.get(item_id)
+        if item is None:
+            item = self._base.item(self._base.row_of(item_id))
+        return item
+
+    def _all_entries(self) -> List[Tuple[Dict, Counter, float]]:
+        """全部条目的 (条目, 向量, 向量模)"""
+        entries = [(self._items[i], self._vecs[i], self._norms[i]) for i in self._items]
+        return entries + self._base_entries(self._base, self._masked)
+
+    @staticmethod
+    def _base_entries(base: Optional[KBSnapshot], masked: Set[int]) -> List[Tuple[Dict, Counter, float]]:
+        """快照底座中未被屏蔽的条目"""
+        if base is None:
+            return []
+        return [
+            (base.item(row), base.vec(row), base.norm(row))
+            for row in base.rows()
+            if base.id_at(row) not in masked
+        ]
+
+    def _mask(self, item_id: int) -> None:
+        if self._base is not None and self._base.row_of(item_id) is not None:
+            self._masked.add(item_id)
+
+    def _apply(self, entries: List[Tuple[Dict, Counter]], deleted: List[int], generation: int) -> None:
+        for item_id in deleted:
+            self._remove(item_id)
+            self._mask(item_id)
+        for item, vec in entries:
+            self._remove(item["id"])
+            self._add(item, vec)
+            self._mask(item["id"])
+        self._generation = max(self._generation, generation)
+
+    def _exact_cosine(self, q_vec: Counter, q_norm: float, item_id: int) -> float:
+        """与 ai_qa._cosine 逐位一致的余弦计算（复用预计算的向量模）"""
+        norm = self._norms.get(item_id)
+        if not norm or q_norm == 0.0:
+            return 0.0
+        vec = self._vecs[item_id]
+        dot = 0.0
+        for k, v in q_vec.items():
+            if k in vec:
+                dot += v * vec[k]
+        return dot / (q_norm * norm)
+
+    def _add(self, item: Dict, vec: Counter) -> None:
+        item_id = item["id"]
+        self._items[item_id] = item
+        self._vecs[item_id] = vec
+        self._norms[item_id] = sqrt(sum(v * v for v in vec.values()))
+        for bg, cnt in vec.items():
+            self._postings.setdefault(bg, {})[item_id] = cnt
+
+    def _remove(self, item_id: int) -> None:
+        vec = self._vecs.pop(item_id, None)
+        self._items.pop(item_id, None)
+        self._norms.pop(item_id, None)
+        if not vec:
+            return
+        for bg in vec:
+            posting = self._postings.get(bg)
+            if posting is None:
+                continue
+            posting.pop(item_id, None)
+            if not posting:
+                del self._postings[bg]
+
+    # ----- 数据库读取（无需持有锁） -----
+
+    def _read_changes(
+        self, conn: sqlite3.Connection, since: int
+    ) -> Tuple[List[Tuple[Dict, Counter]], List[int], int]:
+        """在同一读事务内读取代数大于 since 的行与删除记录，返回 (条目与向量, 删除的 id, 当前代数)"""
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        own_tx = not conn.in_transaction
+        if own_tx:
+            cur.execute("BEGIN")
+        try:
+            gen = _db_generation(conn)
+            rows = cur.execute(
+                "SELECT id, question, answer, created_at, updated_at, features FROM qa_kb WHERE gen > ?",
+                (since,),
+            ).fetchall()
+            deleted = []
+            if since >= 0:
+                deleted = [r[0] for r in cur.execute("SELECT id FROM qa_kb_tombstones WHERE gen > ?", (since,))]
+        finally:
+            if own_tx:
+                conn.commit()
+        return self._entries_from_rows(conn, rows), deleted, gen
+
+    def _entries_from_rows(self, conn: sqlite3.Connection, rows: List[sqlite3.Row]) -> List[Tuple[Dict, Counter]]:
+        """解析持久化特征；缺失的行现场分词并补写回数据库"""
+        entries: List[Tuple[Dict, Counter]] = []
+        missing = []
+        for r in rows:
+            item = _row_to_item(r)
+            vec = parse_features(r["features"]) if r["features"] else None
+            if vec is None:
+                vec = Counter(self._tokenize(item["question"]))
+                missing.append((self._normalize(item["question"]), serialize_features(vec), r["id"], r["question"]))
+            entries.append((item, vec))
+        if missing:
+            try:
+                # 仅在问题未被并发修改时写入，避免把旧问题的特征写到新问题上
+                conn.executemany(
+                    "UPDATE qa_kb SET question_norm=?, features=? WHERE id=? AND question=? AND features IS NULL",
+                    missing,
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.debug("补写知识库特征失败: %s", e)
+        return entries
+
+
+def serialize_features(vec: Counter) -> str:
+    """双字组向量的持久化格式（qa_kb.features）"""
+    return json.dumps(vec, ensure_ascii=False, separators=(",", ":"))
+
+
+def parse_features(raw: str) -> Optional[Counter]:
+    try:
+        return Counter(json.loads(raw))
+    except (TypeError, ValueError):
+        return None
+
+
+def _db_generation(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM qa_kb_meta WHERE name='generation'").fetchone()
+    return row[0] if row else 0
+
+
+def _row_to_item(r: sqlite3.Row) -> Dict:
+    return {
+        "id": r["id"],
+        "question": r["question"] or "",
+        "answer": r["answer"] or "",
+        "created_at": r["created_at"],
+        "updated_at": r["updated_at"],
+    }
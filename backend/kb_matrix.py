@@ -0,0 +1,186 @@
+"""
+知识库稀疏矩阵检索引擎（可选）
+
+功能：
+- 将全部知识库问题表示为 L2 归一化的双字组稀疏矩阵（SciPy CSR）
+- 单条或批量问题均通过一次稀疏矩阵乘法完成打分
+- 精确匹配 / 子串匹配加分以向量方式叠加
+
+说明：
+- 依赖 numpy 与 scipy，未安装时 AVAILABLE 为 False，由调用方回退到倒排索引
+- 矩阵由 KBIndex 快照构建，索引版本变化时懒重建
+- 为与逐条循环结果完全一致，最高分附近的候选会用标量公式复核
+"""
+
+import logging
+import threading
+from collections import Counter
+from math import sqrt
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .kb_index import KBIndex
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np  # type: ignore
+    from scipy import sparse  # type: ignore
+
+    AVAILABLE = True
+except Exception:
+    np = None  # type: ignore
+    sparse = None  # type: ignore
+    AVAILABLE = False
+
+# 浮点误差容忍度：与最高分相差在此范围内的候选需复核
+_TIE_EPS = 1e-9
+# 批量检索每次相乘的问题数：乘积保持稀疏（CSC），逐列展开为长度 N 的得分向量，内存与批大小无关
+_QUERY_CHUNK = 128
+
+
+class _MatrixState:
+    """某一索引版本下构建出的不可变矩阵快照"""
+
+    def __init__(self, version: int, items: List[Dict], vecs: List[Counter]):
+        vocab: Dict[str, int] = {}
+        indptr = [0]
+        indices: List[int] = []
+        data: List[float] = []
+        for vec in vecs:
+            norm = sqrt(sum(v * v for v in vec.values()))
+            if norm > 0.0:
+                for bg, cnt in vec.items():
+                    indices.append(vocab.setdefault(bg, len(vocab)))
+                    data.append(cnt / norm)
+            indptr.append(len(indices))
+        self.version = version
+        self.items = items
+        self.vecs = vecs
+        self.vocab = vocab
+        self.matrix = sparse.csr_matrix(
+            (
+                np.asarray(data, dtype=np.float64),
+                np.asarray(indices, dtype=np.int64),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(items), max(len(vocab), 1)),
+        )
+        self.questions = np.asarray([it["question"].strip() for it in items], dtype=object)
+        self.exact: Dict[str, List[int]] = {}
+        for row, q in enumerate(self.questions):
+            self.exact.setdefault(q, []).append(row)
+
+
+class KBMatrix:
+    """基于稀疏矩阵乘法的知识库打分引擎"""
+
+    def __init__(
+        self,
+        index: KBIndex,
+        tokenize: Callable[[str], List[str]],
+        normalize: Callable[[str], str],
+        cosine: Callable[[Counter, Counter], float],
+        bonus: Callable[[str, str], float],
+    ):
+        if not AVAILABLE:
+            raise RuntimeError("稀疏矩阵引擎需要安装 numpy 与 scipy")
+        self._index = index
+        self._tokenize = tokenize
+        self._normalize = normalize
+        self._cosine = cosine
+        self._bonus = bonus
+        self._lock = threading.Lock()
+        self._state: Optional[_MatrixState] = None
+
+    def _current(self) -> _MatrixState:
+        """返回与索引版本一致的矩阵快照，必要时重建"""
+        state = self._state
+        if state is not None and state.version == self._index.version:
+            return state
+        with self._lock:
+            state = self._state
+            if state is None or state.version != self._index.version:
+                state = _MatrixState(*self._index.snapshot())
+                self._state = state
+                logger.info("稀疏矩阵构建完成: %d 条, 词表 %d", len(state.items), len(state.vocab))
+            return state
+
+    def _query_matrix(self, state: _MatrixState, questions: Sequence[str]):
+        """将问题批量转为 (词表维度 x 批大小) 的归一化稀疏矩阵"""
+        rows: List[int] = []
+        cols: List[int] = []
+        data: List[float] = []
+        for col, q in enumerate(questions):
+            vec = Counter(self._tokenize(q))
+            # 向量模包含词表外的双字组，保证与标量余弦一致
+            norm = sqrt(sum(v * v for v in vec.values()))
+            if norm == 0.0:
+                continue
+            for bg, cnt in vec.items():
+                row = state.vocab.get(bg)
+                if row is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    data.append(cnt / norm)
+        return sparse.csr_matrix(
+            (data, (rows, cols)), shape=(state.matrix.shape[1], len(questions))
+        )
+
+    def _bonus_vector(self, state: _MatrixState, q: str, cosines):
+        """计算单个问题的加分向量：精确匹配 0.2，子串匹配 0.1"""
+        bonus = np.zeros(len(state.items), dtype=np.float64)
+        if len(self._normalize(q).replace(" ", "")) >= 2:
+            # 子串必然共享双字组，只在非零余弦的行上检查
+            cand = np.flatnonzero(cosines)
+        else:
+            cand = np.arange(len(state.items))
+        if len(cand):
+            contains = np.fromiter((q in s for s in state.questions[cand]), dtype=bool, count=len(cand))
+            bonus[cand[contains]] = 0.1
+        exact_rows = state.exact.get(q)
+        if exact_rows:
+            bonus[exact_rows] = 0.2
+        return bonus
+
+    def _pick_top_k(
+        self, state: _MatrixState, q: str, scores, k: int, min_score: float
+    ) -> List[Tuple[Dict, float]]:
+        cand = np.flatnonzero(scores > max(0.0, min_score - _TIE_EPS))
+        if len(cand) > k:
+            kth = np.partition(scores[cand], -k)[-k]
+            cand = cand[scores[cand] >= kth - _TIE_EPS]
+        # 复核入围候选，消除矩阵运算的浮点误差并按 id 较大者决胜
+        q_vec = Counter(self._tokenize(q))
+        ranked: List[Tuple[float, int, Dict]] = []
+        for row in cand:
+            item = state.items[row]
+            score = self._cosine(q_vec, state.vecs[row]) + self._bonus(q, item["question"])
+            if score > 0.0 and score >= min_score:
+                ranked.append((score, item["id"], item))
+        ranked.sort(key=lambda t: (t[0], t[1]), reverse=True)
+        return [(item, score) for score, _, item in ranked[:k]]
+
+    def search_top_k(self, question: str, k: int, min_score: float = 0.0) -> List[Tuple[Dict, float]]:
+        """检索单个问题的前 k 个匹配"""
+        return self.search_batch_top_k([question], k, min_score)[0]
+
+    def search_batch_top_k(
+        self, questions: Sequence[str], k: int, min_score: float = 0.0
+    ) -> List[List[Tuple[Dict, float]]]:
+        """批量检索：按块做稀疏矩阵乘法得到余弦得分，不构造 N x 批大小 的稠密矩阵"""
+        state = self._current()
+        if not state.items or not questions or k <= 0:
+            return [[] for _ in questions]
+        n = len(state.items)
+        results: List[List[Tuple[Dict, float]]] = []
+        for start in range(0, len(questions), _QUERY_CHUNK):
+            chunk = questions[start : start + _QUERY_CHUNK]
+            product = (state.matrix @ self._query_matrix(state, chunk)).tocsc()
+            for col, question in enumerate(chunk):
+                q = question.strip()
+                lo, hi = product.indptr[col], product.indptr[col + 1]
+                cosines = np.zeros(n, dtype=np.float64)
+                cosines[product.indices[lo:hi]] = product.data[lo:hi]
+                scores = cosines + self._bonus_vector(state, q, cosines)
+                results.append(self._pick_top_k(state, q, scores, k, min_score))
+        return results
@@ -0,0 +1,146 @@
+"""
+知识库未命中统计
+
+功能：
+- 记录检索得分低于命中下限的问题，按标准化问题累计次数、最高得分与最近出现时间
+- 计数先在内存中聚合，达到条数或时间间隔后批量写入 kb_misses 表，问答链路不逐条写库
+- 按次数列出高频未命中问题，供管理端补充为知识库条目；补充后对应记录自动移除
+
+说明：
+- 表结构在 db.ensure_kb_misses_table 中创建；写入失败只记日志，不影响问答
+- 进程退出时尚未写入的计数（最多 flush_every 条）会丢失，对统计用途可以接受
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class MissTracker:
+    """内存聚合 + 批量落库的未命中计数"""
+
+    def __init__(self, db_path: str, flush_every: int = 50, flush_interval: float = 5.0):
+        self.db_path = db_path
+        self.flush_every = max(1, flush_every)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # 标准化问题 -> [原始问题, 次数, 最高得分, 首次出现时间, 最近出现时间]
+        self._pending: Dict[str, List] = {}
+        self._pending_hits = 0
+        self._last_flush = time.monotonic()
+        self._stats = {"recorded": 0, "flushes": 0, "resolved": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def record(self, question: str, norm: str, score: float) -> None:
+        """记录一次未命中；达到阈值时同步写库"""
+        if not norm:
+            return
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            entry = self._pending.get(norm)
+            if entry is None:
+                self._pending[norm] = [question, 1, score, now, now]
+            else:
+                entry[0] = question
+                entry[1] += 1
+                entry[2] = max(entry[2], score)
+                entry[4] = now
+            self._pending_hits += 1
+            self._stats["recorded"] += 1
+            due = (
+                self._pending_hits >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """把内存中的计数合并写入 kb_misses，返回写入的问题数"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_hits = 0
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            with closing(self._connect()) as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO kb_misses(question_norm, question, hits, best_score, first_seen, last_seen)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(question_norm) DO UPDATE SET
+                        question=excluded.question,
+                        hits=hits + excluded.hits,
+                        best_score=MAX(best_score, excluded.best_score),
+                        last_seen=excluded.last_seen
+                    """,
+                    [(norm, *entry) for norm, entry in pending.items()],
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("写入未命中统计失败: %s", e)
+            return 0
+        with self._lock:
+            self._stats["flushes"] += 1
+        return len(pending)
+
+    def top(self, limit: int = 50, offset: int = 0, min_hits: int = 1) -> Tuple[List[Dict], int]:
+        """按次数降序列出未命中问题，返回 (记录列表, 总数)"""
+        self.flush()
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            total = conn.execute("SELECT COUNT(*) FROM kb_misses WHERE hits >= ?", (min_hits,)).fetchone()[0]
+            rows = conn.execute(
+                """
+                SELECT id, question, hits, best_score, first_seen, last_seen FROM kb_misses
+                WHERE hits >= ? ORDER BY hits DESC, last_seen DESC LIMIT ? OFFSET ?
+                """,
+                (min_hits, limit, offset),
+            ).fetchall()
+        return [dict(r) for r in rows], total
+
+    def resolve(self, conn: sqlite3.Connection, norm: str) -> int:
+        """问题已补充进知识库：移除对应记录（不提交），返回删除条数"""
+        with self._lock:
+            dropped = self._pending.pop(norm, None)
+            if dropped is not None:
+                self._pending_hits -= dropped[1]
+        cur = conn.execute("DELETE FROM kb_misses WHERE question_norm=?", (norm,))
+        removed = max(cur.rowcount, 0)
+        if removed or dropped is not None:
+            with self._lock:
+                self._stats["resolved"] += 1
+        return removed
+
+    def resolve_existing(self, conn: sqlite3.Connection) -> int:
+        """批量导入后调用：移除标准化问题已在知识库中的记录（不提交）"""
+        self.flush()
+        cur = conn.execute(
+            "DELETE FROM kb_misses WHERE question_norm IN "
+            "(SELECT question_norm FROM qa_kb WHERE question_norm IS NOT NULL)"
+        )
+        removed = max(cur.rowcount, 0)
+        with self._lock:
+            self._stats["resolved"] += removed
+        return removed
+
+    def remove(self, miss_id: int) -> bool:
+        """忽略一条未命中记录"""
+        self.flush()
+        with closing(self._connect()) as conn:
+            cur = conn.execute("DELETE FROM kb_misses WHERE id=?", (miss_id,))
+            conn.commit()
+            return cur.rowcount > 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            data = dict(self._stats)
+            data["pending"] = len(self._pending)
+        return data
@@ -0,0 +1,266 @@
+"""
+知识库多进程分片检索（可选）
+
+功能：
+- 以进程池绕开 GIL：每个工作进程内存映射同一份只读索引快照（kb_snapshot），
+  多进程共享操作系统页缓存，不复制索引
+- 快照按行号（即按 id 升序）均分为与进程数相同的连续区间，每个分片只扫描本区间的倒排
+- 一次检索向全部分片分发（scatter），各分片返回本区间的 Top-K，主进程合并（gather）
+- 快照之后的内存增量由主进程检索，与分片结果一起合并，结果与单进程路径一致
+
+说明：
+- 通过 KB_ENGINE=sharded 启用；KB_SHARD_WORKERS 为进程数（默认 CPU 核数），
+  条目数少于 KB_SHARD_MIN_ROWS 或没有快照时仍走单进程倒排索引
+- 进程以 spawn 方式启动，避免在已有线程的服务进程中 fork
+- 快照被其他进程重写后，分片发现代数不一致时返回 None，由调用方重新加载快照后重试
+- 检索超时或进程池损坏时返回 None，调用方回退到单进程路径
+"""
+
+import bisect
+import concurrent.futures
+import heapq
+import logging
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from concurrent.futures.process import BrokenProcessPool
+from math import sqrt
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .kb_index import KBIndex
+from .kb_snapshot import KBSnapshot
+
+logger = logging.getLogger(__name__)
+
+# 精确匹配可获得的最大加分（与 kb_index 一致）
+_MAX_BONUS = 0.2
+_BOUND_EPS = 1e-12
+
+# 工作进程内的状态：映射的快照与加分函数
+_WORKER: Dict = {"snapshot": None, "bonus": None}
+
+# 一条查询：(双字组向量, 去除首尾空白的问题, 是否全量扫描)
+Query = Tuple[Dict[str, int], str, bool]
+
+
+def _init_worker(bonus: Callable[[str, str], float]) -> None:
+    _WORKER["bonus"] = bonus
+
+
+def _worker_snapshot(path: str, generation: int) -> Optional[KBSnapshot]:
+    """返回指定代数的快照；文件已被重写为其他代数时返回 None"""
+    snap = _WORKER["snapshot"]
+    if snap is not None and snap.path == path and snap.generation == generation:
+        return snap
+    fresh = KBSnapshot.open(path)
+    if fresh is None or fresh.generation != generation:
+        if fresh is not None:
+            fresh.close()
+        return None
+    if snap is not None:
+        snap.close()
+    _WORKER["snapshot"] = fresh
+    return fresh
+
+
+def _search_shard(
+    path: str,
+    generation: int,
+    lo: int,
+    hi: int,
+    masked: Sequence[int],
+    queries: List[Query],
+    k: int,
+    min_score: float,
+) -> Optional[List[List[Tuple[float, int]]]]:
+    """工作进程入口：对快照行区间 [lo, hi) 逐条检索，返回每条查询的 [(得分, id)]"""
+    snap = _worker_snapshot(path, generation)
+    if snap is None:
+        return None
+    skip = set(masked)
+    return [_shard_top_k(snap, lo, hi, skip, q_vec, q, full_scan, k, min_score) for q_vec, q, full_scan in queries]
+
+
+def _shard_top_k(
+    snap: KBSnapshot,
+    lo: int,
+    hi: int,
+    masked: set,
+    q_vec: Dict[str, int],
+    q: str,
+    full_scan: bool,
+    k: int,
+    min_score: float,
+) -> List[Tuple[float, int]]:
+    """快照行区间内的有界堆 + 上界剪枝检索（与 KBIndex.top_k 的快照部分逐位一致）"""
+    bonus = _WORKER["bonus"]
+    q_norm = sqrt(sum(v * v for v in q_vec.values()))
+    heap: List[Tuple[float, int]] = []
+
+    def threshold() -> float:
+        return heap[0][0] if len(heap) >= k else min_score
+
+    def consider(row: int, may_bonus: bool) -> None:
+        item_id = snap.id_at(row)
+        if item_id in masked:
+            return
+        cos = snap.cosine(row, q_tids, q_norm)
+        if may_bonus and cos + _MAX_BONUS >= threshold():
+            cos += bonus(q, snap.question(row))
+        if cos <= 0.0 or cos < min_score:
+            return
+        entry = (cos, item_id)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    q_tids: Dict[int, int] = {}
+    ranges: Dict[str, Tuple[int, int, int]] = {}
+    for bg, cnt in q_vec.items():
+        tid = snap.term_id(bg)
+        if tid is None:
+            continue
+        q_tids[tid] = cnt
+        posting = snap.posting(tid)
+        a, b = bisect.bisect_left(posting, lo), bisect.bisect_left(posting, hi)
+        if b > a:
+            ranges[bg] = (tid, a, b)
+
+    if full_scan:
+        for row in range(lo, hi):
+            consider(row, True)
+    elif q_norm > 0.0:
+        terms = sorted(ranges, key=lambda bg: ranges[bg][2] - ranges[bg][1])
+        suffix = [0.0] * (len(terms) + 1)
+        for j in range(len(terms) - 1, -1, -1):
+            suffix[j] = suffix[j + 1] + q_vec[terms[j]] ** 2
+        seen = set()
+        for j, bg in enumerate(terms):
+            bound = sqrt(suffix[j]) / q_norm + (_MAX_BONUS if j == 0 else 0.0)
+            if bound + _BOUND_EPS < threshold():
+                break
+            tid, a, b = ranges[bg]
+            for row in snap.posting(tid)[a:b]:
+                if row not in seen:
+                    seen.add(row)
+                    consider(row, j == 0)
+    return sorted(heap, reverse=True)
+
+
+class KBShardPool:
+    """按 id 区间分片、散发 / 合并检索的进程池"""
+
+    def __init__(self, workers: int, bonus: Callable[[str, str], float], min_rows: int = 50000, timeout: float = 5.0):
+        self.workers = max(1, workers)
+        self.min_rows = min_rows
+        self.timeout = timeout
+        self._bonus = bonus
+        self._lock = threading.Lock()
+        self._pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._stats = {"queries": 0, "batches": 0, "stale": 0, "fallbacks": 0, "restarts": 0}
+
+    def _executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self._bonus,),
+                )
+            return self._pool
+
+    def usable(self, index: KBIndex) -> bool:
+        base, _ = index.base_view()
+        return base is not None and base.count >= self.min_rows
+
+    def top_k_batch(
+        self,
+        index: KBIndex,
+        queries: List[Query],
+        k: int,
+        min_score: float,
+    ) -> Optional[List[List[Tuple[Dict, float]]]]:
+        """分片检索一批查询，返回每条的 [(条目, 得分)]
+
+        快照已被重写（代数不一致）、超时或进程池异常时返回 None，由调用方处理
+        """
+        base, masked = index.base_view()
+        if base is None or k <= 0:
+            return None
+        n = base.count
+        bounds = [n * i // self.workers for i in range(self.workers + 1)]
+        futures = []
+        try:
+            pool = self._executor()
+            for lo, hi in zip(bounds, bounds[1:]):
+                if hi <= lo:
+                    continue
+                # 只把落在本分片 id 区间内的屏蔽 id 发给该分片
+                a = bisect.bisect_left(masked, base.id_at(lo))
+                b = bisect.bisect_right(masked, base.id_at(hi - 1))
+                futures.append(pool.submit(
+                    _search_shard, base.path, base.generation, lo, hi, masked[a:b], queries, k, min_score,
+                ))
+            # 等待分片期间在本进程检索内存增量
+            local = [
+                index.top_k(Counter(q_vec), k, min_score, lambda item, q=q: self._bonus(q, item["question"]),
+                            full_scan=full_scan, include_base=False)
+                for q_vec, q, full_scan in queries
+            ]
+            # timeout 按每条查询计，整批的等待上限随批大小增长
+            wait_until = time.monotonic() + self.timeout * len(queries)
+            parts = [f.result(timeout=max(0.0, wait_until - time.monotonic())) for f in futures]
+        except Exception as e:
+            for f in futures:
+                f.cancel()
+            self._fail(e)
+            return None
+        if any(p is None for p in parts):
+            with self._lock:
+                self._stats["stale"] += 1
+            return None
+
+        results: List[List[Tuple[Dict, float]]] = []
+        for i, mine in enumerate(local):
+            merged = [(score, item["id"], item) for item, score in mine]
+            for part in parts:
+                merged.extend((score, item_id, None) for score, item_id in part[i])
+            merged.sort(key=lambda t: (t[0], t[1]), reverse=True)
+            top: List[Tuple[Dict, float]] = []
+            for score, item_id, item in merged[:k]:
+                if item is None:
+                    row = base.row_of(item_id)
+                    item = base.item(row) if row is not None else None
+                if item is not None:
+                    top.append((item, score))
+            results.append(top)
+        with self._lock:
+            self._stats["queries"] += len(queries)
+            self._stats["batches"] += 1
+        return results
+
+    def _fail(self, e: Exception) -> None:
+        """超时或进程池损坏：记录并在下次使用时重建进程池"""
+        logger.warning("分片检索失败，回退到单进程检索: %r", e)
+        with self._lock:
+            self._stats["fallbacks"] += 1
+            if isinstance(e, BrokenProcessPool) and self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+                self._stats["restarts"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            data = dict(self._stats)
+            data["workers"] = self.workers
+            data["running"] = self._pool is not None
+        return data
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
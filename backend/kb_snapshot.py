@@ -0,0 +1,312 @@
+"""
+知识库索引快照（内存映射）
+
+功能：
+- 把倒排索引序列化为紧凑的二进制文件：条目 id、向量模、正排（条目 -> 双字组）、
+  倒排（双字组 -> 条目）与字符串区，按知识库代数（qa_kb_meta.generation）标记版本
+- 任意进程以 mmap 打开后即可直接检索，无需分词或构建字典
+- 每个代数写为独立的不可变文件（wechat_friends.<代数>.kbsnap），再原子替换指针文件
+  （<快照路径>.current，内容为当前快照文件名）；不会覆盖任何进程正在映射的文件，Windows 下同样可用
+- 切换指针后删除更早的快照文件（保留上一个，供刚读过旧指针的进程打开）；仍被映射而删不掉的留待下次清理
+
+文件布局（小端序）：
+- 头部：魔数 + 格式版本、代数、条目数、双字组数、正排长度、倒排长度、字符串区长度、词表区长度
+- 定长数组：ids(int64)、norms(float64)、str_off(int64, 每条 4 段)、fwd_off(int64)、
+  term_off(int64)、post_off(int64)、fwd_tid(int32)、fwd_cnt(int32)、post_row(int32)
+- 变长区：字符串区（question / answer / created_at / updated_at 依次拼接）、
+  词表区（按 UTF-8 字节序排列的双字组）
+
+说明：
+- 仅小端平台读写快照，其他平台自动回退为从数据库构建
+- 兼容旧版直接写在快照路径上的单文件快照：没有指针文件时直接映射该文件
+"""
+
+import array
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"KBSNAP01"
+_HEADER = struct.Struct("<8s8q")
+_FORMAT_VERSION = 1
+# 每个条目在字符串区中的字段
+_STR_FIELDS = ("question", "answer", "created_at", "updated_at")
+
+
+class KBSnapshot:
+    """只读、内存映射的索引快照"""
+
+    def __init__(self, path: str, mm: mmap.mmap):
+        self.path = path
+        self._mm = mm
+        (
+            magic, fmt, self.generation, n_rows, n_terms, n_fwd, n_post, str_len, term_len
+        ) = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or fmt != _FORMAT_VERSION:
+            raise ValueError("索引快照格式不匹配")
+        self.count = n_rows
+        self.n_terms = n_terms
+        view = memoryview(mm)
+        pos = _HEADER.size
+
+        def take(fmt_char: str, n: int) -> memoryview:
+            nonlocal pos
+            size = struct.calcsize(fmt_char) * n
+            part = view[pos : pos + size].cast(fmt_char)
+            pos += size
+            return part
+
+        self._ids = take("q", n_rows)
+        self._norms = take("d", n_rows)
+        self._str_off = take("q", n_rows * len(_STR_FIELDS) + 1)
+        self._fwd_off = take("q", n_rows + 1)
+        self._term_off = take("q", n_terms + 1)
+        self._post_off = take("q", n_terms + 1)
+        self._fwd_tid = take("i", n_fwd)
+        self._fwd_cnt = take("i", n_fwd)
+        self._post_row = take("i", n_post)
+        self._str_base = pos
+        self._term_base = pos + str_len
+        if self._term_base + term_len > len(mm):
+            raise ValueError("索引快照文件不完整")
+
+    @classmethod
+    def open(cls, path: str) -> Optional["KBSnapshot"]:
+        """映射快照（path 为配置的快照路径或具体的快照文件）；不存在、损坏或平台不支持时返回 None"""
+        if sys.byteorder != "little":
+            return None
+        path = resolve_snapshot(path)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(path, mm)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("索引快照不可用，改为从数据库构建: %s", e)
+            return None
+
+    # ----- 词表与倒排 -----
+
+    def term(self, tid: int) -> str:
+        base = self._term_base
+        return self._mm[base + self._term_off[tid] : base + self._term_off[tid + 1]].decode("utf-8")
+
+    def term_id(self, term: str) -> Optional[int]:
+        """二分查找双字组编号；不存在时返回 None"""
+        key = term.encode("utf-8")
+        base, off, mm = self._term_base, self._term_off, self._mm
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[base + off[mid] : base + off[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and mm[base + off[lo] : base + off[lo + 1]] == key:
+            return lo
+        return None
+
+    def posting_len(self, tid: int) -> int:
+        return self._post_off[tid + 1] - self._post_off[tid]
+
+    def posting(self, tid: int) -> memoryview:
+        """包含该双字组的条目行号"""
+        return self._post_row[self._post_off[tid] : self._post_off[tid + 1]]
+
+    # ----- 条目 -----
+
+    def id_at(self, row: int) -> int:
+        return self._ids[row]
+
+    def row_of(self, item_id: int) -> Optional[int]:
+        row = bisect.bisect_left(self._ids, item_id)
+        if row < self.count and self._ids[row] == item_id:
+            return row
+        return None
+
+    def rows(self) -> range:
+        return range(self.count)
+
+    def item(self, row: int) -> Dict:
+        n = len(_STR_FIELDS)
+        off, base, mm = self._str_off, self._str_base, self._mm
+        fields = [
+            mm[base + off[row * n + i] : base + off[row * n + i + 1]].decode("utf-8")
+            for i in range(n)
+        ]
+        return {
+            "id": self._ids[row],
+            "question": fields[0],
+            "answer": fields[1],
+            "created_at": fields[2] or None,
+            "updated_at": fields[3] or None,
+        }
+
+    def norm(self, row: int) -> float:
+        return self._norms[row]
+
+    def question(self, row: int) -> str:
+        n = len(_STR_FIELDS)
+        base = self._str_base
+        return self._mm[base + self._str_off[row * n] : base + self._str_off[row * n + 1]].decode("utf-8")
+
+    def vec(self, row: int) -> Counter:
+        s, e = self._fwd_off[row], self._fwd_off[row + 1]
+        return Counter({self.term(t): c for t, c in zip(self._fwd_tid[s:e], self._fwd_cnt[s:e])})
+
+    def cosine(self, row: int, q_tids: Dict[int, int], q_norm: float) -> float:
+        """与 ai_qa._cosine 逐位一致的余弦计算（q_tids 为问题向量的 双字组编号 -> 词频）"""
+        norm = self._norms[row]
+        if not norm or q_norm == 0.0:
+            return 0.0
+        s, e = self._fwd_off[row], self._fwd_off[row + 1]
+        dot = 0
+        for t, c in zip(self._fwd_tid[s:e], self._fwd_cnt[s:e]):
+            v = q_tids.get(t)
+            if v:
+                dot += v * c
+        return dot / (q_norm * norm)
+
+    def close(self) -> None:
+        # 仍有 memoryview 引用时无法关闭，交给垃圾回收
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+
+
+def _pointer_path(path: str) -> str:
+    return path + ".current"
+
+
+def _versioned_path(path: str, generation: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.{generation}{ext}"
+
+
+def resolve_snapshot(path: str) -> Optional[str]:
+    """返回 path 当前对应的快照文件：优先读指针文件，其次是 path 本身（旧版单文件快照或具体快照文件）"""
+    try:
+        with open(_pointer_path(path), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except OSError:
+        name = ""
+    if name and os.path.basename(name) == name:
+        target = os.path.join(os.path.dirname(path), name)
+        if os.path.exists(target):
+            return target
+    return path if os.path.exists(path) else None
+
+
+def write_snapshot(path: str, generation: int, entries: Iterable[Tuple[Dict, Counter, float]]) -> bool:
+    """把 (条目, 双字组向量, 向量模) 写为指定代数的快照文件并切换指针，成功返回 True
+
+    快照先写入同目录临时文件再改名为带代数的文件名，最后原子替换指针文件；
+    读者要么看到旧快照要么看到完整的新快照，已映射旧文件的进程不受影响
+    """
+    if sys.byteorder != "little":
+        return False
+    target = _versioned_path(path, generation)
+    if not os.path.exists(target) and not _write_file(target, generation, entries):
+        return False
+    previous = resolve_snapshot(path)
+    tmp = f"{_pointer_path(path)}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(os.path.basename(target))
+        os.replace(tmp, _pointer_path(path))
+    except OSError as e:
+        logger.warning("切换索引快照指针失败: %s", e)
+        _remove_quietly(tmp)
+        return False
+    _cleanup(path, keep={target, previous})
+    return True
+
+
+def _cleanup(path: str, keep: set) -> None:
+    """删除旧的快照文件；仍被其他进程映射（Windows）而删不掉的留待下次清理"""
+    directory = os.path.dirname(path) or "."
+    root, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(root) + r"\.\d+" + re.escape(ext) + r"$")
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    stale = [os.path.join(directory, n) for n in names if pattern.match(n)]
+    # 旧版单文件快照已被指针取代
+    stale.append(path)
+    for p in stale:
+        if p not in keep and os.path.exists(p):
+            _remove_quietly(p)
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _write_file(path: str, generation: int, entries: Iterable[Tuple[Dict, Counter, float]]) -> bool:
+    """序列化快照并经临时文件原子写入 path（path 尚不存在，不会替换被映射的文件）"""
+    entries = sorted(entries, key=lambda e: e[0]["id"])
+    vocab = sorted({bg for _, vec, _ in entries for bg in vec}, key=lambda t: t.encode("utf-8"))
+    tids = {t: i for i, t in enumerate(vocab)}
+
+    ids = array.array("q")
+    norms = array.array("d")
+    str_off = array.array("q", [0])
+    fwd_off = array.array("q", [0])
+    fwd_tid = array.array("i")
+    fwd_cnt = array.array("i")
+    postings: List[List[int]] = [[] for _ in vocab]
+    strings = bytearray()
+    for row, (item, vec, norm) in enumerate(entries):
+        ids.append(item["id"])
+        norms.append(norm)
+        for field in _STR_FIELDS:
+            strings += (item.get(field) or "").encode("utf-8")
+            str_off.append(len(strings))
+        for t in sorted(tids[bg] for bg in vec):
+            fwd_tid.append(t)
+            fwd_cnt.append(vec[vocab[t]])
+            postings[t].append(row)
+        fwd_off.append(len(fwd_tid))
+
+    term_blob = bytearray()
+    term_off = array.array("q", [0])
+    post_off = array.array("q", [0])
+    post_row = array.array("i")
+    for t, term in enumerate(vocab):
+        term_blob += term.encode("utf-8")
+        term_off.append(len(term_blob))
+        post_row.extend(postings[t])
+        post_off.append(len(post_row))
+
+    header = _HEADER.pack(
+        _MAGIC, _FORMAT_VERSION, generation, len(ids), len(vocab),
+        len(fwd_tid), len(post_row), len(strings), len(term_blob),
+    )
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for part in (ids, norms, str_off, fwd_off, term_off, post_off, fwd_tid, fwd_cnt, post_row):
+                part.tofile(f)
+            f.write(strings)
+            f.write(term_blob)
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        logger.warning("写入索引快照失败: %s", e)
+        _remove_quietly(tmp)
+        return False
@@ -1,11 +1,28 @@
+import argparse
+import http.client
 import time
 import logging
+import queue
+import socket
+import sys
+import threading
 import requests
 import json
 import os
+from collections import OrderedDict, deque
 from datetime import datetime
+from types import SimpleNamespace
 from wxautox import WeChat
 
+# 脚本方式运行（python listen_new_message.py）时包根目录不在 sys.path 中，确保可以使用绝对导入 backend.*
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from backend.conversation_store import ConversationStore
+from backend.db import DB_PATH
+from backend.dedup_cache import TTLDedupCache
+
 # ==================== 增强日志配置 ====================
 # 确保日志目录存在
 log_dir = os.path.join(os.path.dirname(__file__), "logs")
@@ -38,52 +55,660 @@ logger.info("🚀 微信AI助手日志系统启动")
 logger.info(f"📁 日志文件路径: {log_filename}")
 logger.info("=" * 50)
 
+def _co_initialize():
+    """在当前线程初始化 COM 环境（UI 自动化在部分机器上需要，失败不致命）"""
+    try:
+        import pythoncom  # type: ignore
+        pythoncom.CoInitialize()
+    except Exception:
+        pass
+
+
+# ==================== 回答引擎 ====================
+# 单次回答的时间预算（毫秒）与请求超时（秒）：预算小于超时，
+# 大模型过慢或熔断时后端直接返回知识库答案，而不是整体超时
+AI_BUDGET_MS = 8000
+AI_TIMEOUT = 10
+
+
+class InProcessAnswerer:
+    """进程内回答：直接调用 backend.ai_qa，省去本地 HTTP 往返与两次 JSON 编解码，后端重启也不受影响
+
+    - 启动时预热：加载知识库索引（优先映射快照）并预建大模型连接
+    - 其他进程（管理后台）对知识库的修改按 KB_SYNC_INTERVAL 同步进本进程索引
+    """
+
+    name = "inprocess"
+
+    def __init__(self):
+        from backend import ai_qa
+        from backend.db import ensure_all_tables
+
+        ensure_all_tables()
+        started = time.perf_counter()
+        ai_qa.warm_up()
+        logger.info(f"🔥 进程内回答引擎已预热，耗时 {time.perf_counter() - started:.2f}s")
+        self._ai_qa = ai_qa
+
+    def answer(self, question):
+        deadline = time.monotonic() + AI_BUDGET_MS / 1000
+        return self._ai_qa.answer_question(question, None, deadline)
+
+
+class HTTPAnswerer:
+    """远程回答：经 HTTP 调用后端 /ai_test，每个回答线程一个 requests.Session 以复用 TCP 连接"""
+
+    name = "http"
+
+    def __init__(self, base_url="http://127.0.0.1:8000"):
+        self.url = base_url.rstrip("/") + "/ai_test"
+        self._local = threading.local()
+
+    def answer(self, question):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        payload = {"question": question, "budget_ms": AI_BUDGET_MS}
+        response = session.post(self.url, json=payload, timeout=AI_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """连接到 Unix 域套接字的 HTTP 连接"""
+
+    def __init__(self, path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class UDSAnswerer:
+    """远程回答：经 Unix 域套接字调用 /ai_test（后端以 uvicorn --uds 启动），每个回答线程一条长连接"""
+
+    name = "uds"
+
+    def __init__(self, path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise OSError("当前系统不支持 Unix 域套接字")
+        self.path = path
+        self._local = threading.local()
+
+    def answer(self, question):
+        body = json.dumps({"question": question, "budget_ms": AI_BUDGET_MS}, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            reused = conn is not None
+            if conn is None:
+                conn = self._local.conn = _UnixHTTPConnection(self.path, AI_TIMEOUT)
+            try:
+                conn.request("POST", "/ai_test", body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self._local.conn = None
+                # 复用的长连接可能已被服务端关闭，换新连接重试一次
+                if reused and attempt == 0:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+                self._local.conn = None
+            if response.status != 200:
+                raise RuntimeError(f"/ai_test 返回 {response.status}: {data[:200]!r}")
+            return json.loads(data.decode("utf-8"))
+
+
+def build_answerer(mode="inprocess", api_url="http://127.0.0.1:8000", uds_path=None):
+    """按模式创建回答引擎；进程内引擎加载失败时退回 HTTP 模式"""
+    if mode == "uds":
+        if not uds_path:
+            raise ValueError("uds 模式需要指定套接字路径")
+        return UDSAnswerer(uds_path)
+    if mode == "http":
+        return HTTPAnswerer(api_url)
+    try:
+        return InProcessAnswerer()
+    except Exception as e:
+        logger.error(f"❌ 进程内回答引擎加载失败，改用 HTTP 调用后端: {e}", exc_info=True)
+        return HTTPAnswerer(api_url)
+
+
+class PollScheduler:
+    """自适应轮询间隔
+
+    - 拉到消息后立即再拉（连续排空），最多连续 max_drain 次，避免长时间独占 UI 锁
+    - 拉空后间隔回到 min_interval，此后每次空轮询乘以 backoff，直至 max_interval
+    """
+
+    def __init__(self, min_interval=0.2, max_interval=2.0, backoff=1.5, max_drain=20):
+        self.min_interval = max(0.0, float(min_interval))
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.backoff = max(1.0, float(backoff))
+        self.max_drain = max(1, int(max_drain))
+        self.interval = self.min_interval
+        self._drained = 0
+
+    def next_delay(self, got_messages):
+        """根据本次轮询是否拉到消息，返回距下次轮询的等待秒数"""
+        if got_messages:
+            self.interval = self.min_interval
+            self._drained += 1
+            if self._drained < self.max_drain:
+                return 0.0
+            self._drained = 0
+            return self.min_interval
+        self._drained = 0
+        delay = self.interval
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+        return delay
+
+
+# 连发合并窗口的默认配置：单聊通常一问一答，合并只会推迟回复，默认只对群聊开启
+DEFAULT_BURST_WINDOW = "friend:0,group:1000"
+
+
+def parse_per_chat_type(value, default_ms):
+    """解析按聊天类型配置的毫秒数，返回 {聊天类型: 秒}，"*" 为缺省值
+
+    格式如 "1000"（所有类型）或 "friend:1500,group:600"（未列出的类型使用 default_ms）
+    """
+    result = {"*": default_ms / 1000}
+    for part in str(value or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        chat_type, _, ms = part.rpartition(":")
+        result[chat_type.strip() or "*"] = max(0.0, float(ms)) / 1000
+    return result
+
+
+class BurstAggregator:
+    """按聊天合并连发的消息（防抖）：一段话分几条发出时只回答一次
+
+    - 同一聊天、同一发送者在 window 内接连发来的文本合并为一条，从第一条起最多等待 max_wait
+    - 窗口与最长等待按聊天类型（friend / group 等）配置，窗口为 0 表示不合并
+    - 其他发送者插话时，已缓冲的消息立即截止，保证同一聊天内的顺序
+    - 所有合并结果由单个后台线程通过 emit(chat_name, msg) 提交，提交顺序与到达顺序一致
+    - 未提交的缓冲数不超过 max_pending：emit 阻塞（回答队列已满）导致缓冲积压到上限时，
+      add 等待空位，调用方（轮询线程）随之暂停拉取
+    """
+
+    def __init__(self, emit, windows, max_waits, max_pending=100):
+        self._emit = emit
+        self.windows = windows
+        self.max_waits = max_waits
+        self.max_pending = max(1, int(max_pending))
+        self._cond = threading.Condition()
+        # 聊天 -> deque[缓冲]，只有最后一个缓冲仍可追加
+        self._bursts = {}
+        self._pending = 0  # 尚未提交完成的缓冲数
+        self._stopping = False
+        self._thread = None
+        self._stats = {"emitted": 0, "merged_bursts": 0, "merged_messages": 0, "max_merged": 0}
+
+    @staticmethod
+    def _setting(table, chat_type):
+        return table.get(chat_type, table.get("*", 0.0))
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="wx-burst", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """立即提交所有缓冲并结束后台线程"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def pending(self):
+        with self._cond:
+            return self._pending
+
+    def _open_burst(self, chat_name, sender, window):
+        """返回可继续追加的缓冲（调用方持有锁）"""
+        chat_bursts = self._bursts.get(chat_name)
+        burst = chat_bursts[-1] if chat_bursts else None
+        if burst is not None and not burst["closed"] and burst["sender"] == sender and window > 0:
+            return burst
+        return None
+
+    def add(self, chat_name, chat_type, msg):
+        """加入一条消息；需要新建缓冲而未提交的缓冲已达上限时等待，返回是否等待过"""
+        window = self._setting(self.windows, chat_type)
+        sender = getattr(msg, 'sender', '')
+        waited = False
+        with self._cond:
+            while (self._pending >= self.max_pending and not self._stopping
+                   and self._open_burst(chat_name, sender, window) is None):
+                waited = True
+                self._cond.wait(0.5)
+            now = time.monotonic()
+            open_burst = self._open_burst(chat_name, sender, window)
+            if open_burst is not None:
+                open_burst["msgs"].append(msg)
+                open_burst["deadline"] = min(now + window, open_burst["max_deadline"])
+            else:
+                chat_bursts = self._bursts.setdefault(chat_name, deque())
+                burst = chat_bursts[-1] if chat_bursts else None
+                if burst is not None and not burst["closed"]:
+                    # 换了发送者：前一段立即截止
+                    burst["closed"] = True
+                    burst["deadline"] = now
+                chat_bursts.append({
+                    "sender": sender,
+                    "msgs": [msg],
+                    "deadline": now + window,
+                    "max_deadline": now + max(window, self._setting(self.max_waits, chat_type)),
+                    "closed": window <= 0,
+                })
+                self._pending += 1
+            self._cond.notify_all()
+        return waited
+
+    def _take_due(self, now):
+        """取出所有到期的缓冲（调用方持有锁），返回 ([(聊天, 缓冲)], 距下一个到期的秒数)"""
+        due, wait = [], None
+        for chat_name in list(self._bursts):
+            chat_bursts = self._bursts[chat_name]
+            while chat_bursts and (self._stopping or chat_bursts[0]["deadline"] <= now):
+                due.append((chat_name, chat_bursts.popleft()))
+            if chat_bursts:
+                remaining = chat_bursts[0]["deadline"] - now
+                wait = remaining if wait is None else min(wait, remaining)
+            else:
+                del self._bursts[chat_name]
+        return due, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    due, wait = self._take_due(time.monotonic())
+                    if due or (self._stopping and not self._bursts):
+                        break
+                    self._cond.wait(wait)
+            if not due:
+                return
+            for chat_name, burst in due:
+                try:
+                    self._emit(chat_name, self._merge(burst["msgs"]))
+                except Exception as e:
+                    logger.error(f"❌ 提交合并消息失败: {e}", exc_info=True)
+                finally:
+                    with self._cond:
+                        self._pending -= 1
+                        self._cond.notify_all()
+
+    def _merge(self, msgs):
+        n = len(msgs)
+        with self._cond:
+            self._stats["emitted"] += 1
+            if n > 1:
+                self._stats["merged_bursts"] += 1
+                self._stats["merged_messages"] += n
+                self._stats["max_merged"] = max(self._stats["max_merged"], n)
+        if n == 1:
+            return msgs[0]
+        first = msgs[0]
+        logger.info(f"🧩 合并 {n} 条连发消息: {getattr(first, 'sender', '')}")
+        return SimpleNamespace(
+            sender=getattr(first, 'sender', ''),
+            content="\n".join(getattr(m, 'content', '') for m in msgs),
+            type=getattr(first, 'type', 'text'),
+            attr=getattr(first, 'attr', ''),
+            merged=n,
+        )
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data["pending"] = self._pending
+        # 合并省下的回答次数
+        data["saved_answers"] = data["merged_messages"] - data["merged_bursts"]
+        return data
+
+
+class ChatDispatcher:
+    """按聊天分键的消息调度：同一聊天串行、不同聊天并发、聊天之间轮转
+
+    - 每个聊天一个先进先出队列，同一时刻每个聊天最多一条消息在处理，保证回复顺序
+    - 有积压且不在处理中的聊天排入就绪队列，回答线程依次取队首聊天的一条消息；
+      处理完后若该聊天仍有积压则排到就绪队列末尾，刷屏的群聊每轮只占一个名额，不会饿死单聊
+    - 并发聊天数上限即回答线程数；所有聊天的积压总数不超过 maxsize
+    - 每个聊天的累计等待统计按最近处理顺序最多保留 max_chat_stats 个，超出时丢弃最久未处理的聊天
+    """
+
+    def __init__(self, maxsize=100, max_chat_stats=1000):
+        self.maxsize = max(1, int(maxsize))
+        self.max_chat_stats = max(1, int(max_chat_stats))
+        self._cond = threading.Condition()
+        self._queues = {}  # 聊天 -> deque[(入队时间, 消息)]，只保留有积压的聊天
+        self._ready = deque()  # 有积压且不在处理中的聊天，按轮转顺序
+        self._active = set()  # 正在处理的聊天
+        self._pending = 0
+        self._chat_stats = OrderedDict()  # 聊天 -> {"processed", "wait_total", "wait_max"}，按最近处理排序
+
+    def qsize(self):
+        with self._cond:
+            return self._pending
+
+    def idle(self):
+        """没有积压也没有处理中的消息"""
+        with self._cond:
+            return self._pending == 0 and not self._active
+
+    def put(self, chat_name, item, timeout=None):
+        """入队；积压已满时最多等待 timeout 秒，仍无空位返回 False"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending < self.maxsize, timeout):
+                return False
+            self._append(chat_name, item)
+            return True
+
+    def put_dropping(self, chat_name, item):
+        """入队；积压已满时丢弃积压最多的聊天中最早的一条，返回被丢弃的 (聊天, 消息) 或 None"""
+        with self._cond:
+            dropped = None
+            if self._pending >= self.maxsize:
+                victim = max(self._queues, key=lambda c: len(self._queues[c]))
+                _, old = self._queues[victim].popleft()
+                self._pending -= 1
+                if not self._queues[victim]:
+                    del self._queues[victim]
+                    if victim not in self._active:
+                        self._ready.remove(victim)
+                dropped = (victim, old)
+            self._append(chat_name, item)
+            return dropped
+
+    def get(self, timeout=None):
+        """取下一条可处理的消息，返回 (聊天, 消息, 排队秒数)；超时返回 None
+
+        取出后该聊天进入处理中，处理完必须调用 task_done
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._ready, timeout):
+                return None
+            chat_name = self._ready.popleft()
+            q = self._queues[chat_name]
+            enqueued_at, item = q.popleft()
+            if not q:
+                del self._queues[chat_name]
+            self._pending -= 1
+            self._active.add(chat_name)
+            waited = time.monotonic() - enqueued_at
+            st = self._chat_stats.pop(chat_name, None) or {"processed": 0, "wait_total": 0.0, "wait_max": 0.0}
+            st["processed"] += 1
+            st["wait_total"] += waited
+            st["wait_max"] = max(st["wait_max"], waited)
+            self._chat_stats[chat_name] = st
+            while len(self._chat_stats) > self.max_chat_stats:
+                self._chat_stats.popitem(last=False)
+            self._cond.notify_all()
+            return chat_name, item, waited
+
+    def task_done(self, chat_name):
+        """结束该聊天当前消息的处理；仍有积压时排到就绪队列末尾"""
+        with self._cond:
+            self._active.discard(chat_name)
+            if chat_name in self._queues:
+                self._ready.append(chat_name)
+            self._cond.notify_all()
+
+    def stats(self):
+        """整体与每个聊天的积压深度、排队等待时间（毫秒）"""
+        now = time.monotonic()
+        with self._cond:
+            chats = {}
+            for chat_name in set(self._queues) | self._active | set(self._chat_stats):
+                q = self._queues.get(chat_name, ())
+                st = self._chat_stats.get(chat_name, {"processed": 0, "wait_total": 0.0, "wait_max": 0.0})
+                n = st["processed"]
+                chats[chat_name] = {
+                    "depth": len(q),
+                    "active": chat_name in self._active,
+                    "oldest_wait_ms": round((now - q[0][0]) * 1000, 1) if q else 0.0,
+                    "processed": n,
+                    "avg_wait_ms": round(st["wait_total"] / n * 1000, 1) if n else 0.0,
+                    "max_wait_ms": round(st["wait_max"] * 1000, 1),
+                }
+            return {
+                "pending": self._pending,
+                "active_chats": len(self._active),
+                "ready_chats": len(self._ready),
+                "chats": chats,
+            }
+
+    def _append(self, chat_name, item):
+        """追加到聊天队列（调用方需持有锁）"""
+        q = self._queues.get(chat_name)
+        if q is None:
+            q = self._queues[chat_name] = deque()
+            if chat_name not in self._active:
+                self._ready.append(chat_name)
+        q.append((time.monotonic(), item))
+        self._pending += 1
+        self._cond.notify_all()
+
+
 # ==================== AI助手核心类 ====================
 class WeChatAIAssistant:
-    def __init__(self, check_interval=2):
+    """微信 AI 助手：轮询 -> 回答 -> 发送 三段流水线
+
+    - 轮询线程只调用 GetNextNewMessage、过滤消息并入队，不等待回答；
+      轮询间隔自适应（PollScheduler）：有消息时连续拉取，空闲时指数退避到 check_interval；
+      同一发送者连发的消息先经 BurstAggregator 合并，再交给回答线程
+    - 回答线程池并发生成回复（进程内调用 ai_qa，或经 HTTP / Unix 域套接字调用后端 /ai_test），慢请求不阻塞其他聊天；
+      消息经 ChatDispatcher 按聊天分派：同一聊天按顺序逐条回答，不同聊天轮转调度
+    - 单个发送线程独占 SendMsg 等 UI 自动化调用；轮询与发送共用一把 UI 锁，互不交错
+    - 两个队列均有上限：回答队列满时按 backpressure 策略处理
+      （block：连发合并线程等待空位，未提交的连发缓冲随之积压，达到上限后轮询线程暂停拉取新消息；
+      drop：丢弃积压最多的聊天中最早的消息），发送队列满时回答线程等待
+    """
+
+    def __init__(
+        self,
+        check_interval=2,
+        poll_min=0.2,
+        poll_backoff=1.5,
+        answer_workers=4,
+        answer_queue_size=100,
+        send_queue_size=100,
+        backpressure="block",
+        answerer=None,
+        burst_windows=None,
+        burst_max_waits=None,
+        memory_chats=200,
+        memory_bytes=8 * 1024 * 1024,
+        memory_idle_seconds=1800,
+    ):
         self.wx = WeChat()
-        self.check_interval = check_interval
+        self.answerer = answerer or HTTPAnswerer()
+        self.check_interval = check_interval  # 空闲时的最长轮询间隔
+        self.poll_scheduler = PollScheduler(poll_min, check_interval, poll_backoff)
         self.current_chat = None
-        self.conversation_history = {}  # 存储每个聊天的对话历史
-        # 消息去重：改为 TTL 机制，允许相同内容在一段时间后再次处理
-        self.processed_messages = {}
-        self.dedup_ttl_seconds = 1.5
-        
+        # 每个聊天的对话历史：按聊天 LRU 常驻、空闲过期，移出内存时写入 chat_history，再来消息时懒加载
+        self.conversations = ConversationStore(
+            DB_PATH,
+            max_chats=memory_chats,
+            max_bytes=memory_bytes,
+            idle_seconds=memory_idle_seconds,
+        )
+        # 消息去重：TTL 内重复的消息只处理一次，允许相同内容在一段时间后再次处理
+        self.dedup = TTLDedupCache(ttl_seconds=1.5, max_entries=10000)
+
+        # 流水线配置
+        self.answer_workers = max(1, int(answer_workers))
+        self.backpressure = backpressure if backpressure in ("block", "drop") else "block"
+        self.dispatcher = ChatDispatcher(maxsize=answer_queue_size)
+        # 连发合并：默认只合并群聊（窗口 1 秒），单聊立即回答；从第一条起最多等待 4 秒
+        self.burst = BurstAggregator(
+            self._enqueue_answer,
+            burst_windows or parse_per_chat_type(DEFAULT_BURST_WINDOW, 0),
+            burst_max_waits or parse_per_chat_type("", 4000),
+            max_pending=answer_queue_size,
+        )
+        self.send_queue = queue.Queue(maxsize=max(1, int(send_queue_size)))
+        self._stop_event = threading.Event()
+        self._threads = []
+        # 轮询与发送都驱动同一个微信窗口，UI 自动化调用需串行
+        self._ui_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.pipeline_stats = {
+            "polls": 0,  # GetNextNewMessage 调用次数
+            "empty_polls": 0,
+            "polled": 0,  # 轮询到的有效消息
+            "dropped": 0,  # 回答队列满被丢弃的消息
+            "blocked": 0,  # 回答队列满、连发缓冲积压到上限导致轮询等待的次数
+            "answered": 0,
+            "sent": 0,
+            "send_failed": 0,
+        }
+        # 首次回复耗时：聊天 -> 最早一条未回复消息的估计到达时间；最近若干次耗时（毫秒）
+        self._awaiting_reply = {}
+        self._first_reply_ms = deque(maxlen=500)
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.pipeline_stats[key] += n
 
-        
     def start_listening(self):
-        """启动智能微信监听"""
+        """启动智能微信监听（阻塞直到 Ctrl+C 或调用 stop）"""
         logger.info("🚀 启动智能微信AI助手...")
-        logger.info("🤖 回复将通过本地接口 /ai_test 生成")
-        logger.info(f"⏰ 检查间隔: {self.check_interval}秒")
-        
-        while True:  # 外层无限循环，确保异常后能恢复
+        logger.info(f"🤖 回答模式: {self.answerer.name}")
+        logger.info(
+            f"⏰ 轮询间隔: {self.poll_scheduler.min_interval}~{self.check_interval}秒，"
+            f"空闲退避倍数: {self.poll_scheduler.backoff}"
+        )
+        logger.info(
+            f"🧵 回答线程: {self.answer_workers}，回答队列上限: {self.dispatcher.maxsize}，"
+            f"发送队列上限: {self.send_queue.maxsize}，背压策略: {self.backpressure}"
+        )
+
+        self._stop_event.clear()
+        self.burst.start()
+        self._threads = [threading.Thread(target=self._poll_loop, name="wx-poller", daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._answer_loop, name=f"wx-answer-{i}", daemon=True)
+            for i in range(self.answer_workers)
+        ]
+        self._threads.append(threading.Thread(target=self._send_loop, name="wx-sender", daemon=True))
+        for t in self._threads:
+            t.start()
+
+        try:
+            # 主线程只等待中断；time.sleep 在 Windows 下也能及时响应 Ctrl+C
+            while not self._stop_event.is_set():
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            logger.info("🛑 用户停止监听")
+        finally:
+            self.stop()
+
+    def stop(self, timeout=5.0):
+        """停止流水线：不再轮询，等待已入队的消息在 timeout 内处理完"""
+        self._stop_event.set()
+        deadline = time.time() + timeout
+        # 轮询已停止：把尚在合并窗口内的消息立即交给回答线程
+        self.burst.stop(timeout)
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.time()))
+        self._threads = []
+        # 常驻对话中尚未落库的消息写入数据库，重启后可继续上下文
+        self.conversations.flush()
+
+    def _poll_loop(self):
+        """轮询线程：只负责拉取新消息并入队，间隔由 PollScheduler 自适应调整"""
+        _co_initialize()
+        last_poll = time.monotonic()
+        while not self._stop_event.is_set():
+            got_messages = False
             try:
-                while True:
-                    # 检查新消息（轮询队列）
-                    try:
-                        # 不过滤静音聊天，避免遗漏消息
-                        new_messages = self.wx.GetNextNewMessage(filter_mute=False)
-                        if new_messages and new_messages.get('msg'):
-                            logger.info(f"🔔 获取到新消息")
-                            self.handle_new_messages(new_messages)
-                    except Exception as e:
-                        logger.warning(f"⚠️ 轮询新消息异常: {e}")
-
-                    time.sleep(self.check_interval)
-
-            except KeyboardInterrupt:
-                logger.info("🛑 用户停止监听")
-                break  # 用户主动停止，退出循环
+                # 不过滤静音聊天，避免遗漏消息
+                with self._ui_lock:
+                    new_messages = self.wx.GetNextNewMessage(filter_mute=False)
+                now = time.monotonic()
+                gap, last_poll = now - last_poll, now
+                self._count("polls")
+                if new_messages and new_messages.get('msg'):
+                    got_messages = True
+                    logger.info(f"🔔 获取到新消息")
+                    # 消息在上一次轮询之后到达，取两次轮询的中点作为估计到达时间
+                    self.handle_new_messages(new_messages, received_at=now - gap / 2)
+                else:
+                    self._count("empty_polls")
             except Exception as e:
-                logger.error(f"❌ 监听错误: {e}，5秒后自动重启...", exc_info=True)
-                time.sleep(5)
-                logger.info("🔄 正在重启监听循环...")
-                # 继续外层循环，实现自动恢复
+                logger.warning(f"⚠️ 轮询新消息异常: {e}")
+            self._stop_event.wait(self.poll_scheduler.next_delay(got_messages))
+
+    def _enqueue_answer(self, chat_name, msg):
+        """把待回答消息交给调度器，积压已满时按背压策略处理"""
+        if self.backpressure == "drop":
+            dropped = self.dispatcher.put_dropping(chat_name, msg)
+            if dropped:
+                old_chat, old_msg = dropped
+                self._count("dropped")
+                logger.warning(f"⚠️ 回答队列已满，丢弃最早的待回答消息: {old_chat} {getattr(old_msg, 'content', '')[:20]}")
+            return
+        if self.dispatcher.put(chat_name, msg, timeout=0):
+            return
+        logger.warning("⚠️ 回答队列已满，连发合并线程等待空位")
+        while not self._stop_event.is_set():
+            if self.dispatcher.put(chat_name, msg, timeout=0.5):
+                return
+
+    def _answer_loop(self):
+        """回答线程：从调度器取消息并生成回复；回复入发送队列后才释放该聊天，保证同一聊天的回复顺序"""
+        while not (self._stop_event.is_set() and self.burst.pending() == 0 and self.dispatcher.qsize() == 0):
+            task = self.dispatcher.get(timeout=0.5)
+            if task is None:
+                continue
+            chat_name, msg, _ = task
+            try:
+                self.process_intelligent_response(chat_name, msg)
+            finally:
+                self.dispatcher.task_done(chat_name)
+
+    def _enqueue_send(self, chat_name, text, record=True):
+        """把回复交给发送线程；发送队列满时等待（回答线程随之放慢）"""
+        self.send_queue.put((chat_name, text, record))
+
+    def _send_loop(self):
+        """发送线程：独占 SendMsg 调用"""
+        _co_initialize()
+        while not (self._stop_event.is_set() and self.send_queue.empty()
+                   and self.burst.pending() == 0 and self.dispatcher.idle()):
+            try:
+                chat_name, text, record = self.send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.send_reply(chat_name, text, record)
+            except Exception as e:
+                logger.error(f"❌ 发送阶段错误: {e}", exc_info=True)
+            finally:
+                self.send_queue.task_done()
     
-    def handle_new_messages(self, messages):
-        """处理新消息"""
+    def handle_new_messages(self, messages, received_at=None):
+        """处理新消息；received_at 为估计到达时间（time.monotonic），用于统计首次回复耗时"""
         chat_name = messages.get('chat_name')
+        chat_type = messages.get('chat_type')
         msgs = messages.get('msg', [])
         # 兼容非列表返回
         if msgs and not isinstance(msgs, list):
@@ -118,100 +743,100 @@ class WeChatAIAssistant:
             logger.info(f"   🏷️ 属性: {msg.attr}")
             logger.info(f"   🔍 是否自己: self={getattr(msg, 'self', None)}, is_self={getattr(msg, 'is_self', None)}")
             
-            # 如果是新聊天，初始化对话历史
-            if chat_name not in self.conversation_history:
-                self.conversation_history[chat_name] = []
+            # 如果是新聊天，初始化对话历史（移出内存的聊天从数据库加载）
+            if self.conversations.ensure(chat_name):
                 self.current_chat = chat_name
                 logger.info(f"🆕 新聊天创建: {chat_name}")
 
-            # 处理所有来源的消息（好友/群聊/公众号等）
-            self.process_intelligent_response(chat_name, msg)
+            self._count("polled")
+            if received_at is not None:
+                with self._stats_lock:
+                    self._awaiting_reply.setdefault(chat_name, received_at)
+
+            # 处理所有来源的消息（好友/群聊/公众号等）：经连发合并后交给回答线程池，轮询线程不等待
+            # 未返回聊天类型时按发送者推断：单聊的发送者即聊天名
+            # 连发缓冲积压到上限时 add 阻塞，轮询线程随之暂停（backpressure=block）
+            if self.burst.add(chat_name, chat_type or ('friend' if msg.sender == chat_name else 'group'), msg):
+                self._count("blocked")
+                logger.warning("⚠️ 回答队列已满，暂停拉取新消息直至有空位")
     
     def process_intelligent_response(self, chat_name, msg):
+        """回答阶段：生成回复后交给发送线程（在回答线程中执行）"""
         try:
             logger.info(f"🎯 开始处理回复: {chat_name}")
             
-            # 初始化对话历史
-            self.conversation_history.setdefault(chat_name, [])
-
             # 统一通过后端 /ai_test 接口生成回复，不在本地拼接
-            # 添加到对话历史
-            self.conversation_history[chat_name].append({
-                "role": "user",
-                "content": msg.content,
-                "sender": msg.sender
-            })
-            
-            # 保持对话历史在合理长度
-            if len(self.conversation_history[chat_name]) > 20:
-                self.conversation_history[chat_name] = self.conversation_history[chat_name][-20:]
-                logger.debug("🧹 清理旧对话历史")
+            # 添加到对话历史（超出长度的旧消息由对话记忆自动裁剪）
+            self.conversations.append(chat_name, "user", msg.content, msg.sender)
             
             # 获取AI回复（调用本地 /ai_test）
             ai_response = self.get_ai_response(chat_name, msg.content)
+            self._count("answered")
 
             if ai_response:
-                # 发送回复（增强健壮性：重试与备用发送器）
-                sent_ok = False
+                self._enqueue_send(chat_name, ai_response)
+                
+        except Exception as e:
+            logger.error(f"❌ 回复处理错误: {e}", exc_info=True)
+            self._enqueue_send(chat_name, "抱歉，我暂时无法回复，请稍后再试。", record=False)
+
+    def send_reply(self, chat_name, ai_response, record=True):
+        """发送阶段：发送回复（增强健壮性：重试与备用发送器），仅在发送线程中调用"""
+        sent_ok = False
+        with self._ui_lock:
+            try:
+                logger.info(f"📤 尝试发送回复到: {chat_name}")
+                self.wx.SendMsg(ai_response, who=chat_name)
+                sent_ok = True
+            except Exception as e:
+                logger.warning(f"⚠️ 首次发送失败，尝试选择聊天后重试: {e}")
                 try:
-                    logger.info(f"📤 尝试发送回复到: {chat_name}")
+                    # 若支持选择聊天窗口，先选择再发送
+                    if hasattr(self.wx, 'SelectChat'):
+                        try:
+                            self.wx.SelectChat(chat_name)
+                            logger.info(f"✅ 已选择聊天窗口: {chat_name}")
+                        except Exception as se:
+                            logger.debug(f"选择聊天窗口失败: {se}")
                     self.wx.SendMsg(ai_response, who=chat_name)
                     sent_ok = True
-                except Exception as e:
-                    logger.warning(f"⚠️ 首次发送失败，尝试选择聊天后重试: {e}")
+                except Exception as e2:
+                    logger.warning(f"⚠️ 第二次发送失败，尝试备用发送器: {e2}")
                     try:
-                        # 若支持选择聊天窗口，先选择再发送
-                        if hasattr(self.wx, 'SelectChat'):
-                            try:
-                                self.wx.SelectChat(chat_name)
-                                logger.info(f"✅ 已选择聊天窗口: {chat_name}")
-                            except Exception as se:
-                                logger.debug(f"选择聊天窗口失败: {se}")
-                        self.wx.SendMsg(ai_response, who=chat_name)
-                        sent_ok = True
-                    except Exception as e2:
-                        logger.warning(f"⚠️ 第二次发送失败，尝试备用发送器: {e2}")
-                        try:
-                            # 备用发送器（通过单例封装）
-                            from .wechat import WeChatSingleton  # 延迟导入避免循环依赖
-                            wx_single = WeChatSingleton.get_instance()
-                            if wx_single:
-                                wx_single.SendMsg(ai_response, chat_name)
-                                sent_ok = True
-                            else:
-                                logger.error("❌ 备用发送器不可用")
-                        except Exception as e3:
-                            logger.error(f"❌ 备用发送器发送失败: {e3}")
-
-                if sent_ok:
-                    # 添加到对话历史
-                    self.conversation_history[chat_name].append({
-                        "role": "assistant",
-                        "content": ai_response,
-                        "sender": "AI助手"
-                    })
-                    logger.info(f"🤖 AI回复成功:")
-                    logger.info(f"   💬 回复内容: {ai_response}")
-                    logger.info(f"   📊 对话历史长度: {len(self.conversation_history[chat_name])}")
-                else:
-                    logger.error(f"❌ AI回复发送失败: {chat_name}")
-                
-        except Exception as e:
-            logger.error(f"❌ 回复处理错误: {e}", exc_info=True)
-            self.wx.SendMsg("抱歉，我暂时无法回复，请稍后再试。", who=chat_name)
+                        # 备用发送器（通过单例封装）
+                        from .wechat import WeChatSingleton  # 延迟导入避免循环依赖
+                        wx_single = WeChatSingleton.get_instance()
+                        if wx_single:
+                            wx_single.SendMsg(ai_response, chat_name)
+                            sent_ok = True
+                        else:
+                            logger.error("❌ 备用发送器不可用")
+                    except Exception as e3:
+                        logger.error(f"❌ 备用发送器发送失败: {e3}")
+
+        if sent_ok:
+            self._count("sent")
+            with self._stats_lock:
+                waiting_since = self._awaiting_reply.pop(chat_name, None)
+                if waiting_since is not None:
+                    self._first_reply_ms.append((time.monotonic() - waiting_since) * 1000)
+            if not record:
+                return True
+            # 添加到对话历史
+            history_len = self.conversations.append(chat_name, "assistant", ai_response, "AI助手")
+            logger.info(f"🤖 AI回复成功:")
+            logger.info(f"   💬 回复内容: {ai_response}")
+            logger.info(f"   📊 对话历史长度: {history_len}")
+        else:
+            self._count("send_failed")
+            logger.error(f"❌ AI回复发送失败: {chat_name}")
+        return sent_ok
     
     def get_ai_response(self, chat_name, user_message):
-        """调用后端本地接口获取智能回复（与前端问答测试一致）"""
+        """通过回答引擎获取智能回复（与前端问答测试一致）"""
         try:
-            logger.info("🔄 调用本地AI测试接口...")
-            payload = {
-                "question": user_message
-            }
-            # 通过本地 FastAPI 接口，避免外网证书问题
-
-            response = requests.post("http://127.0.0.1:8000/ai_test", json=payload, timeout=10)
-            response.raise_for_status()
-            data = response.json()
+            logger.info(f"🔄 调用回答引擎（{self.answerer.name}）...")
+            data = self.answerer.answer(user_message)
             content = (data.get('answer') or '').strip()
             cleaned_response = self.clean_response(content or "")
             logger.info(f"✅ AI调用成功，回复长度: {len(cleaned_response)}字符")
@@ -253,33 +878,46 @@ class WeChatAIAssistant:
             logger.info(f"🚫 忽略sender为空的消息: {content[:30]}...")
             return False
             
-        # 检查重复
-        msg_key = f"{chat_name}_{sender}_{content}"
-        now_ts = time.time()
-        last_ts = self.processed_messages.get(msg_key)
-        if last_ts is not None and (now_ts - last_ts) < self.dedup_ttl_seconds:
-            logger.debug(f"🔄 忽略短期内重复消息: {msg_key}")
+        # 检查重复（首次出现时记录）
+        if self.dedup.seen(chat_name, sender, content):
+            logger.debug(f"🔄 忽略短期内重复消息: {chat_name} {sender} {content[:20]}")
             return False
 
-        # 记录本次处理时间
-        self.processed_messages[msg_key] = now_ts
-
-        # 清理旧的消息记录（防止内存溢出）
-        if len(self.processed_messages) > 1000:
-            logger.debug("🧹 清理消息记录缓存")
-            # 只保留最近 TTL 内的记录，其他删除
-            cutoff = now_ts - self.dedup_ttl_seconds
-            self.processed_messages = {k: ts for k, ts in self.processed_messages.items() if ts >= cutoff}
-            
         return True
     
     def get_chat_stats(self):
         """获取聊天统计"""
+        resident = self.conversations.resident()
         stats = {
-            "total_chats": len(self.conversation_history),
-            "active_chats": list(self.conversation_history.keys()),
-            "total_messages": sum(len(hist) for hist in self.conversation_history.values())
+            "total_chats": len(resident),
+            "active_chats": list(resident.keys()),
+            "total_messages": sum(resident.values()),
+            # 常驻聊天数、估算字节数与溢出 / 加载统计
+            "memory": self.conversations.stats(),
         }
+        stats["answer_mode"] = self.answerer.name
+        with self._stats_lock:
+            stats["pipeline"] = dict(self.pipeline_stats)
+            first_reply = sorted(self._first_reply_ms)
+        # 轮询开销与首次回复耗时（从消息估计到达到该聊天收到第一条回复）
+        polled = stats["pipeline"]["polled"]
+        stats["polling"] = {
+            "interval_s": round(self.poll_scheduler.interval, 3),
+            "polls_per_message": round(stats["pipeline"]["polls"] / polled, 2) if polled else None,
+            "first_reply_ms": {
+                "count": len(first_reply),
+                "avg": round(sum(first_reply) / len(first_reply), 1) if first_reply else None,
+                "p50": round(first_reply[len(first_reply) // 2], 1) if first_reply else None,
+                "p95": round(first_reply[int(len(first_reply) * 0.95)], 1) if first_reply else None,
+                "max": round(first_reply[-1], 1) if first_reply else None,
+            },
+        }
+        stats["pipeline"]["send_queue"] = self.send_queue.qsize()
+        # 每个聊天的积压深度与排队等待时间
+        stats["dispatch"] = self.dispatcher.stats()
+        stats["burst"] = self.burst.stats()
+        stats["dedup"] = self.dedup.stats()
+        stats["pipeline"]["answer_queue"] = stats["dispatch"]["pending"]
         logger.info(f"📊 统计信息: {stats}")
         return stats
 
@@ -292,16 +930,69 @@ if __name__ == "__main__":
     print("   ✓ 多聊天切换")
     print("   ✓ 详细日志记录")
     print("   ✓ 错误处理")
+    print("   ✓ 轮询 / 回答 / 发送流水线")
+    print("   ✓ 进程内问答引擎")
     print()
     print(f"📁 日志文件将保存在: {log_filename}")
     print()
-    
-    assistant = WeChatAIAssistant(check_interval=1.5)
+
+    # 命令行参数优先，其次环境变量（由 /api/start-auto-reply 启动时只能通过环境变量配置）
+    parser = argparse.ArgumentParser(description="微信AI助手")
+    parser.add_argument("--answer-workers", type=int, default=int(os.getenv("LISTENER_ANSWER_WORKERS", "4")),
+                        help="并发生成回复的线程数（即同时处理的聊天数上限）")
+    parser.add_argument("--answer-queue", type=int, default=int(os.getenv("LISTENER_ANSWER_QUEUE", "100")),
+                        help="待回答消息队列上限")
+    parser.add_argument("--send-queue", type=int, default=int(os.getenv("LISTENER_SEND_QUEUE", "100")),
+                        help="待发送回复队列上限")
+    parser.add_argument("--backpressure", choices=("block", "drop"), default=os.getenv("LISTENER_BACKPRESSURE", "block"),
+                        help="回答队列满时：block 暂停拉取新消息，drop 丢弃积压最多的聊天中最早的消息")
+    parser.add_argument("--answer-mode", choices=("inprocess", "http", "uds"),
+                        default=os.getenv("LISTENER_ANSWER_MODE", "inprocess"),
+                        help="inprocess 进程内调用问答引擎；http / uds 经 HTTP 或 Unix 域套接字调用后端 /ai_test")
+    parser.add_argument("--api-url", default=os.getenv("LISTENER_API_URL", "http://127.0.0.1:8000"),
+                        help="http 模式的后端地址")
+    parser.add_argument("--api-uds", default=os.getenv("LISTENER_API_UDS"),
+                        help="uds 模式的套接字路径（后端以 uvicorn --uds 启动）")
+    parser.add_argument("--poll-min", type=float, default=float(os.getenv("LISTENER_POLL_MIN", "0.2")),
+                        help="有消息往来后的最短轮询间隔（秒）")
+    parser.add_argument("--poll-max", type=float, default=float(os.getenv("LISTENER_POLL_MAX", "3")),
+                        help="空闲时退避到的最长轮询间隔（秒）")
+    parser.add_argument("--poll-backoff", type=float, default=float(os.getenv("LISTENER_POLL_BACKOFF", "1.5")),
+                        help="每次空轮询后间隔的放大倍数")
+    parser.add_argument("--burst-window", default=os.getenv("LISTENER_BURST_WINDOW_MS", DEFAULT_BURST_WINDOW),
+                        help="连发合并窗口（毫秒），可按聊天类型配置，如 friend:1500,group:600；"
+                             "未列出的类型不合并，默认只合并群聊")
+    parser.add_argument("--burst-max-wait", default=os.getenv("LISTENER_BURST_MAX_WAIT_MS", "4000"),
+                        help="从第一条消息起最长合并等待（毫秒），格式同上")
+    parser.add_argument("--memory-chats", type=int, default=int(os.getenv("LISTENER_MEMORY_CHATS", "200")),
+                        help="内存中保留对话历史的聊天数上限")
+    parser.add_argument("--memory-mb", type=float, default=float(os.getenv("LISTENER_MEMORY_MB", "8")),
+                        help="对话历史占用内存上限（MB，估算值）")
+    parser.add_argument("--memory-idle", type=float, default=float(os.getenv("LISTENER_MEMORY_IDLE", "1800")),
+                        help="聊天空闲多少秒后移出内存")
+    args = parser.parse_args()
+
+    assistant = WeChatAIAssistant(
+        check_interval=args.poll_max,
+        poll_min=args.poll_min,
+        poll_backoff=args.poll_backoff,
+        answer_workers=args.answer_workers,
+        answer_queue_size=args.answer_queue,
+        send_queue_size=args.send_queue,
+        backpressure=args.backpressure,
+        answerer=build_answerer(args.answer_mode, args.api_url, args.api_uds),
+        burst_windows=parse_per_chat_type(args.burst_window, 0),
+        burst_max_waits=parse_per_chat_type(args.burst_max_wait, 4000),
+        memory_chats=args.memory_chats,
+        memory_bytes=int(args.memory_mb * 1024 * 1024),
+        memory_idle_seconds=args.memory_idle,
+    )
     
     try:
         assistant.start_listening()
     except KeyboardInterrupt:
-        logger.info("🛑 程序已安全停止")
-        stats = assistant.get_chat_stats()
-        logger.info(f"📊 运行统计: {stats}")
-        print(f"📁 日志文件位置: {log_filename}")
+        pass
+    logger.info("🛑 程序已安全停止")
+    stats = assistant.get_chat_stats()
+    logger.info(f"📊 运行统计: {stats}")
+    print(f"📁 日志文件位置: {log_filename}")
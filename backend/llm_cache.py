@@ -0,0 +1,217 @@
+"""
+大模型回答缓存
+
+功能：
+- 内存 LRU + TTL，进程重启后由 SQLite 表 llm_answer_cache 兜底
+- 键：标准化问题 + 命中的知识库答案 + 系统提示词
+- 支持按知识库条目 id、按系统提示词失效，或整体清空；多进程共用时可只清空本进程的内存层
+- 统计命中 / 未命中 / 淘汰 / 失效次数
+
+说明：
+- 表结构在 db.ensure_llm_answer_cache_table 中创建；表不存在时自动退化为纯内存缓存
+- 不同用途的缓存实例使用各自的表（table 参数），容量清理与失效互不影响
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 每写入多少次检查一次 SQLite 表容量
+_PRUNE_EVERY = 200
+
+
+def _hash(*parts: str) -> str:
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def system_hash(system: str) -> str:
+    """系统提示词的摘要，用于按提示词失效"""
+    return _hash(system or "")[:16]
+
+
+class LLMAnswerCache:
+    """LRU + TTL 的两级（内存 / SQLite）回答缓存"""
+
+    def __init__(
+        self,
+        db_path: str,
+        max_entries: int = 2000,
+        ttl_seconds: float = 86400.0,
+        max_db_entries: int = 20000,
+        table: str = "llm_answer_cache",
+    ):
+        self.db_path = db_path
+        self.table = table
+        self.max_entries = max(1, max_entries)
+        self.max_db_entries = max(self.max_entries, max_db_entries)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # key -> (answer, expires_at, kb_id, system_hash)
+        self._mem: "OrderedDict[str, Tuple[str, float, Optional[int], str]]" = OrderedDict()
+        self._writes = 0
+        self._stats: Dict[str, int] = {
+            "hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def make_key(norm_question: str, kb_answer: str, system: str) -> str:
+        return _hash(norm_question, kb_answer or "", system or "")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._mem.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[0]
+                del self._mem[key]
+                self._stats["expirations"] += 1
+        # 内存未命中，查询持久层
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute(
+                    f"SELECT answer, expires_at, kb_id, system_hash FROM {self.table} WHERE key=?",
+                    (key,),
+                ).fetchone()
+                if row and row[1] <= now:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key=?", (key,))
+                    conn.commit()
+                    row = None
+                    with self._lock:
+                        self._stats["expirations"] += 1
+        except sqlite3.Error as e:
+            logger.debug("读取回答缓存表失败: %s", e)
+            row = None
+        with self._lock:
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["db_hits"] += 1
+            self._put_mem(key, (row[0], row[1], row[2], row[3]))
+            return row[0]
+
+    def put(self, key: str, answer: str, kb_id: Optional[int], system: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        s_hash = system_hash(system)
+        with self._lock:
+            self._put_mem(key, (answer, expires_at, kb_id, s_hash))
+            self._writes += 1
+            prune = self._writes % _PRUNE_EVERY == 0
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table}(key, answer, kb_id, system_hash, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, answer, kb_id, s_hash, expires_at),
+                )
+                if prune:
+                    self._prune_db(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.debug("写入回答缓存表失败: %s", e)
+
+    def invalidate_kb(self, kb_id: int) -> int:
+        """失效与指定知识库条目相关的所有缓存"""
+        with self._lock:
+            keys = [k for k, v in self._mem.items() if v[2] == kb_id]
+            for k in keys:
+                del self._mem[k]
+        removed = len(keys)
+        try:
+            with closing(self._connect()) as conn:
+                cur = conn.execute(f"DELETE FROM {self.table} WHERE kb_id=?", (kb_id,))
+                conn.commit()
+                removed = max(removed, cur.rowcount)
+        except sqlite3.Error as e:
+            logger.debug("按条目失效回答缓存失败: %s", e)
+        with self._lock:
+            self._stats["invalidations"] += removed
+        return removed
+
+    def invalidate_system(self, system: str) -> int:
+        """失效以指定系统提示词生成的所有缓存"""
+        s_hash = system_hash(system)
+        with self._lock:
+            keys = [k for k, v in self._mem.items() if v[3] == s_hash]
+            for k in keys:
+                del self._mem[k]
+        removed = len(keys)
+        try:
+            with closing(self._connect()) as conn:
+                cur = conn.execute(f"DELETE FROM {self.table} WHERE system_hash=?", (s_hash,))
+                conn.commit()
+                removed = max(removed, cur.rowcount)
+        except sqlite3.Error as e:
+            logger.debug("按提示词失效回答缓存失败: %s", e)
+        with self._lock:
+            self._stats["invalidations"] += removed
+        return removed
+
+    def invalidate_all(self) -> int:
+        """清空全部缓存（内存层与持久层）"""
+        with self._lock:
+            removed = len(self._mem)
+            self._mem.clear()
+        try:
+            with closing(self._connect()) as conn:
+                cur = conn.execute(f"DELETE FROM {self.table}")
+                conn.commit()
+                removed = max(removed, cur.rowcount)
+        except sqlite3.Error as e:
+            logger.debug("清空回答缓存失败: %s", e)
+        with self._lock:
+            self._stats["invalidations"] += removed
+        return removed
+
+    def drop_memory(self) -> int:
+        """只清空内存层：其他进程修改知识库时，持久层已由修改方失效"""
+        with self._lock:
+            removed = len(self._mem)
+            self._mem.clear()
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            data: Dict[str, float] = dict(self._stats)
+            data["size"] = len(self._mem)
+        lookups = data["hits"] + data["db_hits"] + data["misses"]
+        data["hit_rate"] = round((data["hits"] + data["db_hits"]) / lookups, 4) if lookups else 0.0
+        return data
+
+    # ----- 内部方法 -----
+
+    def _put_mem(self, key: str, entry: Tuple[str, float, Optional[int], str]) -> None:
+        """写入内存层（调用方需持有锁）"""
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _prune_db(self, conn: sqlite3.Connection) -> None:
+        """清理持久层：删除过期行，并按过期时间淘汰超出容量的旧行"""
+        conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_db_entries,),
+        )
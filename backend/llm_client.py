@@ -0,0 +1,557 @@
+"""
+大模型 HTTP 客户端：线程安全的长连接池
+
+功能：
+- 按 (协议, 主机, 端口) 复用 http.client 连接，避免每次请求重新握手 TCP + TLS
+- 每个主机的并发连接数上限，超出时排队等待
+- 连接超时与读取超时分开设置；调用方给出时间预算时，等待连接名额、建连与读取都不超过剩余预算
+- 复用的空闲连接被服务端关闭时自动重连重试一次
+- 遵循 HTTPS_PROXY / HTTP_PROXY / NO_PROXY：https 经代理 CONNECT 隧道，http 以绝对 URI 发给代理
+- 另提供 asyncio 版本（AsyncHTTPConnectionPool），供异步接口与流式输出使用
+
+说明：
+- 仅依赖标准库，支持 http 与 https，便于对接本地 OpenAI 兼容的替身服务离线测试
+- 只支持 http:// 形式的代理（可带用户名密码，按 Basic 认证发送），其他代理协议直接连接并记录警告
+"""
+
+import asyncio
+import base64
+import http.client
+import json
+import logging
+import socket
+import ssl
+import threading
+import time
+import urllib.request
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# 复用连接时可能出现的“对端已关闭”类异常，此时换新连接重试
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+class LLMHTTPError(Exception):
+    """服务端返回非 2xx 状态码"""
+
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"HTTP {status}: {body[:200].decode('utf-8', errors='ignore')}")
+        self.status = status
+        self.body = body
+
+
+class BudgetExceeded(TimeoutError):
+    """调用方给定的时间预算先于连接池自身的超时耗尽，不代表服务端故障"""
+
+
+def _clamp(limit: float, deadline: Optional[float]) -> Tuple[float, bool]:
+    """把单步超时截短到剩余预算内，返回 (超时秒数, 是否由预算决定)；预算已用完抛出 BudgetExceeded"""
+    if deadline is None:
+        return limit, False
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise BudgetExceeded("时间预算已用完")
+    if remaining < limit:
+        return remaining, True
+    return limit, False
+
+
+# 代理：(代理主机, 代理端口, 需附加的代理请求头)
+_Proxy = Tuple[str, int, Dict[str, str]]
+
+
+def proxy_for(scheme: str, host: str) -> Optional[_Proxy]:
+    """按环境变量（urllib.request.getproxies 与 NO_PROXY）返回访问 host 应使用的代理；直连返回 None"""
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    parts = urlsplit(proxy)
+    if parts.scheme != "http" or not parts.hostname:
+        logger.warning("不支持的代理 %s，直接连接 %s", proxy, host)
+        return None
+    headers: Dict[str, str] = {}
+    if parts.username:
+        cred = f"{unquote(parts.username)}:{unquote(parts.password or '')}"
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(cred.encode("utf-8")).decode("ascii")
+    return parts.hostname, parts.port or 80, headers
+
+
+def _open_tunnel(proxy: _Proxy, host: str, port: int, timeout: float) -> socket.socket:
+    """经 HTTP 代理建立到 host:port 的 CONNECT 隧道，返回已连通的套接字"""
+    proxy_host, proxy_port, proxy_headers = proxy
+    sock = socket.create_connection((proxy_host, proxy_port), timeout=timeout)
+    try:
+        lines = [f"CONNECT {host}:{port} HTTP/1.1", f"Host: {host}:{port}"]
+        lines.extend(f"{k}: {v}" for k, v in proxy_headers.items())
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        # 逐字节读到响应头结束，隧道建立后的字节不能被多读
+        head = b""
+        while not head.endswith(b"\r\n\r\n"):
+            ch = sock.recv(1)
+            if not ch or len(head) > 65536:
+                raise OSError(f"代理 {proxy_host}:{proxy_port} 的 CONNECT 响应不完整")
+            head += ch
+        status = head.split(b"\r\n", 1)[0].decode("latin-1")
+        parts = status.split(" ", 2)
+        if len(parts) < 2 or parts[1] != "200":
+            raise OSError(f"代理 CONNECT {host}:{port} 失败: {status}")
+        return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+class _HostPool:
+    """单个主机的连接池"""
+
+    def __init__(self, scheme: str, host: str, port: Optional[int], max_connections: int):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.proxy = proxy_for(scheme, host)
+        self.idle: List[http.client.HTTPConnection] = []
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+
+
+class HTTPConnectionPool:
+    """保持长连接的 HTTP 连接池"""
+
+    def __init__(
+        self,
+        max_per_host: int = 8,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+    ):
+        self.max_per_host = max(1, max_per_host)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._pools: Dict[Tuple[str, str, Optional[int]], _HostPool] = {}
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "connections_created": 0, "connections_reused": 0, "retries": 0}
+
+    def _host_pool(self, scheme: str, host: str, port: Optional[int]) -> _HostPool:
+        key = (scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = _HostPool(scheme, host, port, self.max_per_host)
+                self._pools[key] = pool
+            return pool
+
+    def _new_connection(self, pool: _HostPool, deadline: Optional[float] = None) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if pool.scheme == "https" else http.client.HTTPConnection
+        connect_timeout, clamped = _clamp(self.connect_timeout, deadline)
+        if pool.proxy is None:
+            conn = cls(pool.host, pool.port, timeout=connect_timeout)
+        else:
+            proxy_host, proxy_port, proxy_headers = pool.proxy
+            conn = cls(proxy_host, proxy_port, timeout=connect_timeout)
+            if pool.scheme == "https":
+                # TLS 在隧道内与目标主机握手，证书按目标主机名校验
+                conn.set_tunnel(pool.host, pool.port, headers=proxy_headers)
+        try:
+            conn.connect()
+        except TimeoutError as e:
+            conn.close()
+            if clamped:
+                raise BudgetExceeded(f"连接 {pool.host} 超出时间预算") from e
+            raise
+        # 连接建立后切换为读取超时
+        if conn.sock is not None:
+            conn.sock.settimeout(self.read_timeout)
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _acquire(
+        self, pool: _HostPool, timeout: float, deadline: Optional[float] = None
+    ) -> Tuple[http.client.HTTPConnection, bool]:
+        """取得一个连接，返回 (连接, 是否复用)；deadline 为调用方的截止时间（time.monotonic() 基准）"""
+        wait, clamped = _clamp(timeout, deadline)
+        if not pool.slots.acquire(timeout=wait):
+            if clamped:
+                raise BudgetExceeded(f"等待 {pool.host} 的空闲连接超出时间预算")
+            raise TimeoutError(f"等待 {pool.host} 的空闲连接超时")
+        try:
+            with pool.lock:
+                conn = pool.idle.pop() if pool.idle else None
+            if conn is not None:
+                with self._lock:
+                    self._stats["connections_reused"] += 1
+                return conn, True
+            return self._new_connection(pool, deadline), False
+        except BaseException:
+            pool.slots.release()
+            raise
+
+    def _release(self, pool: _HostPool, conn: Optional[http.client.HTTPConnection], reusable: bool) -> None:
+        try:
+            if conn is not None:
+                if reusable:
+                    with pool.lock:
+                        pool.idle.append(conn)
+                else:
+                    conn.close()
+        finally:
+            pool.slots.release()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, bytes]:
+        """发送请求并读取完整响应体，返回 (状态码, 响应体)；非 2xx 抛出 LLMHTTPError
+
+        timeout 为调用方剩余的时间预算：等待连接名额、建连与读取均截短到预算内，
+        因预算耗尽而超时抛出 BudgetExceeded；缺省使用连接池自身的超时
+        """
+        parts = urlsplit(url)
+        pool = self._host_pool(parts.scheme or "http", parts.hostname or "", parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        hdrs = {"Connection": "keep-alive"}
+        if pool.proxy is not None and pool.scheme != "https":
+            # 明文请求经代理转发：请求行使用绝对 URI
+            path = f"{pool.scheme}://{parts.netloc}{path}"
+            hdrs.update(pool.proxy[2])
+        hdrs.update(headers or {})
+        with self._lock:
+            self._stats["requests"] += 1
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for attempt in range(2):
+            conn, reused = self._acquire(pool, self.connect_timeout + self.read_timeout, deadline)
+            reusable = False
+            clamped = False
+            try:
+                read_timeout, clamped = _clamp(self.read_timeout, deadline)
+                if conn.sock is not None:
+                    conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body=body, headers=hdrs)
+                resp = conn.getresponse()
+                data = resp.read()
+                reusable = not resp.will_close
+                if not 200 <= resp.status < 300:
+                    raise LLMHTTPError(resp.status, data)
+                return resp.status, data
+            except TimeoutError as e:
+                if clamped:
+                    raise BudgetExceeded("读取响应超出时间预算") from e
+                raise
+            except _STALE_ERRORS:
+                # 复用的空闲连接已被服务端关闭：换新连接重试一次
+                if reused and attempt == 0:
+                    with self._lock:
+                        self._stats["retries"] += 1
+                    continue
+                raise
+            finally:
+                self._release(pool, conn, reusable)
+        raise RuntimeError("unreachable")
+
+    def post_json(
+        self,
+        url: str,
+        payload: Dict,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+    ) -> Dict:
+        """POST JSON 并解析 JSON 响应"""
+        hdrs = {"Content-Type": "application/json"}
+        hdrs.update(headers or {})
+        _, data = self.request("POST", url, json.dumps(payload).encode("utf-8"), hdrs, timeout=timeout)
+        return json.loads(data.decode("utf-8", errors="ignore"))
+
+    def warm(self, url: str) -> bool:
+        """预先建立一条到 url 所在主机的连接（TCP + TLS）放入空闲池，使首个请求免于握手"""
+        parts = urlsplit(url)
+        pool = self._host_pool(parts.scheme or "http", parts.hostname or "", parts.port)
+        try:
+            conn, _ = self._acquire(pool, self.connect_timeout)
+        except (OSError, TimeoutError, http.client.HTTPException) as e:
+            logger.debug("预建连接失败: %s", e)
+            return False
+        self._release(pool, conn, True)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            data = dict(self._stats)
+            data["idle_connections"] = sum(len(p.idle) for p in self._pools.values())
+        return data
+
+    def close(self) -> None:
+        """关闭所有空闲连接"""
+        with self._lock:
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn in idle:
+                conn.close()
+
+
+class _AsyncConn:
+    """asyncio 流上的一条 HTTP/1.1 连接"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self) -> None:
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class AsyncHTTPConnectionPool:
+    """asyncio 版长连接池：同一事件循环内复用连接，单个 worker 可并发大量请求"""
+
+    def __init__(
+        self,
+        max_per_host: int = 32,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+    ):
+        self.max_per_host = max(1, max_per_host)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._idle: Dict[Tuple[str, str, int], List[_AsyncConn]] = {}
+        self._slots: Dict[Tuple[str, str, int], asyncio.Semaphore] = {}
+        self._proxies: Dict[Tuple[str, str, int], Optional[_Proxy]] = {}
+        self._stats = {"requests": 0, "connections_created": 0, "connections_reused": 0, "retries": 0}
+
+    def _bind_loop(self) -> None:
+        # 连接与信号量都绑定事件循环；循环变化时（如测试中多次 asyncio.run）重置状态
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._loop = loop
+            self._idle = {}
+            self._slots = {}
+
+    def _proxy(self, key: Tuple[str, str, int]) -> Optional[_Proxy]:
+        if key not in self._proxies:
+            self._proxies[key] = proxy_for(key[0], key[1])
+        return self._proxies[key]
+
+    async def _connect(self, key: Tuple[str, str, int]) -> _AsyncConn:
+        scheme, host, port = key
+        ssl_ctx = ssl.create_default_context() if scheme == "https" else None
+        proxy = self._proxy(key)
+        if proxy is None:
+            opening = asyncio.open_connection(host, port, ssl=ssl_ctx, server_hostname=host if ssl_ctx else None)
+        elif ssl_ctx is not None:
+            opening = self._connect_tunnel(proxy, host, port, ssl_ctx)
+        else:
+            opening = asyncio.open_connection(proxy[0], proxy[1])
+        reader, writer = await asyncio.wait_for(opening, timeout=self.connect_timeout)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        self._stats["connections_created"] += 1
+        return _AsyncConn(reader, writer)
+
+    async def _connect_tunnel(self, proxy: _Proxy, host: str, port: int, ssl_ctx: ssl.SSLContext):
+        """在线程中完成 CONNECT 握手，再在隧道套接字上建立 TLS 流"""
+        sock = await asyncio.to_thread(_open_tunnel, proxy, host, port, self.connect_timeout)
+        try:
+            sock.setblocking(False)
+            return await asyncio.open_connection(sock=sock, ssl=ssl_ctx, server_hostname=host)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def _readline(self, conn: _AsyncConn) -> bytes:
+        return await asyncio.wait_for(conn.reader.readline(), timeout=self.read_timeout)
+
+    async def _send(
+        self, conn: _AsyncConn, method: str, host: str, path: str, body: Optional[bytes], headers: Dict[str, str]
+    ) -> Tuple[int, Dict[str, str]]:
+        """发送请求并读取状态行与响应头"""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Connection: keep-alive"]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        conn.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+        await conn.writer.drain()
+        status_line = await self._readline(conn)
+        if not status_line:
+            raise http.client.RemoteDisconnected("服务端关闭了连接")
+        parts = status_line.decode("latin-1").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise http.client.BadStatusLine(status_line.decode("latin-1", errors="ignore"))
+        resp_headers: Dict[str, str] = {}
+        while True:
+            line = await self._readline(conn)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            resp_headers[name.strip().lower()] = value.strip()
+        if parts[0] == "HTTP/1.0" and resp_headers.get("connection", "").lower() != "keep-alive":
+            resp_headers["connection"] = "close"
+        return int(parts[1]), resp_headers
+
+    async def _iter_body(self, conn: _AsyncConn, headers: Dict[str, str]):
+        """按块产出响应体；支持 chunked、Content-Length 与读到连接关闭三种方式"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await self._readline(conn)
+                size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # 读取 trailer 直到空行
+                    while (await self._readline(conn)) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                chunk = await asyncio.wait_for(conn.reader.readexactly(size), timeout=self.read_timeout)
+                await self._readline(conn)
+                yield chunk
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(conn.reader.read(min(remaining, 65536)), timeout=self.read_timeout)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(conn.reader.read(65536), timeout=self.read_timeout)
+                if not chunk:
+                    return
+                yield chunk
+
+    @staticmethod
+    def _reusable(headers: Dict[str, str]) -> bool:
+        if headers.get("connection", "").lower() == "close":
+            return False
+        return "content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"
+
+    async def _open(self, method: str, url: str, body: Optional[bytes], headers: Optional[Dict[str, str]]):
+        """取得连接并发出请求，返回 (key, 连接, 状态码, 响应头)；调用方负责 _finish"""
+        self._bind_loop()
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        key = (scheme, parts.hostname or "", parts.port or (443 if scheme == "https" else 80))
+        path = (parts.path or "/") + (("?" + parts.query) if parts.query else "")
+        host = parts.netloc
+        proxy = self._proxy(key)
+        if proxy is not None and scheme != "https":
+            # 明文请求经代理转发：请求行使用绝对 URI
+            path = f"{scheme}://{host}{path}"
+            headers = dict(proxy[2], **(headers or {}))
+        slots = self._slots.setdefault(key, asyncio.Semaphore(self.max_per_host))
+        self._stats["requests"] += 1
+
+        await asyncio.wait_for(slots.acquire(), timeout=self.connect_timeout + self.read_timeout)
+        try:
+            for attempt in range(2):
+                idle = self._idle.setdefault(key, [])
+                conn = idle.pop() if idle else None
+                reused = conn is not None
+                if reused:
+                    self._stats["connections_reused"] += 1
+                else:
+                    conn = await self._connect(key)
+                try:
+                    status, resp_headers = await self._send(conn, method, host, path, body, headers or {})
+                    return key, conn, status, resp_headers
+                except (_STALE_ERRORS + (asyncio.IncompleteReadError,)):
+                    conn.close()
+                    # 复用的空闲连接已被服务端关闭：换新连接重试一次
+                    if reused and attempt == 0:
+                        self._stats["retries"] += 1
+                        continue
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+        except BaseException:
+            slots.release()
+            raise
+        raise RuntimeError("unreachable")
+
+    def _finish(self, key: Tuple[str, str, int], conn: _AsyncConn, reusable: bool) -> None:
+        if reusable:
+            self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self._slots[key].release()
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, bytes]:
+        """发送请求并读取完整响应体，返回 (状态码, 响应体)；非 2xx 抛出 LLMHTTPError"""
+        key, conn, status, resp_headers = await self._open(method, url, body, headers)
+        reusable = False
+        try:
+            chunks = [chunk async for chunk in self._iter_body(conn, resp_headers)]
+            reusable = self._reusable(resp_headers)
+        finally:
+            self._finish(key, conn, reusable)
+        data = b"".join(chunks)
+        if not 200 <= status < 300:
+            raise LLMHTTPError(status, data)
+        return status, data
+
+    async def stream(
+        self,
+        method: str,
+        url: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[bytes]:
+        """发送请求并按块产出响应体（用于 SSE 流式响应）；非 2xx 抛出 LLMHTTPError
+
+        调用方提前结束迭代时应使用 contextlib.aclosing，确保连接及时归还或关闭
+        """
+        key, conn, status, resp_headers = await self._open(method, url, body, headers)
+        reusable = False
+        try:
+            if not 200 <= status < 300:
+                data = b"".join([chunk async for chunk in self._iter_body(conn, resp_headers)])
+                reusable = self._reusable(resp_headers)
+                raise LLMHTTPError(status, data)
+            async for chunk in self._iter_body(conn, resp_headers):
+                yield chunk
+            reusable = self._reusable(resp_headers)
+        finally:
+            self._finish(key, conn, reusable)
+
+    async def post_json(self, url: str, payload: Dict, headers: Optional[Dict[str, str]] = None) -> Dict:
+        """POST JSON 并解析 JSON 响应"""
+        hdrs = {"Content-Type": "application/json"}
+        hdrs.update(headers or {})
+        _, data = await self.request("POST", url, json.dumps(payload).encode("utf-8"), hdrs)
+        return json.loads(data.decode("utf-8", errors="ignore"))
+
+    def stats(self) -> Dict[str, int]:
+        data = dict(self._stats)
+        data["idle_connections"] = sum(len(v) for v in self._idle.values())
+        return data
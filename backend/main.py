@@ -46,8 +46,10 @@ def create_app() -> FastAPI:
     return app
 
 
-# 供 ASGI 使用
-app = create_app()
+# 供 ASGI 使用；以 spawn 方式启动的子进程（如分片检索进程池）会以 __mp_main__ 重新导入本文件，
+# 此时不创建应用，避免重复建表与启动调度器
+if __name__ != "__mp_main__":
+    app = create_app()
 
 
 if __name__ == "__main__":
@@ -89,6 +89,11 @@ class QAItem(BaseModel):
     updated_at: str
 
 
+# 知识库相似检索结果条目
+class QASearchItem(QAItem):
+    score: float
+
+
 # 新增/更新知识库载荷
 class QACreateUpdate(BaseModel):
     question: str
@@ -99,6 +104,8 @@ class QACreateUpdate(BaseModel):
 class AITestPayload(BaseModel):
     question: str
     system: Optional[str] = None
+    # 时间预算（毫秒）：超出后直接返回知识库答案，不再等待大模型
+    budget_ms: Optional[int] = None
 
 
 # AI 测试响应
@@ -106,11 +113,27 @@ class AITestResponse(BaseModel):
     answer: str
     matched_id: Optional[int] = None
     matched_question: Optional[str] = None
+    score: float = 0.0
+    # 回答层级：kb（直接返回知识库答案）/ llm / kb_fallback / no_kb
+    tier: Optional[str] = None
+
+# 批量 AI 测试请求载荷
+class AITestBatchPayload(BaseModel):
+    questions: List[str]
+    system: Optional[str] = None
+    concurrency: int = 8
+    ordered: bool = True
+
 
 # 系统提示词设置
 class AISettingsResponse(BaseModel):
     system: str
     updated_at: Optional[str] = None
+    kb_direct_score: Optional[float] = None
+    kb_min_score: Optional[float] = None
 
 class AISettingsUpdate(BaseModel):
-    system: str
\ No newline at end of file
+    system: str
+    # 分层阈值：不传则保持不变
+    kb_direct_score: Optional[float] = None
+    kb_min_score: Optional[float] = None
\ No newline at end of file
@@ -1,24 +1,37 @@
+import asyncio
+import codecs
+import csv
+import io
 import json
 import logging
+import queue
 import sqlite3
 import subprocess
 import sys
 import os
+import tempfile
 import time
 from contextlib import closing
-from typing import List, Optional, Dict
+from typing import Iterator, List, Optional, Dict, Tuple
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
-from .db import DB_PATH
+from .db import DB_PATH, begin_qa_kb_bulk
+from .dedup_cache import TTLDedupCache
 from .models import (
     Friend, GroupItem, SendMessagePayload, SendHistoryItem,
     ScheduleMessagePayload, ScheduledJobItem,
     GroupCreate, GroupUpdate, FriendGroupUpdate,
-    QAItem, QACreateUpdate, AITestPayload, AITestResponse,
+    QAItem, QASearchItem, QACreateUpdate, AITestPayload, AITestResponse, AITestBatchPayload,
     AISettingsResponse, AISettingsUpdate,
 )
-from .ai_qa import answer_question
+from .ai_qa import (
+    answer_question_async, answer_question_stream, answer_questions_batch, retrieve_top_k, kb_item_updated, kb_item_deleted,
+    kb_features, kb_backfill_features, kb_bulk_updated, kb_find_duplicates, kb_backfill_minhash, kb_duplicate_clusters,
+    kb_top_misses, kb_dismiss_miss,
+    ai_settings_updated, ai_stats,
+)
 from .wechat import WeChatSingleton
 
 logger = logging.getLogger(__name__)
@@ -431,6 +444,284 @@ def list_qa_kb(offset: int = 0, limit: int = 10):
         return {"items": [], "total": 0}
 
 
+# 知识库：相似问题检索（用于查重与近似问题查找）
+@router.get('/qa_kb/search')
+def search_qa_kb(q: str, k: int = 5, min_score: float = 0.0):
+    question = (q or '').strip()
+    if not question:
+        raise HTTPException(status_code=400, detail='请输入问题')
+    k = max(1, min(k, 100))
+    try:
+        t0 = time.perf_counter()
+        results = retrieve_top_k(question, k, min_score)
+        took_ms = (time.perf_counter() - t0) * 1000
+        items = [
+            QASearchItem(
+                id=item['id'],
+                question=item['question'],
+                answer=item['answer'],
+                created_at=item['created_at'],
+                updated_at=item['updated_at'],
+                score=score,
+            ).dict()
+            for item, score in results
+        ]
+        return {"items": items, "total": len(items), "took_ms": round(took_ms, 3)}
+    except Exception as e:
+        logger.exception("检索知识库失败")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 知识库批量导入 / 导出
+_KB_IO_FORMATS = ('jsonl', 'csv')
+# 每批 executemany 的行数
+_KB_IMPORT_BATCH = 2000
+# 导出时每次从游标读取的行数
+_KB_EXPORT_BATCH = 1000
+# 导入结果中最多返回的错误明细条数
+_KB_IMPORT_MAX_ERRORS = 20
+
+
+def _iter_kb_records(lines: Iterator[str], fmt: str) -> Iterator[Tuple[int, Optional[str], Optional[str], Optional[str]]]:
+    """逐条解析导入内容，产出 (行号, 问题, 答复, 错误信息)"""
+    if fmt == 'jsonl':
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as e:
+                yield lineno, None, None, f'JSON 解析失败: {e}'
+                continue
+            if not isinstance(obj, dict):
+                yield lineno, None, None, '每行需为 JSON 对象'
+                continue
+            yield lineno, obj.get('question'), obj.get('answer'), None
+        return
+    reader = csv.reader(lines)
+    q_col, a_col = 0, 1
+    for row in reader:
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if reader.line_num == 1 and 'question' in row and 'answer' in row:
+            # 首行为表头（导出文件的格式）
+            q_col, a_col = row.index('question'), row.index('answer')
+            continue
+        if len(row) <= max(q_col, a_col):
+            yield reader.line_num, None, None, '列数不足'
+            continue
+        yield reader.line_num, row[q_col], row[a_col], None
+
+
+def _import_qa_kb(lines: Iterator[str], fmt: str, dedup: bool) -> Dict:
+    """先解析全部导入内容并暂存到临时文件，再在单个事务内分批写入；dedup 时跳过标准化问题已存在的条目
+
+    上传与解析期间不持有写锁，事务只覆盖插入本身；
+    整批条目共用一个知识库代数（插入时写入 gen，不逐行递增），全文索引由触发器随插入写入
+    """
+    stats = {"total": 0, "inserted": 0, "skipped": 0, "invalid": 0, "errors": []}
+    if dedup:
+        sql = (
+            "INSERT INTO qa_kb(question, answer, question_norm, features, gen) SELECT ?, ?, ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM qa_kb WHERE question_norm = ?)"
+        )
+    else:
+        sql = "INSERT INTO qa_kb(question, answer, question_norm, features, gen) VALUES (?, ?, ?, ?, ?)"
+    batch: List[Tuple] = []
+
+    def flush():
+        cur = conn.executemany(sql, batch)
+        stats["inserted"] += cur.rowcount
+        stats["skipped"] += len(batch) - cur.rowcount
+        batch.clear()
+
+    with tempfile.TemporaryFile(mode='w+', encoding='utf-8') as spool:
+        # 第一阶段：读完上传内容，校验并计算特征，每条一行 JSON 写入临时文件
+        for lineno, q, a, err in _iter_kb_records(lines, fmt):
+            stats["total"] += 1
+            q = q.strip() if isinstance(q, str) else ''
+            a = a.strip() if isinstance(a, str) else ''
+            if err is None and (not q or not a):
+                err = '问题与答复均不能为空'
+            if err is not None:
+                stats["invalid"] += 1
+                if len(stats["errors"]) < _KB_IMPORT_MAX_ERRORS:
+                    stats["errors"].append({"line": lineno, "error": err})
+                continue
+            spool.write(json.dumps([q, a, *kb_features(q)], ensure_ascii=False) + '\n')
+        spool.seek(0)
+
+        # 第二阶段：上传已完整接收，开启写事务批量插入
+        with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                gen = begin_qa_kb_bulk(conn)
+                if dedup:
+                    # 已有条目缺少标准化问题时先补写，保证去重判断完整
+                    kb_backfill_features(conn)
+                for line in spool:
+                    q, a, norm, features = json.loads(line)
+                    batch.append((q, a, norm, features, gen, norm) if dedup else (q, a, norm, features, gen))
+                    if len(batch) >= _KB_IMPORT_BATCH:
+                        flush()
+                if batch:
+                    flush()
+                kb_backfill_minhash(conn)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    return stats
+
+
+# 知识库：批量导入（请求体为 JSONL 或 CSV 原始内容，边接收边解析写入）
+# JSONL 每行一个 {"question": ..., "answer": ...}；CSV 可带 question,answer 表头，否则取前两列
+@router.post('/qa_kb/import')
+async def import_qa_kb(request: Request, fmt: str = Query('jsonl', alias='format'), dedup: bool = False):
+    if fmt not in _KB_IO_FORMATS:
+        raise HTTPException(status_code=400, detail='format 仅支持 jsonl / csv')
+    # 网络读取在事件循环中进行，解析与写库在工作线程中进行，有界队列提供背压；
+    # 工作线程读完全部内容后才开启写事务，慢速上传不会长时间占用数据库写锁
+    # 队列元素：一批文本行；None 表示结束；异常表示上传中断，工作线程据此回滚
+    lines: "queue.Queue" = queue.Queue(maxsize=64)
+
+    def line_iter() -> Iterator[str]:
+        while True:
+            chunk = lines.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield from chunk
+
+    async def put(item) -> bool:
+        while True:
+            try:
+                lines.put_nowait(item)
+                return True
+            except queue.Full:
+                if worker.done():
+                    return False
+                await asyncio.sleep(0.005)
+
+    t0 = time.perf_counter()
+    worker = asyncio.ensure_future(asyncio.to_thread(_import_qa_kb, line_iter(), fmt, dedup))
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending = ''
+    try:
+        async for chunk in request.stream():
+            pending += decoder.decode(chunk)
+            parts = pending.split('\n')
+            pending = parts.pop()
+            if parts and not await put([p + '\n' for p in parts]):
+                break
+        pending += decoder.decode(b'', final=True)
+        if pending:
+            await put([pending])
+        await put(None)
+    except BaseException as e:
+        await put(RuntimeError(f'上传中断: {e!r}'))
+        await asyncio.gather(worker, return_exceptions=True)
+        raise
+    try:
+        stats = await worker
+    except Exception as e:
+        logger.exception("导入知识库失败")
+        raise HTTPException(status_code=500, detail=str(e))
+    # 索引只在导入结束后刷新一次
+    await asyncio.to_thread(kb_bulk_updated)
+    stats.update(success=True, took_ms=round((time.perf_counter() - t0) * 1000, 3))
+    return stats
+
+
+def _iter_qa_kb_export(fmt: str) -> Iterator[str]:
+    """按 id 升序分批读取并序列化，不一次性加载整表"""
+    with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
+        cur = conn.execute("SELECT id, question, answer, created_at, updated_at FROM qa_kb ORDER BY id")
+        columns = ['id', 'question', 'answer', 'created_at', 'updated_at']
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            # BOM 便于 Excel 正确识别中文
+            buf.write('\ufeff')
+            writer.writerow(columns)
+        while True:
+            rows = cur.fetchmany(_KB_EXPORT_BATCH)
+            if not rows:
+                break
+            if fmt == 'csv':
+                writer.writerows(rows)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            else:
+                yield ''.join(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + '\n' for r in rows)
+        if fmt == 'csv' and buf.tell():
+            yield buf.getvalue()
+
+
+# 知识库：流式导出
+@router.get('/qa_kb/export')
+def export_qa_kb(fmt: str = Query('jsonl', alias='format')):
+    if fmt not in _KB_IO_FORMATS:
+        raise HTTPException(status_code=400, detail='format 仅支持 jsonl / csv')
+    media_type = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv; charset=utf-8'
+    return StreamingResponse(
+        _iter_qa_kb_export(fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=qa_kb.{fmt}"},
+    )
+
+
+# 知识库：近似重复簇（MinHash + LSH，无需两两比较）
+@router.get('/qa_kb/duplicates')
+def list_qa_kb_duplicates(threshold: float = 0.8, limit: int = 50):
+    if not 0.0 < threshold <= 1.0:
+        raise HTTPException(status_code=400, detail='threshold 需在 (0, 1] 之间')
+    limit = max(1, min(limit, 1000))
+    try:
+        t0 = time.perf_counter()
+        clusters = kb_duplicate_clusters(threshold)
+        took_ms = (time.perf_counter() - t0) * 1000
+        return {
+            "clusters": [
+                {"size": len(c), "items": [QAItem(**item).dict() for item in c]}
+                for c in clusters[:limit]
+            ],
+            "total": len(clusters),
+            "took_ms": round(took_ms, 3),
+        }
+    except Exception as e:
+        logger.exception("查询近似重复失败")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 知识库：高频未命中问题（按次数降序），便于补充为知识库条目
+@router.get('/kb_misses')
+def list_kb_misses(offset: int = 0, limit: int = 50, min_hits: int = 1):
+    try:
+        items, total = kb_top_misses(max(1, min(limit, 500)), max(0, offset), max(1, min_hits))
+        return {"items": items, "total": total}
+    except Exception as e:
+        logger.exception("查询未命中问题失败")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 知识库：忽略一条未命中记录
+@router.delete('/kb_misses/{mid}')
+def delete_kb_miss(mid: int):
+    try:
+        if not kb_dismiss_miss(mid):
+            raise HTTPException(status_code=404, detail='记录不存在')
+        return {"success": True}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("删除未命中记录失败")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # 知识库：新增
 @router.post('/qa_kb')
 def create_qa_kb(payload: QACreateUpdate):
@@ -444,7 +735,10 @@ def create_qa_kb(payload: QACreateUpdate):
             cur.execute("INSERT INTO qa_kb(question, answer) VALUES (?, ?)", (q, a))
             conn.commit()
             rid = cur.execute("SELECT last_insert_rowid() AS id").fetchone()[0]
-            return {"success": True, "id": rid}
+            kb_item_updated(conn, rid)
+            # 近似重复提示：不阻止写入，由前端提示用户合并
+            duplicates = kb_find_duplicates(conn, q, exclude_id=rid)
+            return {"success": True, "id": rid, "duplicates": duplicates}
     except Exception as e:
         logger.exception("新增知识库失败")
         raise HTTPException(status_code=500, detail=str(e))
@@ -464,7 +758,9 @@ def update_qa_kb(rid: int, payload: QACreateUpdate):
             if cur.rowcount == 0:
                 raise HTTPException(status_code=404, detail='条目不存在')
             conn.commit()
-            return {"success": True}
+            kb_item_updated(conn, rid)
+            duplicates = kb_find_duplicates(conn, q, exclude_id=rid)
+            return {"success": True, "duplicates": duplicates}
     except HTTPException:
         raise
     except Exception as e:
@@ -482,6 +778,7 @@ def delete_qa_kb(rid: int):
             if cur.rowcount == 0:
                 raise HTTPException(status_code=404, detail='条目不存在')
             conn.commit()
+            kb_item_deleted(conn, rid)
             return {"success": True}
     except HTTPException:
         raise
@@ -497,9 +794,16 @@ def get_ai_settings():
         with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
             conn.row_factory = sqlite3.Row
             cur = conn.cursor()
-            row = cur.execute("SELECT system_prompt, updated_at FROM ai_settings ORDER BY id DESC LIMIT 1").fetchone()
+            row = cur.execute(
+                "SELECT system_prompt, updated_at, kb_direct_score, kb_min_score FROM ai_settings ORDER BY id DESC LIMIT 1"
+            ).fetchone()
             if row:
-                return AISettingsResponse(system=row['system_prompt'], updated_at=row['updated_at'])
+                return AISettingsResponse(
+                    system=row['system_prompt'],
+                    updated_at=row['updated_at'],
+                    kb_direct_score=row['kb_direct_score'],
+                    kb_min_score=row['kb_min_score'],
+                )
             # 兜底：无记录时返回空字符串
             return AISettingsResponse(system="")
     except Exception as e:
@@ -516,37 +820,120 @@ def update_ai_settings(payload: AISettingsUpdate):
     try:
         with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
             cur = conn.cursor()
+            old = cur.execute(
+                "SELECT system_prompt, kb_direct_score, kb_min_score FROM ai_settings ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            direct = payload.kb_direct_score if payload.kb_direct_score is not None else (old[1] if old else 1.0)
+            low = payload.kb_min_score if payload.kb_min_score is not None else (old[2] if old else 0.05)
+            if low < 0 or direct < low:
+                raise HTTPException(status_code=400, detail='阈值需满足 0 <= kb_min_score <= kb_direct_score')
             cur.execute(
-                "UPDATE ai_settings SET system_prompt=?, updated_at=DATETIME('now','localtime') WHERE id=(SELECT id FROM ai_settings ORDER BY id DESC LIMIT 1)",
-                (sys,)
+                "UPDATE ai_settings SET system_prompt=?, kb_direct_score=?, kb_min_score=?, updated_at=DATETIME('now','localtime') WHERE id=(SELECT id FROM ai_settings ORDER BY id DESC LIMIT 1)",
+                (sys, direct, low)
             )
             if cur.rowcount == 0:
-                cur.execute("INSERT INTO ai_settings(system_prompt) VALUES (?)", (sys,))
+                cur.execute(
+                    "INSERT INTO ai_settings(system_prompt, kb_direct_score, kb_min_score) VALUES (?, ?, ?)",
+                    (sys, direct, low)
+                )
             conn.commit()
+            # 仅调整阈值时提示词未变，无需失效回答缓存
+            ai_settings_updated(old[0] if old and old[0] != sys else None)
             return {"success": True}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("更新系统提示词失败")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # AI 测试：调用大模型 + 本地知识库进行智能答复
+# 异步接口：等待大模型期间不占用线程池，单个 worker 可同时处理大量问题
 @router.post('/ai_test', response_model=AITestResponse)
-def ai_test(payload: AITestPayload):
+async def ai_test(payload: AITestPayload):
     q = (payload.question or '').strip()
     if not q:
         raise HTTPException(status_code=400, detail='请输入问题')
+    deadline = time.monotonic() + payload.budget_ms / 1000 if payload.budget_ms else None
     try:
-        res = answer_question(q, payload.system)
+        res = await answer_question_async(q, payload.system, deadline)
         return AITestResponse(
             answer=res.get('answer', ''),
             matched_id=res.get('matched_id'),
-            matched_question=res.get('matched_question')
+            matched_question=res.get('matched_question'),
+            score=res.get('score') or 0.0,
+            tier=res.get('tier'),
         )
     except Exception as e:
         logger.exception("AI 测试失败")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# AI 测试（流式）：以 SSE 逐段推送大模型输出，最后一个 done 事件携带完整结果
+# 已推送的内容与最终答案不一致时（如流中途失败回退到知识库答案），done 之前先推送 replace 事件
+@router.post('/ai_test/stream')
+async def ai_test_stream(payload: AITestPayload):
+    q = (payload.question or '').strip()
+    if not q:
+        raise HTTPException(status_code=400, detail='请输入问题')
+
+    async def events():
+        try:
+            async for event, data in answer_question_stream(q, payload.system):
+                yield _sse(event, data)
+        except Exception as e:
+            logger.exception("AI 流式测试失败")
+            yield _sse('error', {'detail': str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+# AI 运行统计：回答缓存命中、连接池复用等
+@router.get('/ai_stats')
+def get_ai_stats():
+    stats = ai_stats()
+    stats["chat_history_dedup"] = _CHAT_HISTORY_SEEN.stats()
+    return stats
+
+
+# 批量 AI 测试：一次检索全部问题，有限并发调用大模型，以 JSONL 逐行返回
+@router.post('/ai_test/batch')
+async def ai_test_batch(payload: AITestBatchPayload):
+    questions = payload.questions or []
+    if not questions:
+        raise HTTPException(status_code=400, detail='问题列表不能为空')
+    concurrency = max(1, min(payload.concurrency, 64))
+
+    async def lines():
+        t0 = time.perf_counter()
+        total = cache_hits = 0
+        try:
+            async for res in answer_questions_batch(questions, payload.system, concurrency, payload.ordered):
+                total += 1
+                cache_hits += 1 if res.get('cached') else 0
+                yield json.dumps(res, ensure_ascii=False) + '\n'
+        except Exception as e:
+            logger.exception("批量 AI 测试失败")
+            yield json.dumps({'error': str(e)}, ensure_ascii=False) + '\n'
+        # 末行汇总
+        yield json.dumps({
+            'done': True,
+            'total': total,
+            'cache_hits': cache_hits,
+            'elapsed_ms': round((time.perf_counter() - t0) * 1000, 3),
+        }, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
 # 启动自动回复
 @router.post('/api/start-auto-reply')
 def start_auto_reply():
@@ -663,6 +1050,14 @@ def update_friend_remark(payload: dict):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# 已入库的聊天记录（好友、发送者、内容、时间）：每次刷新都会重新拉取窗口内全部消息，
+# 近期写过的记录直接跳过，不再逐条执行 NOT EXISTS 查询
+_CHAT_HISTORY_SEEN = TTLDedupCache(
+    ttl_seconds=float(os.getenv("CHAT_HISTORY_DEDUP_TTL", "3600")),
+    max_entries=int(os.getenv("CHAT_HISTORY_DEDUP_MAX", "50000")),
+)
+
+
 # 获取聊天历史记录
 # 获取聊天记录
 @router.post('/api/get-chat-history')
@@ -700,6 +1095,7 @@ def get_chat_history(payload: dict):
             
             # 格式化消息并保存到数据库
             history = []
+            saved_keys = []
             with closing(sqlite3.connect(DB_PATH, check_same_thread=False)) as conn:
                 cursor = conn.cursor()
                 
@@ -717,7 +1113,9 @@ def get_chat_history(payload: dict):
                             'type': msg_type
                         })
                         
-                        # 保存到数据库（去重：检查是否已存在相同消息）
+                        # 保存到数据库（去重：近期已写入的直接跳过，否则检查是否已存在相同消息）
+                        if _CHAT_HISTORY_SEEN.contains(friend_id, sender, content, msg_time):
+                            continue
                         try:
                             cursor.execute(
                                 """INSERT INTO chat_history (friend_id, friend_name, sender, content, msg_type, msg_time)
@@ -729,10 +1127,14 @@ def get_chat_history(payload: dict):
                                 (friend_id, friend_name, sender, content, msg_type, msg_time,
                                  friend_id, sender, content, msg_time)
                             )
+                            saved_keys.append((friend_id, sender, content, msg_time))
                         except Exception as db_err:
                             logger.warning(f"保存消息到数据库失败: {db_err}")
                 
                 conn.commit()
+            # 提交成功后再记入去重缓存
+            for key in saved_keys:
+                _CHAT_HISTORY_SEEN.add(*key)
             
             logger.info(f"获取聊天历史成功: 好友={friend_name}, 消息数量={len(history)}")
             
@@ -0,0 +1,93 @@
+"""
+进程级设置缓存
+
+功能：
+- 缓存 ai_settings 最新一行，避免每次回答都查询数据库
+- 本进程内的更新通过 invalidate() 立即生效
+- 其他进程（listen_new_message.py 子进程、其他 worker）的修改通过
+  设置专用的版本号发现（由 ai_settings 上的触发器递增）：
+  只有设置本身被修改时才重新读取，其他表的写入不会导致重读
+
+说明：
+- 持有一条长连接专门用于版本检查，版本号为单行主键查询，开销极低
+- 版本表不存在（旧数据库尚未初始化）时不缓存，每次读取
+"""
+
+import logging
+import sqlite3
+import threading
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SettingsCache:
+    """基于设置版本号校验的单行设置缓存"""
+
+    def __init__(
+        self,
+        db_path: str,
+        loader: Callable[[sqlite3.Connection], Optional[Dict]],
+        version_sql: str = "SELECT value FROM ai_settings_meta WHERE name = 'version'",
+    ):
+        self.db_path = db_path
+        self._loader = loader
+        self._version_sql = version_sql
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._value: Optional[Dict] = None
+        self._version: Optional[int] = None
+        self._valid = False
+        self._stats = {"hits": 0, "reloads": 0, "invalidations": 0}
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+        return self._conn
+
+    def get(self) -> Optional[Dict]:
+        """返回缓存值；设置被其他连接修改过或已失效时重新加载"""
+        with self._lock:
+            try:
+                conn = self._connection()
+                version = self._read_version(conn)
+                if self._valid and version is not None and version == self._version:
+                    self._stats["hits"] += 1
+                    return self._value
+                self._value = self._loader(conn)
+                self._version = version
+                self._valid = True
+                self._stats["reloads"] += 1
+                return self._value
+            except sqlite3.Error as e:
+                logger.debug("读取设置失败: %s", e)
+                # 连接异常时丢弃，下次重建
+                self._close()
+                return self._value
+
+    def _read_version(self, conn: sqlite3.Connection) -> Optional[int]:
+        try:
+            row = conn.execute(self._version_sql).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def invalidate(self) -> None:
+        """本进程修改设置后调用，下次 get() 必定重新读取"""
+        with self._lock:
+            self._valid = False
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+            self._conn = None
+            self._valid = False
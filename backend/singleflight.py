@@ -0,0 +1,164 @@
+"""
+单飞（single-flight）请求合并
+
+功能：
+- 相同键的调用在进行中时，后到的调用者不再重复执行，而是等待同一个结果
+- 线程调用者与 asyncio 调用者共享同一张在途表，可以互相合并
+- 统计执行次数、被合并次数与当前等待数
+- do_background：领头调用交给后台执行器，等待者只在自己的线程中等待，不占用执行器线程
+
+说明：
+- 在途结果统一用 concurrent.futures.Future 表示，asyncio 侧通过 asyncio.wrap_future 等待
+- 领头调用被取消时，等待者不会拿到取消异常，而是各自重新发起
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaderCancelled(Exception):
+    """领头调用被取消，等待者需自行重试"""
+
+
+class FlightRejected(Exception):
+    """后台执行器无法接收领头调用（队列已满）"""
+
+
+class SingleFlight:
+    """按键合并并发的相同调用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, concurrent.futures.Future] = {}
+        self._stats = {"executions": 0, "coalesced": 0, "waiting": 0, "max_waiting": 0}
+
+    def _join(self, key: Hashable) -> Tuple[concurrent.futures.Future, bool]:
+        """返回 (在途 Future, 是否为领头)"""
+        with self._lock:
+            fut = self._flights.get(key)
+            if fut is not None:
+                self._stats["coalesced"] += 1
+                self._stats["waiting"] += 1
+                self._stats["max_waiting"] = max(self._stats["max_waiting"], self._stats["waiting"])
+                return fut, False
+            fut = concurrent.futures.Future()
+            self._flights[key] = fut
+            self._stats["executions"] += 1
+            return fut, True
+
+    def _leave(self, key: Hashable, fut: concurrent.futures.Future) -> None:
+        with self._lock:
+            if self._flights.get(key) is fut:
+                del self._flights[key]
+
+    def _done_waiting(self) -> None:
+        with self._lock:
+            self._stats["waiting"] -= 1
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """线程版：执行 fn 或等待相同键的在途结果
+
+        timeout 仅作用于等待者，超时抛出 concurrent.futures.TimeoutError，在途调用不受影响
+        """
+        while True:
+            fut, leader = self._join(key)
+            if not leader:
+                try:
+                    return fut.result(timeout=timeout)
+                except _LeaderCancelled:
+                    continue
+                finally:
+                    self._done_waiting()
+            try:
+                result = fn()
+            except BaseException as e:
+                fut.set_exception(e if isinstance(e, Exception) else _LeaderCancelled())
+                raise
+            finally:
+                self._leave(key, fut)
+            fut.set_result(result)
+            return result
+
+    def do_background(
+        self,
+        key: Hashable,
+        fn: Callable[[], Any],
+        launch: Callable[[Callable[[], None], Callable[[], None]], bool],
+        timeout: Optional[float] = None,
+    ) -> Any:
+        """线程版：领头调用交给后台执行，领头与等待者都在各自线程中最多等待 timeout 秒
+
+        - launch(run, abandon) 负责安排 run() 在后台执行，返回 False 表示无法接收；
+          后台决定不再执行时（如排队期间已过期）调用 abandon()。这两种情况下领头抛出 FlightRejected，
+          仍在等待的调用者在剩余时间内各自重新发起
+        - 超时抛出 concurrent.futures.TimeoutError，在途调用继续完成，结果交给之后加入的调用者
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if end is None else end - time.monotonic()
+            if wait is not None and wait <= 0:
+                raise concurrent.futures.TimeoutError()
+            fut, leader = self._join(key)
+            if leader:
+
+                def run() -> None:
+                    try:
+                        result = fn()
+                    except BaseException as e:
+                        self._leave(key, fut)
+                        fut.set_exception(e if isinstance(e, Exception) else _LeaderCancelled())
+                        return
+                    self._leave(key, fut)
+                    fut.set_result(result)
+
+                def abandon() -> None:
+                    self._leave(key, fut)
+                    fut.set_exception(_LeaderCancelled())
+
+                if not launch(run, abandon):
+                    abandon()
+                    raise FlightRejected("后台执行器无法接收调用")
+                try:
+                    return fut.result(timeout=wait)
+                except _LeaderCancelled:
+                    raise FlightRejected("后台放弃执行调用") from None
+            try:
+                return fut.result(timeout=wait)
+            except _LeaderCancelled:
+                continue
+            finally:
+                self._done_waiting()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """asyncio 版：执行 fn() 协程或等待相同键的在途结果"""
+        while True:
+            fut, leader = self._join(key)
+            if not leader:
+                try:
+                    # shield：等待者被取消时不影响共享的 Future
+                    return await asyncio.shield(asyncio.wrap_future(fut))
+                except _LeaderCancelled:
+                    continue
+                finally:
+                    self._done_waiting()
+            try:
+                result = await fn()
+            except BaseException as e:
+                fut.set_exception(e if isinstance(e, Exception) else _LeaderCancelled())
+                raise
+            finally:
+                self._leave(key, fut)
+            fut.set_result(result)
+            return result
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            data = dict(self._stats)
+            data["in_flight"] = len(self._flights)
+        return data
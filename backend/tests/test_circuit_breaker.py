@@ -0,0 +1,75 @@
+"""CircuitBreaker：连续失败熔断、超时后半开只放行一个探测、探测结果决定恢复或重新熔断"""
+
+import types
+
+import pytest
+
+from backend import circuit_breaker
+from backend.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("llm", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    # 成功清零连续失败计数
+    breaker.record_success()
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.stats()["rejected"] == 1
+    assert breaker.stats()["opened"] == 1
+
+
+def test_half_open_admits_single_probe_then_closes(clock):
+    breaker = CircuitBreaker("llm", failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 29.9
+    assert not breaker.allow()
+    clock[0] += 0.1
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # 探测进行中，其余调用仍被拒绝
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert all(breaker.allow() for _ in range(3))
+    assert breaker.stats()["consecutive_failures"] == 0
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker("llm", failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock[0] += 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.stats()["opened"] == 2
+    # 重新计时：需再等一个 reset_timeout
+    clock[0] += 9
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+
+
+def test_abandoned_probe_releases_the_slot(clock):
+    breaker = CircuitBreaker("llm", failure_threshold=1, reset_timeout=5)
+    breaker.record_failure()
+    clock[0] += 5
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.abandon()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
@@ -0,0 +1,69 @@
+"""FTS 检索引擎与倒排索引引擎的结果一致性（索引与查询使用同一套标准化双字组）"""
+
+import random
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from backend import ai_qa, db
+from backend.kb_index import KBIndex
+
+# 含大小写字母与标点：FTS 分词折叠大小写只会扩大候选，重排后结果仍应一致
+_CHARS = "退货发票快递价格会员积分客服aB1"
+
+
+@pytest.fixture(scope="module")
+def kb(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("kb_fts") / "kb.db")
+    rnd = random.Random(11)
+    with closing(sqlite3.connect(path)) as conn:
+        db.ensure_qa_kb_table(conn)
+        db.ensure_qa_kb_features(conn)
+        db.ensure_qa_kb_fts(conn)
+        questions = ["".join(rnd.choice(_CHARS) for _ in range(rnd.randint(1, 10))) for _ in range(150)]
+        questions += [q + "？" for q in questions[:10]] + ["分 发 票", "服务 价格"]
+        conn.executemany("INSERT INTO qa_kb(question, answer) VALUES (?, ?)", [(q, "答" + q) for q in questions])
+        # 外部写入的行没有特征：补写后触发器同步写入全文索引
+        ai_qa.kb_backfill_features(conn)
+        conn.execute("UPDATE qa_kb SET question='会员积分退货' WHERE id=3")
+        conn.execute("DELETE FROM qa_kb WHERE id=4")
+        ai_qa.kb_backfill_features(conn)
+        conn.commit()
+        index = KBIndex(ai_qa._char_bigrams, ai_qa._normalize_text)
+        index.load(conn)
+        stored = [r[0] for r in conn.execute("SELECT question FROM qa_kb ORDER BY id")]
+    return path, index, _queries(stored, rnd)
+
+
+def _queries(stored, rnd):
+    queries = list(_CHARS[:4]) + ["a", "？", "分发", "票票", "服价员", "分发票", "没有命中"]
+    queries += rnd.sample(stored, 20) + [q[1:-1] for q in rnd.sample(stored, 30) if len(q) > 3]
+    queries += ["".join(rnd.choice(_CHARS) for _ in range(rnd.randint(2, 6))) for _ in range(60)]
+    return queries
+
+
+@pytest.mark.parametrize("k", [1, 5])
+def test_fts_matches_index_engine(kb, monkeypatch, k):
+    path, index, queries = kb
+    monkeypatch.setattr(ai_qa, "DB_PATH", path)
+    with closing(sqlite3.connect(path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM qa_kb_fts").fetchone()[0] == len(index)
+    for question in queries:
+        got = ai_qa._retrieve_top_k_fts(question, k, 0.0)
+        expected = ai_qa._retrieve_top_k_index(index, question, k, 0.0)
+        assert [item["id"] for item, _ in got] == [item["id"] for item, _ in expected], question
+        assert [s for _, s in got] == pytest.approx([s for _, s in expected], abs=1e-12), question
+
+
+def test_legacy_trigram_index_is_rebuilt(tmp_path):
+    with closing(sqlite3.connect(str(tmp_path / "old.db"))) as conn:
+        db.ensure_qa_kb_table(conn)
+        db.ensure_qa_kb_features(conn)
+        conn.execute(
+            "CREATE VIRTUAL TABLE qa_kb_fts USING fts5(question, content='qa_kb', content_rowid='id', tokenize='trigram')"
+        )
+        conn.execute("INSERT INTO qa_kb(question, answer, features) VALUES ('退货流程', 'x', ?)", ('{"退货":1,"货流":1,"流程":1}',))
+        db.ensure_qa_kb_fts(conn)
+        rows = conn.execute("SELECT rowid, bigrams FROM qa_kb_fts").fetchall()
+        assert rows == [(1, "退货 货流 流程")]
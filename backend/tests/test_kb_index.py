@@ -0,0 +1,123 @@
+"""KBIndex.top_k 与逐条余弦扫描的结果一致性（含同分与精确 / 子串加分）"""
+
+import random
+import sqlite3
+from collections import Counter
+from contextlib import closing
+
+import pytest
+
+from backend import ai_qa, db
+from backend.kb_index import KBIndex
+
+# 字符集很小，问题之间大量共享双字组，容易出现同分
+_CHARS = "退货发票快递价格会员积分客服"
+
+
+def _item(item_id, question):
+    return {"id": item_id, "question": question, "answer": "答" + question, "created_at": None, "updated_at": None}
+
+
+def _brute_force(items, question, k, min_score):
+    q = question.strip()
+    q_vec = Counter(ai_qa._char_bigrams(question))
+    scored = []
+    for item in items.values():
+        score = ai_qa._cosine(q_vec, Counter(ai_qa._char_bigrams(item["question"]))) + ai_qa._match_bonus(
+            q, item["question"]
+        )
+        if score > 0.0 and score >= min_score:
+            scored.append((score, item["id"]))
+    scored.sort(reverse=True)
+    return scored[:k]
+
+
+@pytest.fixture(scope="module")
+def kb():
+    rnd = random.Random(7)
+    index = KBIndex(ai_qa._char_bigrams, ai_qa._normalize_text)
+    items = {}
+    questions = ["".join(rnd.choice(_CHARS) for _ in range(rnd.randint(1, 8))) for _ in range(300)]
+    # 完全相同的问题（同分，按 id 较大者优先）与带标点的变体
+    questions += [questions[i] for i in range(0, 40, 4)]
+    questions += [questions[i] + "？" for i in range(40, 60, 4)]
+    for item_id, question in enumerate(questions, 1):
+        items[item_id] = _item(item_id, question)
+        index.upsert(items[item_id])
+    # 修改与删除后仍应一致
+    for item_id in range(5, 60, 11):
+        items[item_id] = _item(item_id, questions[item_id - 1] + "退货")
+        index.upsert(items[item_id])
+    for item_id in range(7, 300, 37):
+        del items[item_id]
+        index.remove(item_id)
+    return index, items, rnd
+
+
+def _queries(items, rnd):
+    stored = [item["question"] for item in items.values()]
+    queries = list(_CHARS[:5])  # 单字：无法构成双字组，走全量扫描
+    queries += rnd.sample(stored, 30)  # 精确匹配
+    queries += [q[1:-1] for q in rnd.sample(stored, 40) if len(q) > 3]  # 子串匹配
+    queries += ["".join(rnd.choice(_CHARS) for _ in range(rnd.randint(2, 6))) for _ in range(40)]
+    queries += ["  会员积分？ ", "没有命中的问题"]
+    return queries
+
+
+@pytest.mark.parametrize("k,min_score", [(1, 0.0), (5, 0.0), (20, 0.0), (10, 0.5)])
+def test_top_k_matches_brute_force(kb, k, min_score):
+    index, items, rnd = kb
+    assert len(index) == len(items)
+    for question in _queries(items, rnd):
+        got = ai_qa._retrieve_top_k_index(index, question, k, min_score)
+        expected = _brute_force(items, question, k, min_score)
+        assert [item["id"] for item, _ in got] == [item_id for _, item_id in expected], question
+        assert [score for _, score in got] == pytest.approx([score for score, _ in expected], abs=1e-12), question
+
+
+def test_ties_prefer_larger_id_and_bonus_applies(kb):
+    index, items, _ = kb
+    question = items[1]["question"]
+    same = sorted((i for i, item in items.items() if item["question"] == question), reverse=True)
+    assert len(same) >= 2
+    got = ai_qa._retrieve_top_k_index(index, question, len(same), 0.0)
+    # 完全相同的问题同分（余弦 1 + 精确匹配 0.2），id 较大者在前
+    assert [item["id"] for item, _ in got] == same
+    assert all(score == pytest.approx(1.2) for _, score in got)
+
+
+def test_substring_bonus(kb):
+    index, items, _ = kb
+    item = next(it for it in items.values() if len(it["question"]) >= 6)
+    question = item["question"][1:-1]
+    got = dict((it["id"], score) for it, score in ai_qa._retrieve_top_k_index(index, question, len(items), 0.0))
+    q_vec = Counter(ai_qa._char_bigrams(question))
+    expected = ai_qa._cosine(q_vec, Counter(ai_qa._char_bigrams(item["question"]))) + 0.1
+    assert got[item["id"]] == pytest.approx(expected)
+
+
+def test_advance_skips_own_writes_but_not_external_ones(tmp_path):
+    with closing(sqlite3.connect(str(tmp_path / "kb.db"))) as conn:
+        db.ensure_qa_kb_table(conn)
+        db.ensure_qa_kb_features(conn)
+        conn.execute("INSERT INTO qa_kb(question, answer) VALUES ('退货流程', '七天无理由')")
+        conn.commit()
+        index = KBIndex(ai_qa._char_bigrams, ai_qa._normalize_text)
+        index.load(conn)
+
+        # 本进程写入：原地应用并记录代数后，同步不再重读
+        conn.execute("UPDATE qa_kb SET answer='十五天无理由' WHERE id=1")
+        conn.commit()
+        index.upsert_from_db(conn, 1)
+        assert index.advance(conn.execute("SELECT gen FROM qa_kb WHERE id=1").fetchone()[0])
+        assert index.sync(conn) == 0
+        assert index.get(1)["answer"] == "十五天无理由"
+
+        # 其间有其他连接的写入：不前移，同步时一并读取
+        conn.execute("INSERT INTO qa_kb(question, answer) VALUES ('发票抬头', '可修改')")
+        conn.execute("INSERT INTO qa_kb(question, answer) VALUES ('快递时间', '三天')")
+        conn.commit()
+        index.upsert_from_db(conn, 3)
+        assert not index.advance(conn.execute("SELECT gen FROM qa_kb WHERE id=3").fetchone()[0])
+        assert index.sync(conn) == 2
+        assert len(index) == 3
@@ -0,0 +1,231 @@
+"""监听流水线的调度组件：ChatDispatcher、PollScheduler、BurstAggregator
+
+使用假时钟与假的提交函数，不依赖微信客户端（导入前注入替身 wxautox 模块）
+"""
+
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+sys.modules.setdefault("wxautox", types.SimpleNamespace(WeChat=object))
+
+from backend import listen_new_message as lnm  # noqa: E402
+from backend.listen_new_message import BurstAggregator, ChatDispatcher, PollScheduler  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(lnm, "time", types.SimpleNamespace(monotonic=fake.monotonic, sleep=time.sleep))
+    return fake
+
+
+def _wait_for(predicate, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, "等待超时"
+        time.sleep(0.001)
+
+
+def _msg(sender, content):
+    return types.SimpleNamespace(sender=sender, content=content, type="text", attr="friend")
+
+
+# ----- ChatDispatcher -----
+
+
+def _drain(dispatcher):
+    """单个回答线程：逐条取出并处理完成，返回处理顺序"""
+    order = []
+    while True:
+        got = dispatcher.get(timeout=0)
+        if got is None:
+            return order
+        chat_name, item, _ = got
+        order.append(item)
+        dispatcher.task_done(chat_name)
+
+
+def test_dispatcher_keeps_order_within_a_chat_and_serializes_it(clock):
+    d = ChatDispatcher()
+    for item in ("a1", "a2", "a3"):
+        d.put("A", item)
+    d.put("B", "b1")
+    assert d.get(timeout=0)[:2] == ("A", "a1")
+    # A 仍在处理中：其他线程只能拿到 B，A 的后续消息不会并发处理
+    assert d.get(timeout=0)[:2] == ("B", "b1")
+    assert d.get(timeout=0) is None
+    d.task_done("B")
+    assert d.get(timeout=0) is None
+    d.task_done("A")
+    assert d.get(timeout=0)[:2] == ("A", "a2")
+    d.task_done("A")
+    assert _drain(d) == ["a3"]
+    assert d.idle()
+
+
+def test_dispatcher_round_robins_between_chats(clock):
+    d = ChatDispatcher()
+    for i in range(6):
+        d.put("群聊", f"g{i}")
+    d.put("好友1", "f1")
+    d.put("好友2", "f2-0")
+    d.put("好友2", "f2-1")
+    # 刷屏的群聊每轮只占一个名额
+    assert _drain(d) == ["g0", "f1", "f2-0", "g1", "f2-1", "g2", "g3", "g4", "g5"]
+
+
+def test_dispatcher_records_queue_wait_with_the_clock(clock):
+    d = ChatDispatcher()
+    d.put("A", "a1")
+    clock.now += 2.5
+    d.put("A", "a2")
+    assert d.stats()["chats"]["A"]["oldest_wait_ms"] == 2500.0
+    assert d.get(timeout=0)[2] == pytest.approx(2.5)
+    d.task_done("A")
+    clock.now += 0.5
+    assert d.get(timeout=0)[2] == pytest.approx(0.5)
+    st = d.stats()["chats"]["A"]
+    assert (st["processed"], st["avg_wait_ms"], st["max_wait_ms"]) == (2, 1500.0, 2500.0)
+
+
+def test_dispatcher_bounds_backlog(clock):
+    d = ChatDispatcher(maxsize=3)
+    d.put("A", "a1")
+    d.put("A", "a2")
+    d.put("B", "b1")
+    assert d.put("C", "c1", timeout=0) is False
+    # drop：丢弃积压最多的聊天中最早的一条
+    assert d.put_dropping("C", "c1") == ("A", "a1")
+    assert _drain(d) == ["a2", "b1", "c1"]
+
+
+# ----- PollScheduler -----
+
+
+def test_poll_scheduler_backs_off_when_idle_and_resets_on_messages():
+    s = PollScheduler(min_interval=0.2, max_interval=1.0, backoff=2, max_drain=3)
+    assert [s.next_delay(False) for _ in range(5)] == [0.2, 0.4, 0.8, 1.0, 1.0]
+    # 拉到消息：立即连续拉取，连续 max_drain 次后让出一个最短间隔
+    assert [s.next_delay(True) for _ in range(4)] == [0.0, 0.0, 0.2, 0.0]
+    assert s.next_delay(False) == 0.2
+    assert s.next_delay(False) == 0.4
+
+
+# ----- BurstAggregator -----
+
+
+class Emitted:
+    """假的提交函数：记录 (聊天, 合并后的内容, 合并条数)"""
+
+    def __init__(self):
+        self.items = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, chat_name, msg):
+        self.gate.wait(5)
+        self.items.append((chat_name, msg.content, getattr(msg, "merged", 1)))
+
+
+@pytest.fixture
+def burst(clock):
+    emitted = Emitted()
+    windows = lnm.parse_per_chat_type("friend:0,group:1000", 0)
+    max_waits = lnm.parse_per_chat_type("4000", 0)
+    agg = BurstAggregator(emitted, windows, max_waits, max_pending=2)
+    agg.start()
+
+    def advance(seconds):
+        clock.now += seconds
+        # 假时钟前进后唤醒合并线程重新检查到期
+        with agg._cond:
+            agg._cond.notify_all()
+
+    yield agg, emitted, advance
+    emitted.gate.set()
+    agg.stop()
+
+
+def _settle():
+    time.sleep(0.05)
+
+
+def test_burst_merges_messages_within_the_window(burst):
+    agg, emitted, advance = burst
+    agg.add("群", "group", _msg("张三", "你好"))
+    advance(0.6)
+    agg.add("群", "group", _msg("张三", "请问"))
+    advance(0.9)
+    agg.add("群", "group", _msg("张三", "怎么退货"))
+    advance(0.9)
+    _settle()
+    assert emitted.items == []
+    advance(0.2)
+    _wait_for(lambda: emitted.items)
+    assert emitted.items == [("群", "你好\n请问\n怎么退货", 3)]
+    assert agg.stats()["saved_answers"] == 2
+
+
+def test_burst_max_wait_caps_a_continuous_stream(burst):
+    agg, emitted, advance = burst
+    texts = [str(i) for i in range(8)]
+    for text in texts:
+        agg.add("群", "group", _msg("张三", text))
+        advance(0.5)
+    # 每条都在窗口内，但从第一条起已满 4 秒上限：不再等最后一条的窗口结束
+    _wait_for(lambda: emitted.items)
+    assert emitted.items == [("群", "\n".join(texts), 8)]
+    agg.add("群", "group", _msg("张三", "六"))
+    advance(1.0)
+    _wait_for(lambda: len(emitted.items) == 2)
+    assert emitted.items[1] == ("群", "六", 1)
+
+
+def test_burst_other_sender_closes_previous_and_keeps_order(burst):
+    agg, emitted, advance = burst
+    agg.add("群", "group", _msg("张三", "a1"))
+    agg.add("群", "group", _msg("李四", "b1"))
+    # 李四插话：张三的缓冲立即提交，李四的仍在窗口内
+    _wait_for(lambda: emitted.items)
+    _settle()
+    assert emitted.items == [("群", "a1", 1)]
+    advance(1.0)
+    _wait_for(lambda: len(emitted.items) == 2)
+    assert emitted.items[1] == ("群", "b1", 1)
+
+
+def test_burst_window_zero_emits_immediately(burst):
+    agg, emitted, _ = burst
+    agg.add("好友", "friend", _msg("好友", "第一条"))
+    agg.add("好友", "friend", _msg("好友", "第二条"))
+    _wait_for(lambda: len(emitted.items) == 2)
+    assert emitted.items == [("好友", "第一条", 1), ("好友", "第二条", 1)]
+
+
+def test_burst_backpressure_waits_for_pending_slots(burst):
+    agg, emitted, _ = burst
+    emitted.gate.clear()  # 回答队列已满：提交阻塞
+    agg.add("好友1", "friend", _msg("a", "1"))
+    agg.add("好友2", "friend", _msg("b", "2"))
+    waited = []
+    t = threading.Thread(target=lambda: waited.append(agg.add("好友3", "friend", _msg("c", "3"))))
+    t.start()
+    _settle()
+    assert t.is_alive() and agg.pending() == 2
+    emitted.gate.set()
+    t.join(5)
+    assert waited == [True]
+    _wait_for(lambda: len(emitted.items) == 3)
+    assert [content for _, content, _ in emitted.items] == ["1", "2", "3"]
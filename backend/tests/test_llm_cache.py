@@ -0,0 +1,89 @@
+"""LLMAnswerCache：内存层 LRU 淘汰与 TTL 过期、持久层兜底，以及按知识库条目 / 提示词失效"""
+
+import sqlite3
+import types
+from contextlib import closing
+
+import pytest
+
+from backend import db, llm_cache
+from backend.llm_cache import LLMAnswerCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(llm_cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "cache.db")
+    with closing(sqlite3.connect(path)) as conn:
+        db.ensure_llm_answer_cache_table(conn)
+        conn.commit()
+    return path
+
+
+def test_lru_evicts_least_recently_used(tmp_path, clock):
+    # 没有缓存表：退化为纯内存缓存，淘汰后不会从持久层取回
+    cache = LLMAnswerCache(str(tmp_path / "none.db"), max_entries=2)
+    cache.put("a", "答A", None, "sys")
+    cache.put("b", "答B", None, "sys")
+    assert cache.get("a") == "答A"  # a 变为最近使用
+    cache.put("c", "答C", None, "sys")
+    assert cache.get("b") is None
+    assert cache.get("a") == "答A"
+    assert cache.get("c") == "答C"
+    stats = cache.stats()
+    assert (stats["evictions"], stats["size"], stats["hits"], stats["misses"]) == (1, 2, 3, 1)
+
+
+def test_ttl_expires_in_memory_and_in_db(db_path, clock):
+    cache = LLMAnswerCache(db_path, ttl_seconds=60)
+    cache.put("k", "答", 1, "sys")
+    clock[0] += 59
+    assert cache.get("k") == "答"
+    clock[0] += 1
+    assert cache.get("k") is None
+    # 新实例（如重启后）同样不会取到持久层中已过期的行
+    fresh = LLMAnswerCache(db_path, ttl_seconds=60)
+    assert fresh.get("k") is None
+    assert cache.stats()["expirations"] == 2
+    with closing(sqlite3.connect(db_path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM llm_answer_cache").fetchone()[0] == 0
+
+
+def test_evicted_entry_falls_back_to_db(db_path, clock):
+    cache = LLMAnswerCache(db_path, max_entries=1)
+    cache.put("a", "答A", None, "sys")
+    cache.put("b", "答B", None, "sys")
+    assert cache.get("a") == "答A"
+    assert cache.stats()["db_hits"] == 1
+
+
+def test_invalidate_kb_removes_only_that_item(db_path, clock):
+    cache = LLMAnswerCache(db_path)
+    cache.put("k1", "答1", 1, "sys")
+    cache.put("k1b", "答1b", 1, "sys")
+    cache.put("k2", "答2", 2, "sys")
+    assert cache.invalidate_kb(1) == 2
+    assert cache.get("k1") is None and cache.get("k1b") is None
+    assert cache.get("k2") == "答2"
+    # 持久层同样已删除：另一进程的新实例也取不到
+    other = LLMAnswerCache(db_path)
+    assert other.get("k1") is None
+    assert other.get("k2") == "答2"
+
+
+def test_invalidate_system_and_drop_memory(db_path, clock):
+    cache = LLMAnswerCache(db_path)
+    cache.put("old", "旧", None, "旧提示词")
+    cache.put("new", "新", None, "新提示词")
+    assert cache.invalidate_system("旧提示词") == 1
+    assert cache.get("old") is None
+    assert cache.drop_memory() == 1
+    # 只清空内存层：持久层仍可取回
+    assert cache.get("new") == "新"
+    assert cache.stats()["db_hits"] == 1
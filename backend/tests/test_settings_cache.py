@@ -0,0 +1,60 @@
+"""SettingsCache：只有 ai_settings 本身的修改才触发重读，其他表的写入不影响缓存"""
+
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from backend import ai_qa, db
+from backend.settings_cache import SettingsCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "settings.db")
+    with closing(sqlite3.connect(path)) as conn:
+        db.ensure_ai_settings_table(conn)
+        db.ensure_chat_history_table(conn)
+        conn.commit()
+    return path
+
+
+def _write(path, sql, params=()):
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute(sql, params)
+        conn.commit()
+
+
+def test_unrelated_writes_do_not_reload(path):
+    cache = SettingsCache(path, ai_qa._load_ai_settings)
+    first = cache.get()
+    assert first["system_prompt"]
+    for i in range(5):
+        _write(
+            path,
+            "INSERT INTO chat_history(friend_id, friend_name, sender, content) VALUES (1, '好友', '好友', ?)",
+            (f"消息{i}",),
+        )
+        assert cache.get() is first
+    assert cache.stats() == {"hits": 5, "reloads": 1, "invalidations": 0}
+
+
+def test_settings_writes_from_other_connections_reload(path):
+    cache = SettingsCache(path, ai_qa._load_ai_settings)
+    cache.get()
+    _write(path, "UPDATE ai_settings SET system_prompt = '新提示词'")
+    assert cache.get()["system_prompt"] == "新提示词"
+    _write(path, "INSERT INTO ai_settings(system_prompt) VALUES ('追加的提示词')")
+    assert cache.get()["system_prompt"] == "追加的提示词"
+    assert cache.get()["system_prompt"] == "追加的提示词"
+    assert cache.stats()["reloads"] == 3
+
+
+def test_missing_version_table_reads_every_time(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    _write(path, "CREATE TABLE ai_settings (id INTEGER PRIMARY KEY, system_prompt TEXT)")
+    _write(path, "INSERT INTO ai_settings(system_prompt) VALUES ('旧库提示词')")
+    cache = SettingsCache(path, ai_qa._load_ai_settings)
+    assert cache.get()["system_prompt"] == "旧库提示词"
+    assert cache.get()["system_prompt"] == "旧库提示词"
+    assert cache.stats()["reloads"] == 2
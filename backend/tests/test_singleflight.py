@@ -0,0 +1,151 @@
+"""SingleFlight：并发的相同调用只执行一次，领头的结果 / 异常交给全部等待者"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from backend.singleflight import FlightRejected, SingleFlight
+
+N = 16
+
+
+def _wait_for(predicate, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, "等待超时"
+        time.sleep(0.001)
+
+
+def _run_concurrently(call):
+    """N 个线程同时调用 call()，领头的 fn 在全部等待者加入后才返回；返回各线程的结果或异常"""
+    results = [None] * N
+
+    def worker(i):
+        try:
+            results[i] = call()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(N)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def _gated_fn(flight, outcome):
+    calls = []
+
+    def fn():
+        calls.append(threading.get_ident())
+        _wait_for(lambda: flight.stats()["waiting"] == N - 1)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return fn, calls
+
+
+def test_concurrent_identical_calls_run_once():
+    flight = SingleFlight()
+    fn, calls = _gated_fn(flight, {"answer": 42})
+    results = _run_concurrently(lambda: flight.do("q", fn))
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    stats = flight.stats()
+    assert (stats["executions"], stats["coalesced"], stats["waiting"], stats["in_flight"]) == (1, N - 1, 0, 0)
+
+
+def test_leader_exception_reaches_all_waiters():
+    flight = SingleFlight()
+    error = ValueError("上游失败")
+    fn, calls = _gated_fn(flight, error)
+    results = _run_concurrently(lambda: flight.do("q", fn))
+    assert len(calls) == 1
+    assert all(r is error for r in results)
+    # 失败的调用不会残留在途表中，下一次调用重新执行
+    assert flight.do("q", lambda: "ok") == "ok"
+    assert flight.stats()["executions"] == 2
+
+
+def test_different_keys_do_not_coalesce():
+    flight = SingleFlight()
+    assert [flight.do(k, lambda k=k: k * 2) for k in (1, 2, 3)] == [2, 4, 6]
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_background_leader_runs_once_and_waiters_stay_off_the_executor():
+    flight = SingleFlight()
+    fn, calls = _gated_fn(flight, "answer")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+
+        def launch(run, abandon):
+            pool.submit(run)
+            return True
+
+        results = _run_concurrently(lambda: flight.do_background("q", fn, launch, timeout=5))
+    # 只有一个执行器线程：等待者若占用执行器，领头永远等不到全部等待者加入
+    assert results == ["answer"] * N
+    assert len(calls) == 1
+
+
+def test_background_rejection_and_timeout():
+    flight = SingleFlight()
+    with pytest.raises(FlightRejected):
+        flight.do_background("q", lambda: "x", lambda run, abandon: False, timeout=1)
+    with pytest.raises(FlightRejected):
+        flight.do_background("q", lambda: "x", lambda run, abandon: abandon() or True, timeout=1)
+    assert flight.stats()["in_flight"] == 0
+
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+
+        def launch(run, abandon):
+            pool.submit(run)
+            return True
+
+        with pytest.raises(concurrent.futures.TimeoutError):
+            flight.do_background("slow", lambda: release.wait(5) and "late", launch, timeout=0.05)
+        # 超时不影响在途调用：仍在执行，之后加入的调用者直接拿到它的结果
+        assert flight.stats()["in_flight"] == 1
+        joined = []
+        t = threading.Thread(target=lambda: joined.append(flight.do_background("slow", lambda: "again", launch, 5)))
+        t.start()
+        _wait_for(lambda: flight.stats()["waiting"] == 1)
+        release.set()
+        t.join(5)
+    assert joined == ["late"]
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_async_and_thread_callers_share_a_flight():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def blocking():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "shared"
+
+    holder = {}
+    t = threading.Thread(target=lambda: holder.setdefault("thread", flight.do("q", blocking)))
+    t.start()
+    started.wait(5)
+
+    async def waiter():
+        task = asyncio.ensure_future(flight.do_async("q", lambda: asyncio.sleep(0, "own")))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await task
+
+    assert asyncio.run(waiter()) == "shared"
+    t.join(5)
+    assert holder["thread"] == "shared" and calls == [1]